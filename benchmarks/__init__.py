@@ -0,0 +1,10 @@
+"""
+    Benchmarks for prep, run against synthetic PromethION runs so that no real sequencing run is needed.
+
+    synthetic_run.py - builds a fake run tree and matching sample sheet
+    run_benchmarks.py - times the scan, staging (collapse and --no_collapse) and max_length.py filter stages,
+                        reporting MB/s and reads/s and keeping the results for before and after comparisons
+
+    Run from the top of the repository, e.g.
+        python -m benchmarks.run_benchmarks --barcodes 8 --chunks 20 --reads 4000 --results bench.jsonl
+"""
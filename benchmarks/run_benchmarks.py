@@ -0,0 +1,215 @@
+from argparse import ArgumentParser as AP
+from contextlib import redirect_stdout
+from datetime import datetime
+from pathlib import Path
+from shutil import rmtree
+import subprocess
+import tempfile
+import json
+import time
+import sys
+import os
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))  # the prep modules are top-level scripts, not a package
+
+from plasmid_prep import parse_samplesheet, parse_input_dirs, create_new_structure
+from plasmid_collapse import default_workers, reads_decoded
+from plasmid_stage import STAGING_STRATEGIES
+from block_gzip import OUTPUT_FORMATS
+from read_filter import size_band
+from benchmarks.synthetic_run import make_run, load_run
+
+"""
+    Repeatable prep benchmarks on a synthetic run (see synthetic_run.py):
+        scan - parse_input_dirs(), walking the run tree for the barcode directories (run_scan.scan_run)
+        collapse_concat - create_new_structure() collapsing each barcode, gzip members joined as they are
+        collapse_decode - create_new_structure() with every read decompressed and recompressed
+        no_collapse - create_new_structure() with --no_collapse, staging the chunks as they are (--staging_strategy)
+        max_length - max_length.py over every collapsed FASTQ, as run by the Nanofilt filter scripts
+
+    Each benchmark is run --repeats times and the fastest is kept, so after the first repeat the run is
+    read from the page cache. Throughput is given in MB of FASTQ input (as stored, mostly gzipped) and
+    reads per second, and the scan in files per second.
+
+    With --results, each benchmark is appended to a JSON Lines file along with the git revision and run
+    settings. With --baseline, the latest earlier result of each benchmark in that file is shown
+    alongside, as a speedup, e.g. to compare a branch against master:
+        python -m benchmarks.run_benchmarks --run_dir /tmp/bench_run --results bench.jsonl
+        git checkout my_branch
+        python -m benchmarks.run_benchmarks --run_dir /tmp/bench_run --results bench.jsonl --baseline bench.jsonl
+"""
+
+BENCHMARKS = ('scan', 'collapse_concat', 'collapse_decode', 'no_collapse', 'max_length')
+
+
+def best_time(fn, repeats: int, setup=None) -> float:
+    """
+    Fastest wall time in seconds of fn() over repeats, calling setup() untimed before each
+    """
+    times = []
+    for _ in range(max(repeats, 1)):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def bench_scan(info: dict, repeats: int) -> dict:
+    client_sheet = parse_samplesheet(info['samplesheet'])
+    seconds = best_time(lambda: parse_input_dirs(info['prom_dir'], client_sheet), repeats)
+    return {'seconds':seconds, 'files_per_s':info['files'] / seconds}
+
+
+def bench_stage(info: dict, work_dir: Path, repeats: int, collapse=True, collapse_mode='concat', workers=1,
+        read_stats=True, staging='copy', output_format='gzip') -> dict:
+    """
+    Time create_new_structure() into work_dir/collapsed (or work_dir/copied without collapse),
+    which is left in place afterwards
+    """
+    client_sheet = parse_samplesheet(info['samplesheet'])
+    source_dirs, scan_index = parse_input_dirs(info['prom_dir'], client_sheet)
+    plasmid_dir = Path(work_dir)/('collapsed' if collapse else 'copied')
+
+    def setup():
+        if plasmid_dir.exists():
+            rmtree(plasmid_dir)
+        plasmid_dir.mkdir(parents=True)
+
+    def stage():
+        with open(os.devnull, 'wt') as devnull, redirect_stdout(devnull):
+            if not create_new_structure(plasmid_dir, client_sheet, source_dirs, collapse=collapse,
+                    collapse_mode=collapse_mode, workers=workers, scan_index=scan_index, read_stats=read_stats,
+                    staging=staging, output_format=output_format):
+                raise RuntimeError(f'create_new_structure failed in {plasmid_dir}')
+
+    return {'seconds':best_time(stage, repeats, setup=setup)}
+
+
+def bench_max_length(info: dict, work_dir: Path, repeats: int) -> dict:
+    """
+    Time max_length.py over the collapsed FASTQs left in work_dir/collapsed by a collapse benchmark
+    """
+    client_sheet = parse_samplesheet(info['samplesheet'])
+    jobs = []
+    for client in client_sheet:
+        for barcode, sample in client_sheet[client].items():
+            fp = Path(work_dir)/'collapsed'/client/barcode/f'{barcode}.fq.gz'
+            jobs.append((size_band(sample['size'])[1], fp))
+    if not all(fp.exists() for max_len, fp in jobs):
+        raise RuntimeError('max_length needs the collapsed FASTQs of a collapse benchmark')
+
+    def run():
+        for max_len, fp in jobs:
+            subprocess.run([sys.executable, str(REPO_DIR/'max_length.py'), str(max_len), str(fp)],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+
+    seconds = best_time(run, repeats)
+    return {'seconds':seconds, 'mb':sum(fp.stat().st_size for max_len, fp in jobs) / 1e6}
+
+
+def latest_results(results_fp: Path) -> dict:
+    """
+    {benchmark: its latest result} from a results file
+    """
+    latest = {}
+    if Path(results_fp).exists():
+        with open(results_fp, 'rt') as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    latest[result['benchmark']] = result
+    return latest
+
+
+def format_results(results: list, baseline: dict) -> str:
+    lines = ['benchmark\tseconds\tMB/s\treads/s\tfiles/s' + ('\tspeedup' if baseline else '')]
+    for r in results:
+        line = '\t'.join([r['benchmark'], f"{r['seconds']:.3f}"] + [f'{r[key]:.1f}' if key in r else '-'
+                for key in ('mb_per_s', 'reads_per_s', 'files_per_s')])
+        if baseline:
+            base = baseline.get(r['benchmark'])
+            line += f"\t{base['seconds'] / r['seconds']:.2f}x" if base else '\t'
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def main():
+    parser = AP(description='Benchmark prep stages on a synthetic PromethION run')
+    parser.add_argument('--run_dir', help='Synthetic run to use, built here first if it holds none (default: a temporary directory)')
+    parser.add_argument('--work_dir', help='Where the plasmid directories are written (default: a temporary directory)')
+    parser.add_argument('--barcodes', type=int, default=8, help='Barcodes in a new synthetic run (default: 8)')
+    parser.add_argument('--chunks', type=int, default=10, help='FASTQ chunks per barcode in a new synthetic run (default: 10)')
+    parser.add_argument('--reads', type=int, default=4000, help='Reads per chunk in a new synthetic run (default: 4000)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for a new synthetic run (default: 1)')
+    parser.add_argument('--benchmarks', nargs='*', choices=BENCHMARKS, default=list(BENCHMARKS), help='Benchmarks to run (default: all)')
+    parser.add_argument('--repeats', type=int, default=3, help='Times each benchmark is run, the fastest is kept (default: 3)')
+    parser.add_argument('--workers', type=int, default=default_workers(), help='Collapse worker processes (default: all available cores)')
+    parser.add_argument('--staging_strategy', choices=STAGING_STRATEGIES, default='copy', help='How no_collapse stages the chunks (default: copy)')
+    parser.add_argument('--output_format', choices=OUTPUT_FORMATS, default='gzip', help='Format of the collapsed FASTQs (default: gzip)')
+    parser.add_argument('--read_stats', action='store_true', help='Gather read statistics in collapse_concat too, as prep --read_stats does')
+    parser.add_argument('--no_read_stats', action='store_true', help='Collapse without gathering read statistics')
+    parser.add_argument('--results', help='Append the results to this JSON Lines file')
+    parser.add_argument('--baseline', help='Compare against the latest earlier results in this JSON Lines file')
+    args = parser.parse_args()
+
+    baseline = latest_results(args.baseline) if args.baseline else {}
+    with tempfile.TemporaryDirectory(prefix='plasmid_bench_') as tmp:
+        run_dir = Path(args.run_dir) if args.run_dir else Path(tmp)/'run'
+        info = load_run(run_dir)
+        if info is None:
+            print(f'Building a synthetic run in {run_dir}')
+            info = make_run(run_dir, barcodes=args.barcodes, chunks=args.chunks, reads=args.reads, seed=args.seed)
+        print(f"Run of {info['files']} FASTQ files, {info['reads']} reads, {info['bytes'] / 1e6:.1f} MB")
+        work_dir = Path(args.work_dir) if args.work_dir else Path(tmp)/'work'
+        work_dir.mkdir(parents=True, exist_ok=True)
+
+        results = []
+        for name in BENCHMARKS:
+            if name not in args.benchmarks:
+                continue
+            if name == 'scan':
+                r = bench_scan(info, args.repeats)
+            elif name == 'max_length':
+                if not {'collapse_concat', 'collapse_decode'} & set(args.benchmarks):
+                    bench_stage(info, work_dir, 1, workers=args.workers, read_stats=False)
+                r = bench_max_length(info, work_dir, args.repeats)
+            else:
+                collapse = name != 'no_collapse'
+                collapse_mode = name.split('_')[-1]
+                # read stats as prep gathers them by default
+                read_stats = collapse and not args.no_read_stats and (args.read_stats or
+                        reads_decoded(collapse_mode, bgzf=args.output_format == 'bgzf'))
+                r = bench_stage(info, work_dir, args.repeats, collapse=collapse, collapse_mode=collapse_mode,
+                        workers=args.workers, read_stats=read_stats, staging=args.staging_strategy,
+                        output_format=args.output_format)
+            r['benchmark'] = name
+            if name != 'scan':
+                mb = r.pop('mb', info['bytes'] / 1e6)
+                r.update({'mb_per_s':mb / r['seconds'], 'reads_per_s':info['reads'] / r['seconds']})
+            results.append(r)
+            print(f"{name}: {r['seconds']:.3f}s")
+
+    print(format_results(results, baseline))
+    if args.results:
+        stamp = {'time':datetime.now().isoformat(timespec='seconds'), 'revision':git_revision(),
+                'settings':dict(info['settings'], workers=args.workers, repeats=args.repeats,
+                read_stats='on' if args.read_stats else 'off' if args.no_read_stats else 'default',
+                staging=args.staging_strategy, output_format=args.output_format)}
+        with open(args.results, 'at') as f:
+            for r in results:
+                print(json.dumps({**stamp, **r}), file=f)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+from argparse import ArgumentParser as AP
+from pathlib import Path
+import random
+import json
+import gzip
+
+"""
+    Synthetic PromethION run trees for benchmarking prep, laid out the way MinKNOW writes them:
+        <root>/pool/<run name>/fastq_pass/barcodeNN/<flowcell>_pass_barcodeNN_<run id>_<chunk>.fastq.gz
+    along with the fastq_fail, pod5 and other_reports directories that the scan has to skip,
+    a sample sheet for the barcodes (<root>/sample_sheet.csv), references for some of them, and
+    <root>/synthetic_run.json describing what was made (reads, bases and bytes) for the benchmarks.
+
+    Each barcode gets a plasmid size between min_size and max_size. Most of its reads are full length,
+    normally distributed around the plasmid size, and the rest (junk_fraction) are partial reads or
+    concatemers uniformly between 200bp and twice the size. Each read's mean quality is normally
+    distributed around mean_quality. A fraction of the chunks (plain_fraction) are written as plain
+    .fastq rather than gzipped, as happens when a run is interrupted.
+
+    Sequence and quality strings are sliced from pre-made random pools, so building a run of
+    several GB is limited by gzip rather than by generating random bases.
+"""
+
+RUN_NAME = '20250101_1200_1A_PBC00000_0000abcd'
+FLOWCELL = 'PBC00000'
+SHEET_NAME = 'sample_sheet.csv'
+INFO_NAME = 'synthetic_run.json'
+POOL_BASES = 1 << 20  # length of the random sequence and quality pools reads are sliced from
+MIN_READ = 200
+MIN_QUALITY = 2
+MAX_QUALITY = 40
+
+
+class ReadMaker:
+    """
+    Makes FASTQ records from random pools
+
+    args:
+    rng - random.Random
+    mean_quality - mean of the per-read mean qualities
+    quality_sd - standard deviation of the per-read mean qualities
+    """
+    def __init__(self, rng: random.Random, mean_quality=20.0, quality_sd=4.0):
+        self.rng = rng
+        self.mean_quality = mean_quality
+        self.quality_sd = quality_sd
+        # each pool is kept twice over, so any read up to POOL_BASES long is a single slice
+        seq_pool = ''.join(rng.choices('ACGT', k=POOL_BASES))
+        self.seq_pool = seq_pool + seq_pool
+        # one pool per mean quality, each base within +/-3 of it, all from the same random offsets
+        offsets = ''.join(rng.choices('0123456', k=POOL_BASES))
+        self.qual_pools = {}
+        for q in range(MIN_QUALITY, MAX_QUALITY + 1):
+            qual_pool = offsets.translate({ord(str(d)):chr(33 + max(q + d - 3, 0)) for d in range(7)})
+            self.qual_pools[q] = qual_pool + qual_pool
+
+    def take(self, pool: str, length: int) -> str:
+        if length <= POOL_BASES:
+            start = self.rng.randrange(POOL_BASES)
+            return pool[start:start + length]
+        return (pool[:POOL_BASES] * (length // POOL_BASES + 1))[:length]
+
+    def record(self, name: str, length: int) -> str:
+        q = min(max(round(self.rng.gauss(self.mean_quality, self.quality_sd)), MIN_QUALITY), MAX_QUALITY)
+        return f'@{name} runid=0000abcd\n{self.take(self.seq_pool, length)}\n+\n{self.take(self.qual_pools[q], length)}\n'
+
+
+def read_length(rng: random.Random, size: int, length_sd: float, junk_fraction: float) -> int:
+    if rng.random() < junk_fraction:
+        return rng.randint(MIN_READ, 2 * size)
+    return max(MIN_READ, int(rng.gauss(size, length_sd)))
+
+
+def make_run(root: Path, barcodes=8, chunks=10, reads=4000, clients=4, min_size=3000, max_size=12000,
+        length_sd=300.0, junk_fraction=0.3, mean_quality=20.0, quality_sd=4.0, plain_fraction=0.1,
+        reference_fraction=0.5, compresslevel=1, seed=1) -> dict:
+    """
+    Build a synthetic run tree and its sample sheet under root
+
+    args:
+    root - Path to build in, created if needed
+    barcodes - number of barcodes
+    chunks - FASTQ chunk files per barcode
+    reads - reads per chunk
+    clients - barcodes are shared out between this many clients
+    min_size, max_size - range of the plasmid sizes
+    length_sd - standard deviation of the full-length read lengths around the plasmid size
+    junk_fraction - fraction of reads that are partial or concatemers
+    mean_quality, quality_sd - distribution of the per-read mean qualities
+    plain_fraction - fraction of chunks written as plain .fastq
+    reference_fraction - fraction of barcodes given a reference
+    compresslevel - gzip level of the gzipped chunks. Random sequence compresses no smaller at higher levels, only slower
+    seed - random seed, the same settings and seed always build the same run
+
+    returns: the run description also written to root/INFO_NAME
+        {'prom_dir', 'samplesheet', 'settings', 'reads', 'bases', 'bytes', 'files'}
+    """
+    root = Path(root)
+    rng = random.Random(seed)
+    maker = ReadMaker(rng, mean_quality=mean_quality, quality_sd=quality_sd)
+    run_dir = root/'pool'/RUN_NAME
+    for sub in ('pod5', 'other_reports', 'fastq_fail/barcode01'):
+        (run_dir/sub).mkdir(parents=True, exist_ok=True)
+    with gzip.open(run_dir/'fastq_fail'/'barcode01'/f'{FLOWCELL}_fail_barcode01_0000abcd_0.fastq.gz', 'wt') as f:
+        f.write(maker.record('fail0', 1000))
+    (root/'references').mkdir(parents=True, exist_ok=True)
+    sheet = ['client,alias,barcode,size,reference']
+    info = {'prom_dir':str(root/'pool'), 'samplesheet':str(root/SHEET_NAME), 'reads':0, 'bases':0, 'bytes':0, 'files':0,
+            'settings':{'barcodes':barcodes, 'chunks':chunks, 'reads':reads, 'clients':clients, 'min_size':min_size,
+            'max_size':max_size, 'length_sd':length_sd, 'junk_fraction':junk_fraction, 'mean_quality':mean_quality,
+            'quality_sd':quality_sd, 'plain_fraction':plain_fraction, 'reference_fraction':reference_fraction,
+            'compresslevel':compresslevel, 'seed':seed}}
+    for b in range(1, barcodes + 1):
+        barcode = f'barcode{b:02d}'
+        bcd = run_dir/'fastq_pass'/barcode
+        bcd.mkdir(parents=True, exist_ok=True)
+        size = rng.randint(min_size, max_size)
+        for c in range(chunks):
+            records = []
+            for r in range(reads):
+                length = read_length(rng, size, length_sd, junk_fraction)
+                records.append(maker.record(f'{barcode}_{c}_{r}', length))
+                info['bases'] += length
+            data = ''.join(records)
+            if rng.random() < plain_fraction:
+                fp = bcd/f'{FLOWCELL}_pass_{barcode}_0000abcd_{c}.fastq'
+                fp.write_text(data)
+            else:
+                fp = bcd/f'{FLOWCELL}_pass_{barcode}_0000abcd_{c}.fastq.gz'
+                with gzip.open(fp, 'wt', compresslevel=compresslevel) as f:
+                    f.write(data)
+            info['reads'] += reads
+            info['bytes'] += fp.stat().st_size
+            info['files'] += 1
+        reference = ''
+        if rng.random() < reference_fraction:
+            ref_fp = root/'references'/f'{barcode}.fasta'
+            ref_fp.write_text(f'>{barcode}_ref\n{maker.take(maker.seq_pool, size)}\n')
+            reference = str(ref_fp)
+        sheet.append(f'Client_{(b - 1) % clients},plasmid{b},{barcode},{size},{reference}')
+    (root/SHEET_NAME).write_text('\n'.join(sheet) + '\n')
+    with open(root/INFO_NAME, 'wt') as f:
+        json.dump(info, f, indent=1)
+    return info
+
+
+def load_run(root: Path) -> dict|None:
+    """
+    Description of a run built earlier by make_run(), or None if root doesn't hold one
+    """
+    fp = Path(root)/INFO_NAME
+    if not fp.exists():
+        return None
+    with open(fp, 'rt') as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = AP(description='Build a synthetic PromethION run and sample sheet for benchmarking prep')
+    parser.add_argument('root', help='Directory to build the run in')
+    parser.add_argument('--barcodes', type=int, default=8, help='Number of barcodes (default: 8)')
+    parser.add_argument('--chunks', type=int, default=10, help='FASTQ chunk files per barcode (default: 10)')
+    parser.add_argument('--reads', type=int, default=4000, help='Reads per chunk (default: 4000)')
+    parser.add_argument('--clients', type=int, default=4, help='Number of clients the barcodes are shared between (default: 4)')
+    parser.add_argument('--min_size', type=int, default=3000, help='Smallest plasmid size (default: 3000)')
+    parser.add_argument('--max_size', type=int, default=12000, help='Largest plasmid size (default: 12000)')
+    parser.add_argument('--length_sd', type=float, default=300, help='Standard deviation of full-length read lengths (default: 300)')
+    parser.add_argument('--junk_fraction', type=float, default=0.3, help='Fraction of partial and concatemer reads (default: 0.3)')
+    parser.add_argument('--mean_quality', type=float, default=20, help='Mean of the per-read mean qualities (default: 20)')
+    parser.add_argument('--quality_sd', type=float, default=4, help='Standard deviation of the per-read mean qualities (default: 4)')
+    parser.add_argument('--plain_fraction', type=float, default=0.1, help='Fraction of chunks written as plain .fastq (default: 0.1)')
+    parser.add_argument('--reference_fraction', type=float, default=0.5, help='Fraction of barcodes with a reference (default: 0.5)')
+    parser.add_argument('--compress_level', type=int, default=1, choices=range(1, 10), metavar='1-9', help='gzip level of the chunks (default: 1)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed (default: 1)')
+    args = parser.parse_args()
+    info = make_run(args.root, barcodes=args.barcodes, chunks=args.chunks, reads=args.reads, clients=args.clients,
+            min_size=args.min_size, max_size=args.max_size, length_sd=args.length_sd, junk_fraction=args.junk_fraction,
+            mean_quality=args.mean_quality, quality_sd=args.quality_sd, plain_fraction=args.plain_fraction,
+            reference_fraction=args.reference_fraction, compresslevel=args.compress_level, seed=args.seed)
+    print(f"Built {info['files']} FASTQ files, {info['reads']} reads, {info['bytes'] / 1e6:.1f} MB in {info['prom_dir']}")
+    print(f"Sample sheet {info['samplesheet']}")
@@ -0,0 +1,233 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from pathlib import Path
+import struct
+import zlib
+import os
+import io
+import gzip
+
+"""
+    Multi-threaded gzip writer used for every compressed FASTQ that prep and read_filter.py write.
+
+    Output is cut into fixed size blocks and each block is compressed on a thread pool as its
+    own gzip member (zlib releases the GIL, so the threads really do run in parallel). The members
+    are written in order, so the file is an ordinary multi-member gzip that gunzip, zcat, Python's
+    gzip module and the pipeline's tools all read as a single stream. Blocks don't depend on each
+    other, so the output is identical whatever the number of threads.
+
+    With bgzf=True the members are BGZF blocks, the blocked gzip of samtools and htslib: at most
+    BGZF_BLOCK_SIZE bytes each, with the block's compressed size in a 'BC' extra field, and an empty
+    end of file block. Any gzip reader still reads the file as one stream, while htslib tools (and
+    anything else that can seek to a member) can decompress the blocks in parallel or start part way
+    through. The file gets a .gzi index alongside, in the format of bgzip -i: a little-endian uint64
+    count, then a (compressed offset, uncompressed offset) uint64 pair for every block but the first.
+"""
+
+DEFAULT_COMPRESS_LEVEL = 3  # most of the size saving of level 6 to 9 at a fraction of the time
+COMPRESS_BLOCK_SIZE = 4 * 1024 * 1024  # 4MiB of uncompressed FASTQ per gzip member
+OUTPUT_FORMATS = ('gzip', 'bgzf')
+BGZF_BLOCK_SIZE = 0xff00  # uncompressed bytes per BGZF block, as htslib, so a block always fits in 64KiB compressed
+BGZF_HEADER = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00'  # followed by the uint16 block size - 1
+BGZF_EOF = BGZF_HEADER + b'\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+
+def default_workers() -> int:
+    """
+    Number of cores this process is allowed to use. On Gadi this respects the
+    cpuset of the PBS job rather than the size of the node.
+    """
+    try:
+        return max(1, len(os.sched_getaffinity(0)))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def compress_block(data: bytes, compresslevel: int) -> bytes:
+    """
+    Compress data as one complete gzip member, with a fixed header timestamp
+    """
+    return gzip.compress(data, compresslevel=compresslevel, mtime=0)
+
+
+def compress_bgzf_block(data: bytes, compresslevel: int) -> bytes:
+    """
+    Compress up to BGZF_BLOCK_SIZE bytes of data as one BGZF block
+    """
+    c = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+    deflated = c.compress(data) + c.flush()
+    return BGZF_HEADER + struct.pack('<H', len(BGZF_HEADER) + 2 + len(deflated) + 8 - 1) + deflated + \
+            struct.pack('<II', zlib.crc32(data), len(data))
+
+
+def gzi_path(fp) -> Path:
+    return Path(str(fp) + '.gzi')
+
+
+def read_gzi(fp) -> list:
+    """
+    [(compressed offset, uncompressed offset)] of the blocks in a .gzi index, the first block (0, 0) excluded
+    """
+    with open(fp, 'rb') as f:
+        data = f.read()
+    n = struct.unpack_from('<Q', data)[0]
+    return [struct.unpack_from('<QQ', data, 8 + 16 * i) for i in range(n)]
+
+
+def write_gzi(fp, entries: list):
+    with open(fp, 'wb') as f:
+        f.write(struct.pack('<Q', len(entries)))
+        for coffset, uoffset in entries:
+            f.write(struct.pack('<QQ', coffset, uoffset))
+
+
+def scan_bgzf(fp, start=(0, 0)) -> tuple:
+    """
+    Walk the block headers of a BGZF file from the block at start, reading a few bytes per block
+
+    args:
+    fp - Path of a BGZF file
+    start - (compressed, uncompressed) offset of a block to start from, e.g. from its .gzi index
+
+    returns: (entries, end)
+    entries - [(compressed offset, uncompressed offset)] of each block from start on that holds data, as in read_gzi()
+    end - (compressed, uncompressed) offset of the end of the file
+
+    Raises ValueError if a block isn't BGZF
+    """
+    entries = []
+    coffset, uoffset = start
+    size = os.path.getsize(fp)
+    with open(fp, 'rb') as f:
+        while coffset < size:
+            f.seek(coffset)
+            header = f.read(len(BGZF_HEADER) + 2)
+            if len(header) < len(BGZF_HEADER) + 2 or header[:len(BGZF_HEADER)] != BGZF_HEADER:
+                raise ValueError(f'{fp} is not BGZF at byte {coffset}')
+            block_size = struct.unpack('<H', header[-2:])[0] + 1
+            f.seek(coffset + block_size - 4)
+            isize = f.read(4)
+            if len(isize) < 4:
+                raise ValueError(f'{fp} ends part way through a BGZF block at byte {coffset}')
+            isize = struct.unpack('<I', isize)[0]
+            if coffset and isize:
+                entries.append((coffset, uoffset))
+            coffset += block_size
+            uoffset += isize
+    return entries, (coffset, uoffset)
+
+
+def resume_bgzf(fp, index_fp=None) -> tuple:
+    """
+    Index of a BGZF file about to be appended to, from index_fp where it is still valid and the file
+    itself after that. The end of file block stays where it is, as an empty block part way through
+    is still valid BGZF (as when bgzip files are joined with cat), and the file only ever grows
+
+    returns: (entries, end) as scan_bgzf()
+    """
+    entries = []
+    size = os.path.getsize(fp)
+    if index_fp is not None and Path(index_fp).exists():
+        # entries past the end are from an append that has since been trimmed (see plasmid_watch.py)
+        entries = [e for e in read_gzi(index_fp) if e[0] < size]
+    start = entries.pop() if entries else (0, 0)
+    more, end = scan_bgzf(fp, start)
+    return entries + more, end
+
+
+class BlockGzipWriter(io.BufferedIOBase):
+    """
+    Binary file object writing a multi-member gzip, compressing blocks on a pool of threads
+
+    args:
+    fp - Path of the file to write, or None if fileobj is given
+    mode - 'wb' to replace fp, 'ab' to add to the end of it
+    fileobj - optional open binary file to write to instead of fp, it is left open on close()
+    compresslevel - int, zlib compression level 1-9
+    threads - int, number of compression threads, 0 for all available cores
+    block_size - int, bytes of uncompressed data per gzip member
+    bgzf - bool, write BGZF blocks of BGZF_BLOCK_SIZE instead, and an index of them
+    index_fp - Path of the BGZF index, by default fp with .gzi added. Needed with fileobj to write an index
+    """
+    def __init__(self, fp=None, mode='wb', fileobj=None, compresslevel=DEFAULT_COMPRESS_LEVEL, threads=1,
+            block_size=COMPRESS_BLOCK_SIZE, bgzf=False, index_fp=None):
+        super().__init__()
+        if mode not in ('wb', 'ab'):
+            raise ValueError(f'Unsupported mode {mode}, expected wb or ab')
+        self.bgzf = bgzf
+        self.index_fp = index_fp if index_fp is not None or fp is None or not bgzf else gzi_path(fp)
+        self.index = []  # BGZF blocks written, see read_gzi()
+        self.offsets = (0, 0)  # (compressed, uncompressed) bytes in the file
+        if bgzf and mode == 'ab' and fileobj is None and os.path.exists(fp) and os.path.getsize(fp):
+            self.index, self.offsets = resume_bgzf(fp, self.index_fp)
+        self.owns_file = fileobj is None
+        self.fileobj = open(fp, mode) if fileobj is None else fileobj
+        self.compresslevel = compresslevel
+        self.threads = threads if threads > 0 else default_workers()
+        self.block_size = BGZF_BLOCK_SIZE if bgzf else block_size
+        self.compress = compress_bgzf_block if bgzf else compress_block
+        self.buf = bytearray()
+        self.written = 0  # uncompressed bytes
+        self.pending = deque()  # compressed blocks in output order
+        self.pool = ThreadPoolExecutor(max_workers=self.threads) if self.threads > 1 else None
+
+    def writable(self):
+        return True
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError('write to closed file')
+        self.buf += data
+        n = len(data) if not isinstance(data, memoryview) else data.nbytes
+        self.written += n
+        while len(self.buf) >= self.block_size:
+            block = bytes(self.buf[:self.block_size])
+            del self.buf[:self.block_size]
+            self._submit(block)
+        return n
+
+    def _submit(self, block: bytes):
+        if self.pool is None:
+            self._write_block(self.compress(block, self.compresslevel))
+            return
+        self.pending.append(self.pool.submit(self.compress, block, self.compresslevel))
+        # keep a couple of blocks per thread in flight, so memory use stays bounded
+        while len(self.pending) > 2 * self.threads:
+            self._write_block(self.pending.popleft().result())
+
+    def _write_block(self, member: bytes):
+        if self.bgzf:
+            coffset, uoffset = self.offsets
+            if coffset:
+                self.index.append(self.offsets)
+            # every member ends with its uncompressed size
+            self.offsets = (coffset + len(member), uoffset + struct.unpack('<I', member[-4:])[0])
+        self.fileobj.write(member)
+
+    def flush(self):
+        """
+        Block boundaries don't move on flush, so the output stays the same however often it's called
+        """
+        if not self.closed:
+            self.fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buf or not (self.written or self.bgzf):
+                # an empty file still gets one (empty) member, as gzip would write. BGZF has its end of file block
+                self._submit(bytes(self.buf))
+                self.buf = bytearray()
+            while self.pending:
+                self._write_block(self.pending.popleft().result())
+            if self.bgzf:
+                self.fileobj.write(BGZF_EOF)
+                if self.index_fp is not None:
+                    write_gzi(self.index_fp, self.index)
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(cancel_futures=True)
+            super().close()  # flushes fileobj
+            if self.owns_file:
+                self.fileobj.close()
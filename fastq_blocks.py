@@ -0,0 +1,129 @@
+import sys
+import gzip
+
+from block_gzip import BlockGzipWriter, DEFAULT_COMPRESS_LEVEL
+
+"""
+    Block based FASTQ parsing shared by max_length.py, read_filter.py and the prep scripts.
+
+    Reads are never split into per-line strings. Large binary blocks are read from the
+    file, record boundaries are found with bytes.find() (memchr in C), and each record is
+    described only by its offsets into the block. Surviving records are written back out
+    as whole slices of the block, with neighbouring records joined into a single write.
+"""
+
+BLOCK_SIZE = 8 * 1024 * 1024  # 8MiB of FASTQ per read() call
+
+NL = 10  # b'\n'
+CR = 13  # b'\r'
+AT = 64  # b'@'
+PLUS = 43  # b'+'
+
+# offsets of a record span tuple
+REC_START, SEQ_START, SEQ_END, QUAL_START, QUAL_END, REC_END = range(6)
+
+
+def open_fastq(fn, mode='rb', compresslevel=DEFAULT_COMPRESS_LEVEL, threads=1, bgzf=False):
+    """
+    Open a FASTQ file for binary reading or writing. '-' means stdin/stdout.
+    Files ending in .gz are (de)compressed, and written on threads compression threads,
+    as BGZF with a .gzi index if bgzf is set (see block_gzip.py)
+    """
+    if fn == '-':
+        return sys.stdin.buffer if 'r' in mode else sys.stdout.buffer
+    if str(fn).lower().endswith('.gz'):
+        if 'r' in mode:
+            return gzip.open(fn, mode)
+        return BlockGzipWriter(fn, mode, compresslevel=compresslevel, threads=threads, bgzf=bgzf)
+    return open(fn, mode)
+
+
+def find_records(buf: bytes) -> tuple:
+    """
+    Locate every complete FASTQ record in buf
+
+    returns: (spans, consumed)
+    spans - list of (rec_start, seq_start, seq_end, qual_start, qual_end, rec_end) offsets,
+            where rec_end is one past the record's final newline
+    consumed - offset of the first byte not belonging to a complete record
+    Blank lines between records are skipped. Raises ValueError on malformed records
+    """
+    spans = []
+    find = buf.find
+    n = len(buf)
+    pos = 0
+    while True:
+        while pos < n and (buf[pos] == NL or buf[pos] == CR):
+            pos += 1
+        if pos >= n:
+            break
+        nl1 = find(b'\n', pos)
+        if nl1 < 0:
+            break
+        nl2 = find(b'\n', nl1 + 1)
+        if nl2 < 0:
+            break
+        nl3 = find(b'\n', nl2 + 1)
+        if nl3 < 0:
+            break
+        nl4 = find(b'\n', nl3 + 1)
+        if nl4 < 0:
+            break
+        seq_end = nl2 - 1 if buf[nl2 - 1] == CR else nl2
+        qual_end = nl4 - 1 if buf[nl4 - 1] == CR else nl4
+        if buf[pos] != AT or buf[nl2 + 1] != PLUS or seq_end - nl1 - 1 != qual_end - nl3 - 1:
+            raise ValueError(f'Malformed FASTQ record starting {bytes(buf[pos:pos+50])!r}')
+        spans.append((pos, nl1 + 1, seq_end, nl3 + 1, qual_end, nl4 + 1))
+        pos = nl4 + 1
+    return spans, pos
+
+
+def iter_record_blocks(fh, block_size=BLOCK_SIZE):
+    """
+    Yield (buf, spans) for successive blocks of complete FASTQ records from the binary
+    file handle fh. See find_records() for the layout of spans.
+    A record cut off at the end of a block is carried over to the next one
+    """
+    tail = b''
+    while True:
+        chunk = fh.read(block_size)
+        if not chunk:
+            break
+        buf = tail + chunk if tail else chunk
+        spans, consumed = find_records(buf)
+        tail = buf[consumed:]
+        if spans:
+            yield buf, spans
+    if tail.strip():
+        if not tail.endswith(b'\n'):
+            tail += b'\n'  # final record without a trailing newline
+        spans, consumed = find_records(tail)
+        if tail[consumed:].strip():
+            raise ValueError(f'Truncated FASTQ record at end of file {bytes(tail[consumed:consumed+50])!r}')
+        if spans:
+            yield tail, spans
+
+
+def write_records(fout, buf: bytes, spans: list, keep) -> int:
+    """
+    Write the records of buf flagged in keep (one bool per span) to the binary file fout.
+    Neighbouring kept records are written as one slice of buf.
+    Returns the number of records written
+    """
+    view = memoryview(buf)
+    kept = 0
+    run_start = run_end = -1
+    for span, k in zip(spans, keep):
+        if not k:
+            continue
+        kept += 1
+        if span[REC_START] == run_end:
+            run_end = span[REC_END]
+            continue
+        if run_end > 0:
+            fout.write(view[run_start:run_end])
+        run_start = span[REC_START]
+        run_end = span[REC_END]
+    if run_end > 0:
+        fout.write(view[run_start:run_end])
+    return kept
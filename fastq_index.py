@@ -0,0 +1,204 @@
+from argparse import ArgumentParser as AP
+from bisect import bisect_right
+from pathlib import Path
+import json
+import gzip
+import os
+
+from fastq_blocks import open_fastq, iter_record_blocks, REC_START, REC_END
+from block_gzip import gzi_path, read_gzi, scan_bgzf, write_gzi
+
+"""
+    Read offset index (.fqi) for BGZF FASTQs, so that one large FASTQ can be split between processes.
+
+    Every INDEX_INTERVAL reads the index records the uncompressed offset where a read starts, and
+    how many reads come before it. The BGZF block index (.gzi, see block_gzip.py) gives the block
+    holding any offset, so each of these checkpoints can be reached by seeking to that block and
+    decompressing less than one block. A file can then be cut at checkpoints into chunks of whole
+    reads which are read independently, e.g. by read_filter.py --workers.
+
+    The index is JSON: {'version', 'interval', 'reads', 'bytes', 'size', 'checkpoints'}, where
+    checkpoints is a list of [offset, reads before it], bytes is the uncompressed length of the
+    FASTQ and size its length on disk, so that an index left behind by an older file is ignored.
+    Offsets assume no blank lines between records, as everything prep writes.
+
+    Collapsing writes the index alongside BGZF output (--output_format bgzf), and
+        python fastq_index.py <fastq.gz>
+    indexes any other BGZF FASTQ, e.g. one made by bgzip.
+"""
+
+INDEX_VERSION = 1
+INDEX_INTERVAL = 1000  # reads between checkpoints, a few MB of ONT plasmid reads
+
+
+def fqi_path(fp) -> Path:
+    return Path(str(fp) + '.fqi')
+
+
+class RecordIndex:
+    """
+    Checkpoints of a FASTQ, kept up to date as blocks of records are written to it
+
+    args:
+    interval - reads between checkpoints
+    reads, offset - reads and uncompressed bytes already in the file, when adding to it
+    checkpoints - [(offset, reads before)] of the reads already in the file
+    """
+    def __init__(self, interval=INDEX_INTERVAL, reads=0, offset=0, checkpoints=None):
+        self.interval = interval
+        self.reads = reads
+        self.offset = offset
+        self.checkpoints = list(checkpoints or [])
+
+    def add(self, spans: list, keep=None):
+        """
+        Account for a block of records written by fastq_blocks.write_records(), every span unless keep is given
+        """
+        for i, span in enumerate(spans):
+            if keep is not None and not keep[i]:
+                continue
+            if self.reads % self.interval == 0:
+                self.checkpoints.append((self.offset, self.reads))
+            self.reads += 1
+            self.offset += span[REC_END] - span[REC_START]
+
+    def save(self, fp: Path):
+        """
+        Write the index of the FASTQ fp to fqi_path(fp), once fp is complete
+        """
+        ip = fqi_path(fp)
+        tmp = ip.with_name(ip.name + '.tmp')
+        with open(tmp, 'wt') as f:
+            json.dump({'version':INDEX_VERSION, 'interval':self.interval, 'reads':self.reads, 'bytes':self.offset,
+                    'size':os.path.getsize(fp), 'checkpoints':self.checkpoints}, f)
+        os.replace(tmp, ip)
+
+
+def load_index(fp: Path) -> RecordIndex|None:
+    """
+    The saved index of the FASTQ fp, or None if there isn't one or it no longer matches the file
+    """
+    ip = fqi_path(fp)
+    try:
+        with open(ip, 'rt') as f:
+            saved = json.load(f)
+        if saved.get('version') != INDEX_VERSION or saved['size'] != os.path.getsize(fp):
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return RecordIndex(saved['interval'], saved['reads'], saved['bytes'], [tuple(c) for c in saved['checkpoints']])
+
+
+def build_index(fp: Path, interval=INDEX_INTERVAL) -> RecordIndex:
+    """
+    Index an existing FASTQ by reading it through
+    """
+    index = RecordIndex(interval)
+    with open_fastq(fp, 'rb') as fin:
+        for buf, spans in iter_record_blocks(fin):
+            index.add(spans)
+    return index
+
+
+def start_index(fp: Path, append=False, interval=INDEX_INTERVAL) -> RecordIndex:
+    """
+    Index for a FASTQ about to be written, carrying on from the reads already in it when appending.
+    An index that doesn't match, e.g. after an interrupted append was trimmed off, is built again
+    """
+    if append and os.path.exists(fp) and os.path.getsize(fp):
+        return load_index(fp) or build_index(fp, interval)
+    return RecordIndex(interval)
+
+
+def load_blocks(fp: Path) -> list|None:
+    """
+    (compressed, uncompressed) offset of every block of a BGZF file, from its .gzi index, including
+    the first block. None if the file has no index
+    """
+    try:
+        return [(0, 0)] + read_gzi(gzi_path(fp))
+    except (OSError, ValueError):
+        return None
+
+
+def block_at(blocks: list, offset: int) -> tuple:
+    """
+    (compressed, uncompressed) offset of the block from load_blocks() holding an uncompressed offset
+    """
+    return blocks[bisect_right(blocks, offset, key=lambda block: block[1]) - 1]
+
+
+def chunk_bounds(index: RecordIndex, chunks: int) -> list:
+    """
+    Cut a file into at most chunks ranges of whole reads, of about the same number of bytes
+
+    returns: [(start offset, end offset, reads before start)]
+    """
+    starts = []
+    offsets = [offset for offset, reads in index.checkpoints]
+    for i in range(max(chunks, 1)):
+        target = index.offset * i / max(chunks, 1)
+        c = min(bisect_right(offsets, target), len(offsets)) - 1
+        if c >= 0 and (not starts or index.checkpoints[c][0] > starts[-1][0]):
+            starts.append(index.checkpoints[c])
+    ends = [offset for offset, reads in starts[1:]] + [index.offset]
+    return [(start, end, reads) for (start, reads), end in zip(starts, ends)]
+
+
+class RangeReader:
+    """
+    Binary reader of the uncompressed bytes from start up to end of a BGZF file, decompressing
+    from the block holding start rather than from the beginning of the file
+
+    args:
+    fp - Path of the BGZF file
+    block - (compressed, uncompressed) offset of the block holding start, from block_at()
+    start, end - uncompressed offsets
+    """
+    def __init__(self, fp: Path, block: tuple, start: int, end: int):
+        coffset, uoffset = block
+        self.raw = open(fp, 'rb')
+        self.raw.seek(coffset)
+        self.gz = gzip.GzipFile(fileobj=self.raw)
+        skip = start - uoffset
+        while skip > 0:
+            data = self.gz.read(skip)
+            if not data:
+                raise ValueError(f'{fp} ends before offset {start}')
+            skip -= len(data)
+        self.remaining = end - start
+
+    def read(self, size=-1) -> bytes:
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.gz.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.gz.close()
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = AP(description='Write the read offset index (.fqi) of a BGZF FASTQ, and its .gzi block index if missing')
+    parser.add_argument('fastq', nargs='+', help='BGZF FASTQ files e.g. from bgzip or --output_format bgzf')
+    parser.add_argument('--interval', type=int, default=INDEX_INTERVAL, help=f'Reads between checkpoints (default: {INDEX_INTERVAL})')
+    args = parser.parse_args()
+    for fp in args.fastq:
+        if load_blocks(fp) is None:
+            try:
+                entries, end = scan_bgzf(fp)
+            except ValueError as exc:
+                print(f'{exc}, only BGZF files can be indexed')
+                exit(1)
+            write_gzi(gzi_path(fp), entries)
+        index = build_index(fp, interval=args.interval)
+        index.save(fp)
+        print(f'Indexed {index.reads} reads of {fp} at {len(index.checkpoints)} checkpoints')
@@ -1,36 +1,27 @@
 import sys
 from argparse import ArgumentParser as AP
-from argparse import FileType as FT
+
+from fastq_blocks import open_fastq, iter_record_blocks, write_records, SEQ_START, SEQ_END
 
 if __name__ == "__main__":
-    
+
     parser = AP(description="max sequence length checker")
     parser.add_argument('max_length', type=int, help="Maximum allowed sequence length")
-    parser.add_argument('input', nargs='?', type=FT('r'), default=sys.stdin,
-        help="Input file (default: stdin)")
+    parser.add_argument('input', nargs='?', default='-',
+        help="Input FASTQ file, may be gzipped (default: stdin)")
     args = parser.parse_args()
 
-    # Read and process the input
-    record = []
-    bad_record = False
-    for i, line in enumerate(sys.stdin):
-        if i % 4 == 0:
-            if record:
-                if not bad_record:
-                    for l in record:
-                        print(l)
-                else:
-                    bad_record = False
-            record = [line.strip()]
-        elif i % 4 == 1:  # sequence line in FASTQ format
-            sequence = line.strip()
-            if len(sequence) > args.max_length:
-                bad_record = True
-            else:
-                record.append(sequence)
-        else:
-            record.append(line.strip())
-    if record:
-        if not bad_record:
-            for l in record:
-                print(l)
+    # Read and process the input a block of records at a time, writing kept records straight through
+    fin = open_fastq(args.input, 'rb')
+    fout = sys.stdout.buffer
+    kept = 0
+    dropped = 0
+    for buf, spans in iter_record_blocks(fin):
+        keep = [span[SEQ_END] - span[SEQ_START] <= args.max_length for span in spans]
+        n = write_records(fout, buf, spans, keep)
+        kept += n
+        dropped += len(spans) - n
+    fout.flush()
+    if fin is not sys.stdin.buffer:
+        fin.close()
+    print(f'max_length.py: kept {kept} records, dropped {dropped} records longer than {args.max_length}', file=sys.stderr)
@@ -0,0 +1,189 @@
+from pathlib import Path
+import math
+
+"""
+    PBS resource planning for the Gadi client jobs written by plasmid_prep_gadi.py.
+
+    Each client's needs are estimated from its staged FASTQs: a fixed start up cost for every
+    wf-clone-validation run, a cost per sample, and a cost per GB of gzipped reads (capped at the
+    --max_depth target when reads are downsampled). Memory follows the largest plasmid, as canu's
+    memory use grows with the genome size. Estimates are padded by WALLTIME_SAFETY and rounded up.
+
+    Gadi doesn't run PBS job arrays, so instead of one array the small clients can be packed into
+    fewer, longer jobs (first fit decreasing on estimated walltime), each running its clients'
+    scripts one after another. This cuts the number of jobs queued and the service units that are
+    reserved but never used.
+
+    With --batch_nextflow every client runs in one larger job (batch_resources()), which pays the
+    pipeline start up once and shares the rest of the work between client sized slots of its CPUs.
+
+    The same estimates are written into the local run_<client>.sh scripts as a '# resources:' comment,
+    which run_clients.py uses to fit clients into its CPU and memory budgets.
+
+    The time constants are not measured. They are guesses scaled so that a typical client (a few samples,
+    a few hundred MB of reads) comes out at about the old fixed 4 hour walltime, which most clients fitted
+    and some outgrew. They assume:
+    - PIPELINE_OVERHEAD_S: nextflow start up with the containers already fetched (prefetch_pipeline.qsub)
+    - SAMPLE_S: canu assembly and mapping of one plasmid of up to about 20kb on PBS_NCPUS cpus
+    - GB_S: filtering and assembly time growing with the reads, at PBS_NCPUS cpus
+    Until they have been checked against the resources_used.walltime of finished jobs, Gadi prep keeps every
+    job's walltime at least --min_walltime (DEFAULT_MIN_WALLTIME_H, the old fixed 4 hours), so the estimates
+    only ever give large clients more time, never small ones less. MIN_WALLTIME_S is only the floor of the
+    estimates themselves, e.g. for ordering local clients in run_clients.py.
+"""
+
+PBS_NCPUS = 4  # cpus for each client job, shared by the pipeline's processes
+MEM_BASE_GB = 8
+MEM_STEP_GB = 4  # extra memory for every MEM_SIZE_STEP_BP of the largest plasmid
+MEM_SIZE_STEP_BP = 20000
+PIPELINE_OVERHEAD_S = 20 * 60  # nextflow and container start up, for each wf-clone-validation run
+SAMPLE_S = 5 * 60  # assembly and mapping of a sample, before its reads are counted
+GB_S = 30 * 60  # filtering, assembly and mapping time for every GB of gzipped FASTQ
+GZ_BYTES_PER_BASE = 0.9  # gzipped FASTQ bytes for each base of read sequence, for the --max_depth cap
+WALLTIME_SAFETY = 1.5
+WALLTIME_STEP_S = 15 * 60
+MIN_WALLTIME_S = 30 * 60
+DEFAULT_MIN_WALLTIME_H = 4  # the fixed walltime of every client job before they were sized
+MAX_WALLTIME_S = 48 * 3600  # longest walltime Gadi allows a small job
+DEFAULT_PACK_WALLTIME_H = 12
+SORT_MEM_MAX_MB = 768  # samtools sort's own default memory per thread
+SORT_MEM_MIN_MB = 64
+
+
+def estimate_client(client_samples: dict, client_sheet_samples: dict, pipeline_runs=1, max_depth=0) -> dict:
+    """
+    Estimate the resources one client needs
+
+    args:
+    client_samples - client_info[client], {sample: {'fastq_files':[Path,...], ...}}
+    client_sheet_samples - client_sheet[client], {sample: {'size':..., ...}}
+    pipeline_runs - number of wf-clone-validation runs in the client script (with and without references)
+    max_depth - reads are downsampled to this depth of the plasmid size, 0 for no downsampling
+
+    returns: {'samples', 'bytes', 'max_size', 'pipeline_runs', 'seconds'} where seconds is the unpadded walltime estimate
+    """
+    total_bytes = 0
+    max_size = 0
+    for sample_name, info in client_samples.items():
+        sample_bytes = sum(Path(fp).stat().st_size for fp in info['fastq_files'] if Path(fp).exists())
+        size = int(client_sheet_samples.get(sample_name, {}).get('size', '') or 0)
+        if max_depth and size:
+            sample_bytes = min(sample_bytes, int(size * max_depth * GZ_BYTES_PER_BASE))
+        total_bytes += sample_bytes
+        max_size = max(max_size, size)
+    seconds = pipeline_runs * PIPELINE_OVERHEAD_S + len(client_samples) * SAMPLE_S + total_bytes / 1e9 * GB_S
+    return {'samples':len(client_samples), 'bytes':total_bytes, 'max_size':max_size, 'pipeline_runs':pipeline_runs,
+            'seconds':seconds}
+
+
+def job_walltime(seconds: float, min_walltime_s=MIN_WALLTIME_S) -> int:
+    """
+    Padded walltime in seconds for an estimate, rounded up to WALLTIME_STEP_S and kept between
+    min_walltime_s and the Gadi limit
+    """
+    padded = math.ceil(seconds * WALLTIME_SAFETY / WALLTIME_STEP_S) * WALLTIME_STEP_S
+    return min(max(padded, min_walltime_s), MAX_WALLTIME_S)
+
+
+def job_mem_gb(max_size: int) -> int:
+    """
+    Memory in GB for a job whose largest plasmid is max_size
+    """
+    return MEM_BASE_GB + MEM_STEP_GB * math.ceil(max(max_size, 1) / MEM_SIZE_STEP_BP)
+
+
+def format_walltime(seconds: int) -> str:
+    return f'{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+
+def parse_resources(resources: str) -> dict:
+    """
+    Read a resource string from pbs_resources() back into {'mem_gb', 'ncpus', 'seconds'}.
+    Anything missing or unreadable gets the default of a client job
+    """
+    parsed = {'mem_gb':job_mem_gb(0), 'ncpus':PBS_NCPUS, 'seconds':MIN_WALLTIME_S}
+    for item in resources.split(','):
+        key, _, value = item.strip().partition('=')
+        try:
+            if key == 'mem' and value.upper().endswith('GB'):
+                parsed['mem_gb'] = int(value[:-2])
+            elif key == 'ncpus':
+                parsed['ncpus'] = int(value)
+            elif key == 'walltime':
+                h, m, s = value.split(':')
+                parsed['seconds'] = int(h) * 3600 + int(m) * 60 + int(s)
+        except ValueError:
+            continue
+    return parsed
+
+
+def sort_mem_per_thread(resources: str) -> str:
+    """
+    samtools sort -m setting for a client job, so that every CPU sorting at once uses at most half of its memory
+    """
+    parsed = parse_resources(resources)
+    mem_mb = parsed['mem_gb'] * 1024 // (2 * parsed['ncpus'])
+    return f'{min(max(mem_mb, SORT_MEM_MIN_MB), SORT_MEM_MAX_MB)}M'
+
+
+def pbs_resources(estimates: list, min_walltime_s=MIN_WALLTIME_S) -> str:
+    """
+    PBS -l resource string for a job running the clients of estimates one after another,
+    asking for at least min_walltime_s e.g. mem=12GB,ncpus=4,walltime=4:00:00
+    """
+    seconds = sum(est['seconds'] for est in estimates)
+    mem_gb = job_mem_gb(max(est['max_size'] for est in estimates))
+    return f'mem={mem_gb}GB,ncpus={PBS_NCPUS},walltime={format_walltime(job_walltime(seconds, min_walltime_s))}'
+
+
+def batch_resources(estimates: list, ncpus: int, min_walltime_s=MIN_WALLTIME_S) -> str:
+    """
+    PBS -l resource string for a single job running every client through one pipeline run.
+    The pipeline start up is paid once, and the rest of the clients' work is shared between
+    ncpus // PBS_NCPUS slots, each with the memory of a client job. The job asks for at least min_walltime_s
+    """
+    slots = max(ncpus // PBS_NCPUS, 1)
+    work = sum(est['seconds'] - est['pipeline_runs'] * PIPELINE_OVERHEAD_S for est in estimates)
+    seconds = PIPELINE_OVERHEAD_S + work / slots
+    mem_gb = job_mem_gb(max(est['max_size'] for est in estimates)) * slots
+    return f'mem={mem_gb}GB,ncpus={ncpus},walltime={format_walltime(job_walltime(seconds, min_walltime_s))}'
+
+
+def pack_clients(estimates: dict, max_walltime_s: int, min_walltime_s=MIN_WALLTIME_S) -> list:
+    """
+    Pack clients into as few jobs as possible, first fit decreasing by estimated time
+
+    args:
+    estimates - {client: estimate from estimate_client()}
+    max_walltime_s - int, longest padded walltime a packed job may ask for
+    min_walltime_s - int, shortest walltime any job asks for
+
+    returns: list of jobs, each a list of client names in the order they should run
+    """
+    packs = []  # [unpadded seconds, [clients]]
+    for client in sorted(estimates, key=lambda c: (-estimates[c]['seconds'], c)):
+        seconds = estimates[client]['seconds']
+        for pack in packs:
+            if job_walltime(pack[0] + seconds, min_walltime_s) <= max_walltime_s:
+                pack[0] += seconds
+                pack[1].append(client)
+                break
+        else:
+            # a client too big for any job still gets one of its own
+            packs.append([seconds, [client]])
+    return [pack[1] for pack in packs]
+
+
+def format_plan(estimates: dict, jobs: list, min_walltime_s=MIN_WALLTIME_S) -> str:
+    """
+    Table of the planned jobs, their clients and resources, for printing
+    """
+    lines = []
+    for i, clients in enumerate(jobs):
+        ests = [estimates[c] for c in clients]
+        lines.append(f'job {i + 1}: {pbs_resources(ests, min_walltime_s)} for {len(clients)} clients, '+\
+                f'{sum(e["samples"] for e in ests)} samples, {sum(e["bytes"] for e in ests) / 1e9:.2f} GB')
+        for client, est in zip(clients, ests):
+            lines.append(f'    {client}: {est["samples"]} samples, {est["bytes"] / 1e9:.2f} GB, '+\
+                    f'largest plasmid {est["max_size"]}bp, about {format_walltime(int(est["seconds"]))}')
+    return '\n'.join(lines)
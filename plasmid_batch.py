@@ -0,0 +1,151 @@
+from argparse import ArgumentParser as AP
+from pathlib import Path
+from shutil import copy2, copytree, rmtree
+import json
+import os
+
+"""
+    Batched assembly: a single wf-clone-validation run for every client in a plasmid directory,
+    instead of one or two runs per client, each paying for Nextflow and container start up.
+
+    build_batch() lays out plasmid_dir/batch/ at prep time:
+        fastq/barcodeNN - a symlink to each client sample directory, numbered across the whole run
+        batch_sample_sheet.csv - one sample sheet for all of them, full_reference left blank where there is none
+        batch_samples.json - which client and alias each batch sample belongs to
+    Aliases are prefixed with their client (<client>__<alias>), as the same alias may be used by
+    more than one client.
+
+    Once the pipeline has finished, split_outputs() (python plasmid_batch.py <plasmid_dir>) copies
+    each sample's outputs from batch/output/ back to <client>/output/ under its own alias, and splits
+    the rows of per-sample tables such as sample_status.txt between the clients. Reports covering
+    the whole run are left in batch/output/, as they show every client's samples.
+"""
+
+BATCH_DIR_NAME = 'batch'
+BATCH_SHEET_NAME = 'batch_sample_sheet.csv'
+BATCH_SAMPLES_NAME = 'batch_samples.json'
+ALIAS_SEPARATOR = '__'
+TABLE_SUFFIXES = ('.txt', '.tsv', '.csv')
+
+
+def batch_alias(client: str, alias: str) -> str:
+    return f'{client}{ALIAS_SEPARATOR}{alias}'
+
+
+def build_batch(plasmid_dir: Path, client_info: dict, client_sheet: dict) -> Path:
+    """
+    Lay out the batch directory for a single pipeline run over every client
+
+    args:
+    plasmid_dir - Path to the plasmid directory
+    client_info - dictionary of clients and samples, as built by prep
+    client_sheet - user provided client/sample info (client,alias,barcode,size,reference)
+
+    returns: Path of the combined sample sheet
+    """
+    batch_dir = Path(plasmid_dir)/BATCH_DIR_NAME
+    fastq_dir = batch_dir/'fastq'
+    if fastq_dir.exists():
+        rmtree(fastq_dir)  # only holds symlinks, the reads themselves are untouched
+    fastq_dir.mkdir(parents=True)
+    samples = []
+    sheet_path = batch_dir/BATCH_SHEET_NAME
+    with open(sheet_path, 'wt') as fout:
+        print(','.join(['alias','barcode','type','approx_size','full_reference']), file=fout)
+        for client in client_info:
+            for sample_name in client_info[client]:
+                barcode = f'barcode{len(samples) + 1:02d}'
+                alias = client_sheet[client][sample_name]['alias']
+                size = client_sheet[client][sample_name].get('size','')
+                reference = str(client_info[client][sample_name].get('reference',''))
+                os.symlink(Path('..')/'..'/client/sample_name, fastq_dir/barcode)
+                print(','.join([batch_alias(client, alias), barcode, 'test_sample', size, reference]), file=fout)
+                samples.append({'client':client, 'sample':sample_name, 'alias':alias, 'barcode':barcode,
+                        'batch_alias':batch_alias(client, alias)})
+    with open(batch_dir/BATCH_SAMPLES_NAME, 'wt') as f:
+        json.dump(samples, f, indent=1)
+    return sheet_path
+
+
+def match_sample(name: str, samples: list) -> dict|None:
+    """
+    The batch sample an output file or directory name belongs to, if any.
+    samples must be sorted longest batch alias first, so that an alias which starts
+    with another alias is matched to the right sample
+    """
+    for sample in samples:
+        ba = sample['batch_alias']
+        if name == ba or (name.startswith(ba) and name[len(ba)] in '._-'):
+            return sample
+    return None
+
+
+def split_table(fp: Path, samples: list, plasmid_dir: Path) -> int:
+    """
+    Split a table whose rows start with a batch alias between the clients, writing each
+    client's rows (with the aliases restored) to a table of the same name in <client>/output.
+    Returns the number of clients written to, 0 if this isn't a per-sample table
+    """
+    with open(fp, 'rt') as f:
+        lines = f.read().splitlines()
+    if len(lines) < 2:
+        return 0
+    sep = '\t' if '\t' in lines[0] else ','
+    by_alias = {sample['batch_alias']:sample for sample in samples}
+    client_rows = {}
+    for line in lines[1:]:
+        sample = by_alias.get(line.split(sep, 1)[0])
+        if sample:
+            client_rows.setdefault(sample['client'], []).append(line.replace(sample['batch_alias'], sample['alias']))
+    for client, rows in client_rows.items():
+        out_dir = Path(plasmid_dir)/client/'output'
+        out_dir.mkdir(parents=True, exist_ok=True)
+        with open(out_dir/fp.name, 'wt') as fout:
+            print('\n'.join([lines[0]] + rows), file=fout)
+    return len(client_rows)
+
+
+def split_outputs(plasmid_dir: Path, verbose=False) -> dict:
+    """
+    Copy the outputs of a batched pipeline run back to each client's output directory
+
+    args:
+    plasmid_dir - Path to the plasmid directory
+    verbose - bool, report every file copied
+
+    returns: {'samples':files and directories copied, 'tables':tables split, 'left':run level outputs left in batch/output}
+    """
+    batch_dir = Path(plasmid_dir)/BATCH_DIR_NAME
+    with open(batch_dir/BATCH_SAMPLES_NAME, 'rt') as f:
+        samples = sorted(json.load(f), key=lambda s: -len(s['batch_alias']))
+    counts = {'samples':0, 'tables':0, 'left':0}
+    for entry in sorted((batch_dir/'output').iterdir()):
+        sample = match_sample(entry.name, samples)
+        if sample:
+            dest = Path(plasmid_dir)/sample['client']/'output'/(sample['alias'] + entry.name[len(sample['batch_alias']):])
+            dest.parent.mkdir(parents=True, exist_ok=True)
+            if entry.is_dir():
+                copytree(entry, dest, dirs_exist_ok=True)
+            else:
+                copy2(entry, dest)
+            counts['samples'] += 1
+            if verbose:
+                print(f'Copied {entry} to {dest}')
+        elif entry.is_file() and entry.suffix in TABLE_SUFFIXES and split_table(entry, samples, plasmid_dir):
+            counts['tables'] += 1
+        else:
+            counts['left'] += 1
+    return counts
+
+
+if __name__ == '__main__':
+    parser = AP(description='Copy the outputs of a batched wf-clone-validation run back to each client')
+    parser.add_argument('plasmid_dir', help='Plasmid directory written by prep with --batch_nextflow')
+    parser.add_argument('-v', '--verbose', action='store_true', help='More output')
+    args = parser.parse_args()
+    if not (Path(args.plasmid_dir)/BATCH_DIR_NAME/'output').exists():
+        print(f'No batch pipeline output found in {Path(args.plasmid_dir)/BATCH_DIR_NAME/"output"}')
+        exit(1)
+    counts = split_outputs(args.plasmid_dir, verbose=args.verbose)
+    print(f"Copied {counts['samples']} sample outputs and split {counts['tables']} tables between the clients, "+\
+            f"{counts['left']} run level outputs left in {Path(args.plasmid_dir)/BATCH_DIR_NAME/'output'}")
@@ -0,0 +1,494 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from pathlib import Path
+from shutil import copyfileobj
+import os
+import gzip
+import zlib
+import errno
+
+from fastq_blocks import open_fastq, iter_record_blocks, write_records
+from read_filter import filter_block, format_counts
+from block_gzip import BlockGzipWriter, default_workers, gzi_path, DEFAULT_COMPRESS_LEVEL
+from fastq_index import start_index
+from read_stats import write_barcode_stats
+from prep_events import run_measured
+from plasmid_manifest import HashingReader, HashingWriter, StreamHashes
+
+"""
+    Collapses the FASTQ chunks of each barcode into a single {barcode}.fq.gz file.
+    Shared by plasmid_prep.py and plasmid_prep_gadi.py. Barcodes are independent of
+    each other, so they can be fanned out over a pool of worker processes.
+
+    Two collapse modes are available:
+    concat - gzip members joined end to end are still a valid gzip stream, so compressed
+             chunks are copied byte for byte into the output, once zlib has checked that every
+             gzip member is complete. Only plain text chunks, or chunks that fail the check, are
+             decoded and recompressed, so a truncated chunk fails the barcode as it would in decode.
+    decode - every chunk is decompressed and recompressed line by line (the original method)
+
+    Collapsing can also filter the reads as it goes (see collapse_barcode_filtered), writing the
+    filtered FASTQ and, optionally, the unfiltered archive from a single read of the source chunks.
+    Everything that has to be compressed is written by block_gzip.BlockGzipWriter.
+    With bgzf the collapsed FASTQ is written as BGZF with a .gzi index, which means recompressing
+    every read, so concat mode decodes the chunks too. An unfiltered archive is left as ordinary gzip.
+    A read offset index (.fqi, see fastq_index.py) is kept alongside, so the filter scripts can split
+    a large barcode between processes.
+    Read statistics (see read_stats.py) are gathered from the same pass when asked for, and so are
+    checksums of every source chunk and output (see plasmid_manifest.StreamHashes). Checksummed
+    chunks are copied through python rather than by the kernel, so that each is only read once.
+"""
+
+COLLAPSE_MODES = ('concat', 'decode')
+COPY_BUFSIZE = 16 * 1024 * 1024  # 16MiB user-space copy buffer when the kernel can't copy for us
+GZIP_PROBE_SIZE = 64 * 1024  # compressed bytes read to check a chunk starts like FASTQ
+GZIP_CHECK_SIZE = 1024 * 1024  # compressed bytes inflated at a time to check a chunk's members are complete
+
+
+def gzip_members_complete(f) -> bool:
+    """
+    Inflate every gzip member of the binary file f with zlib alone, discarding the output.
+    Returns True only if each member runs to its end and its CRC and length trailer match
+    """
+    inflater = zlib.decompressobj(wbits=31)
+    data = b''
+    while True:
+        if not data:
+            data = f.read(GZIP_CHECK_SIZE)
+            if not data:
+                return inflater.eof
+        try:
+            while data:
+                inflater.decompress(data, GZIP_CHECK_SIZE * 4)
+                data = inflater.unconsumed_tail
+        except zlib.error:
+            return False
+        if inflater.eof:
+            data = inflater.unused_data or f.read(GZIP_CHECK_SIZE)
+            if not data:
+                return True
+            inflater = zlib.decompressobj(wbits=31)  # another member follows
+
+
+def is_concatenable_gzip(fp: Path) -> bool:
+    """
+    Structural check that a file can be copied as-is into a concatenated gzip stream.
+    The first GZIP_PROBE_SIZE bytes must hold a gzip header and content that starts like a FASTQ
+    record, then the whole file is inflated by zlib (see gzip_members_complete()), so that a
+    truncated or corrupt chunk is never copied into the output. No reads are parsed in python.
+    Returns True if the file is a complete gzip stream whose content starts like a FASTQ record
+    """
+    try:
+        if os.path.getsize(fp) < 20:  # 10 byte header + empty deflate block + 8 byte trailer
+            return False
+        with open(fp, 'rb') as f:
+            head = f.read(GZIP_PROBE_SIZE)
+            # magic, deflate compression method, and no reserved flag bits set
+            if head[:3] != b'\x1f\x8b\x08' or head[3] & 0xe0:
+                return False
+            try:
+                text = zlib.decompressobj(wbits=31).decompress(head, 1024)
+            except zlib.error:
+                return False
+            text = text.lstrip()
+            if text and not text.startswith(b'@'):
+                return False
+            f.seek(0)
+            return gzip_members_complete(f)
+    except OSError:
+        return False
+
+
+def append_file_bytes(fp: Path, fout) -> int:
+    """
+    Append the raw bytes of fp to the open binary file fout, letting the kernel do the copy
+    with copy_file_range() where possible and falling back to large buffered reads.
+    Returns the number of bytes copied
+    """
+    fout.flush()
+    size = os.path.getsize(fp)
+    copied = 0
+    with open(fp, 'rb') as fin:
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while copied < size:
+                    n = os.copy_file_range(fin.fileno(), fout.fileno(), size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError as exc:
+                if exc.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF):
+                    raise
+            # keep the Python file position in step with the bytes the kernel wrote
+            fout.seek(0, os.SEEK_END)
+        if copied < size:
+            fin.seek(copied)
+            copyfileobj(fin, fout, COPY_BUFSIZE)
+            copied = size
+    return copied
+
+
+def open_for_append(fp: Path):
+    """
+    Open fp for binary writing at its end, creating it if it doesn't exist. Unlike mode 'ab'
+    the file isn't opened O_APPEND, so append_file_bytes() can still use copy_file_range()
+    """
+    fout = open(fp, 'r+b' if Path(fp).exists() else 'wb')
+    fout.seek(0, os.SEEK_END)
+    return fout
+
+
+@contextmanager
+def open_source(fp: Path, hashes=None):
+    """
+    Open a source FASTQ for binary reading like fastq_blocks.open_fastq(), hashing its bytes as
+    stored into hashes (a StreamHashes) if given
+    """
+    if hashes is None:
+        with open_fastq(fp, 'rb') as fin:
+            yield fin
+        return
+    with open(fp, 'rb') as raw:
+        hashed = HashingReader(raw, hashes.hasher(fp))
+        if fp.name.lower().endswith('.gz'):
+            with gzip.GzipFile(fileobj=hashed) as fin:
+                yield fin
+        else:
+            yield hashed
+
+
+@contextmanager
+def open_output(fp: Path, append=False, hashes=None, compresslevel=DEFAULT_COMPRESS_LEVEL, threads=1, bgzf=False):
+    """
+    BlockGzipWriter for a collapsed output, hashing the compressed bytes into hashes if given.
+    An appended file is never hashed, as only its new end would be
+    """
+    if hashes is None or append:
+        with BlockGzipWriter(fp, 'ab' if append else 'wb', compresslevel=compresslevel, threads=threads,
+                bgzf=bgzf) as fout:
+            yield fout
+        return
+    with open(fp, 'wb') as raw, BlockGzipWriter(fileobj=HashingWriter(raw, hashes.hasher(fp)),
+            compresslevel=compresslevel, threads=threads, bgzf=bgzf, index_fp=gzi_path(fp) if bgzf else None) as fout:
+        yield fout
+
+
+def copy_records(fin, fout=None, stats=None, index=None):
+    """
+    Copy every FASTQ record from the binary file fin to fout, dropping blank lines between records,
+    and count them into stats (a read_stats.ReadStats) if given. With no fout the records are only counted.
+    index - optional fastq_index.RecordIndex of fout, the records written are added to it
+    """
+    for buf, spans in iter_record_blocks(fin):
+        if stats is not None:
+            stats.add_block(buf, spans)
+        if fout is not None:
+            write_records(fout, buf, spans, [True] * len(spans))
+            if index is not None:
+                index.add(spans)
+
+
+def collapse_barcode_decode(fps: list, collapse_fp: Path, append=False, compresslevel=DEFAULT_COMPRESS_LEVEL, threads=1,
+        stats=None, hashes=None, bgzf=False, verbose=False) -> Path:
+    """
+    Write every FASTQ record of the files in fps into a single gzipped FASTQ
+
+    args:
+    fps - list of source FASTQ Paths (.gz or plain text) in the order they should be written
+    collapse_fp - Path of the collapsed output file e.g. barcode01/barcode01.fq.gz
+    append - bool, add new gzip members to the end of collapse_fp instead of replacing it
+    compresslevel - int, gzip compression level
+    threads - int, number of compression threads
+    stats - optional read_stats.ReadStats to count the reads into
+    hashes - optional plasmid_manifest.StreamHashes to checksum the sources and output into
+    bgzf - bool, write BGZF with a .gzi index and a read offset index (.fqi)
+    verbose - bool, whether to display more information about the process
+
+    returns: collapse_fp
+
+    The gzip header timestamps are fixed so that the same inputs always give byte-identical output
+    """
+    index = start_index(collapse_fp, append) if bgzf else None
+    with open_output(collapse_fp, append, hashes, compresslevel=compresslevel, threads=threads, bgzf=bgzf) as fout:
+        for fp in fps:
+            if verbose:
+                print(f'Collapsing {fp} to {collapse_fp}')
+            with open_source(fp, hashes) as fin:
+                copy_records(fin, fout, stats, index)
+    if index is not None:
+        index.save(collapse_fp)
+    return collapse_fp
+
+
+def collapse_barcode_concat(fps: list, collapse_fp: Path, append=False, compresslevel=DEFAULT_COMPRESS_LEVEL, threads=1,
+        stats=None, hashes=None, verbose=False) -> Path:
+    """
+    Join the FASTQ files in fps into a single multi-member gzipped FASTQ without
+    decompressing them. Compressed chunks are copied byte for byte. Plain text chunks,
+    and chunks that fail is_concatenable_gzip(), are decoded and appended as a new
+    gzip member, exactly as collapse_barcode_decode() would write them.
+
+    args:
+    fps - list of source FASTQ Paths (.gz or plain text) in the order they should be written
+    collapse_fp - Path of the collapsed output file e.g. barcode01/barcode01.fq.gz
+    append - bool, add to the end of collapse_fp instead of replacing it
+    compresslevel, threads - compression settings for decoded chunks, see collapse_barcode_decode()
+    stats - optional read_stats.ReadStats to count the reads into. Copied chunks are then inflated
+            while they are copied, from the same read of the file, instead of being copied by the kernel
+    hashes - optional plasmid_manifest.StreamHashes to checksum the sources and output into, also from
+             the same read of each file
+    verbose - bool, whether to display more information about the process
+
+    returns: collapse_fp
+    """
+    with (open_for_append(collapse_fp) if append else open(collapse_fp, 'wb')) as raw_out:
+        fout = raw_out
+        if hashes is not None and not append:
+            fout = HashingWriter(raw_out, hashes.hasher(collapse_fp))
+        for fp in fps:
+            if fp.name.lower().endswith('.gz') and is_concatenable_gzip(fp):
+                if verbose:
+                    print(f'Concatenating {fp} to {collapse_fp}')
+                if stats is None and hashes is None:
+                    append_file_bytes(fp, fout)
+                    continue
+                with open(fp, 'rb') as raw:
+                    src = raw if hashes is None else HashingReader(raw, hashes.hasher(fp))
+                    if stats is None:
+                        copyfileobj(src, fout, COPY_BUFSIZE)
+                    else:
+                        with gzip.GzipFile(fileobj=TeeReader(src, fout)) as fin:
+                            copy_records(fin, None, stats)
+            else:
+                if verbose:
+                    print(f'Collapsing {fp} to {collapse_fp}')
+                with BlockGzipWriter(fileobj=fout, compresslevel=compresslevel, threads=threads) as member, \
+                        open_source(fp, hashes) as fin:
+                    copy_records(fin, member, stats)
+    return collapse_fp
+
+
+class TeeReader:
+    """
+    Read-only binary file wrapper that also writes every byte read into sink.
+    Lets a gzip chunk be decompressed and archived from a single read of the file
+    """
+    def __init__(self, fh, sink):
+        self.fh = fh
+        self.sink = sink
+        self.mode = 'rb'
+
+    def read(self, size=-1):
+        data = self.fh.read(size)
+        if data:
+            self.sink.write(data)
+        return data
+
+    def readable(self):
+        return True
+
+
+def collapse_barcode_filtered(fps: list, collapse_fp: Path, min_length=0, max_length=0, min_quality=0.0,
+        unfilt_fp=None, mode='concat', append=False, prior_counts=None, compresslevel=DEFAULT_COMPRESS_LEVEL,
+        threads=1, stats=None, hashes=None, bgzf=False, verbose=False) -> dict:
+    """
+    Collapse and filter in one pass. Only reads passing the length band and mean quality cutoff
+    are written to collapse_fp, so the usual per-sample filter script isn't needed afterwards.
+    A summary line is written to the log file next to collapse_fp, as the filter scripts do.
+
+    args:
+    fps - list of source FASTQ Paths (.gz or plain text) in the order they should be written
+    collapse_fp - Path of the filtered output file e.g. barcode01/barcode01.fq.gz
+    min_length, max_length, min_quality - cutoffs, see read_filter.filter_reads()
+    unfilt_fp - optional Path of an archive of every unfiltered read. In concat mode compressed
+                chunks are archived byte for byte while they are being decompressed
+    mode - collapse mode for the unfiltered archive (see COLLAPSE_MODES)
+    append - bool, add to the end of collapse_fp (and unfilt_fp) instead of replacing them
+    prior_counts - optional counts from earlier appends, so the log covers every read written
+    compresslevel, threads - compression settings, see collapse_barcode_decode()
+    stats - optional read_stats.ReadStats to count every unfiltered read into
+    hashes - optional plasmid_manifest.StreamHashes to checksum the sources and outputs into
+    bgzf - bool, write collapse_fp as BGZF with a .gzi index and a read offset index (.fqi)
+    verbose - bool, whether to display more information about the process
+
+    returns: dict of counts {'reads_in','reads_out','bases_in','bases_out'}, including prior_counts
+    """
+    counts = {'reads_in':0, 'reads_out':0, 'bases_in':0, 'bases_out':0}
+    if prior_counts:
+        counts.update(prior_counts)
+    index = start_index(collapse_fp, append) if bgzf else None
+    uout = None
+    if unfilt_fp:
+        uout = open_for_append(unfilt_fp) if append else open(unfilt_fp, 'wb')
+        if hashes is not None and not append:
+            uout = HashingWriter(uout, hashes.hasher(unfilt_fp))
+    try:
+        with open_output(collapse_fp, append, hashes, compresslevel=compresslevel, threads=threads, bgzf=bgzf) as fout:
+            for fp in fps:
+                if verbose:
+                    print(f'Collapsing and filtering {fp} to {collapse_fp}')
+                member = None
+                raw = None
+                source = None
+                if uout and mode == 'concat' and fp.name.lower().endswith('.gz') and is_concatenable_gzip(fp):
+                    raw = open(fp, 'rb')
+                    src = raw if hashes is None else HashingReader(raw, hashes.hasher(fp))
+                    fin = gzip.GzipFile(fileobj=TeeReader(src, uout))
+                else:
+                    source = open_source(fp, hashes)
+                    fin = source.__enter__()
+                    if uout:
+                        member = BlockGzipWriter(fileobj=uout, compresslevel=compresslevel, threads=threads)
+                try:
+                    for buf, spans in iter_record_blocks(fin):
+                        lengths = scores = None
+                        if stats is not None:
+                            lengths, scores = stats.add_block(buf, spans)
+                        keep, lengths = filter_block(buf, spans, min_length, max_length, min_quality, lengths, scores)
+                        counts['reads_in'] += len(spans)
+                        counts['bases_in'] += sum(lengths)
+                        counts['reads_out'] += write_records(fout, buf, spans, keep)
+                        counts['bases_out'] += sum(read_len for read_len, k in zip(lengths, keep) if k)
+                        if index is not None:
+                            index.add(spans, keep)
+                        if member:
+                            write_records(member, buf, spans, [True] * len(spans))
+                finally:
+                    if source:
+                        source.__exit__(None, None, None)
+                    else:
+                        fin.close()
+                    if raw:
+                        raw.close()
+                    if member:
+                        member.close()
+    finally:
+        if uout:
+            uout.close()
+    if index is not None:
+        index.save(collapse_fp)
+    log_fp = collapse_fp.parent / (collapse_fp.name.split('.')[0] + '.log')
+    with open(log_fp, 'wt') as flog:
+        print(format_counts(counts), file=flog)
+    return counts
+
+
+def collapse_barcode(fps: list, collapse_fp: Path, mode='concat', filt=None, append=False,
+        compresslevel=DEFAULT_COMPRESS_LEVEL, threads=1, stats=None, checksum=False, bgzf=False, verbose=False) -> tuple:
+    """
+    Collapse the FASTQ files in fps into collapse_fp using the given mode (see COLLAPSE_MODES)
+    filt - optional dict of collapse_barcode_filtered() arguments to filter while collapsing
+    append - bool, add the reads to the end of an existing collapse_fp
+    compresslevel, threads - compression settings, see collapse_barcode_decode()
+    stats - optional read_stats.ReadStats, the reads are counted into it and {barcode}_stats.json is written
+    checksum - bool, checksum every source and output as it is read or written
+    bgzf - bool, write collapse_fp as BGZF with .gzi and .fqi indexes. Concat mode decodes the chunks to do so
+    returns: (counts, stats, digests) - the filter counts if filt was given, otherwise None, stats, and
+             {str(path): blake2b checksum} of the files read and written if checksum was asked for
+    """
+    if mode not in COLLAPSE_MODES:
+        raise ValueError(f'Unknown collapse mode {mode}, expected one of {COLLAPSE_MODES}')
+    hashes = StreamHashes() if checksum else None
+    kwargs = {'append':append, 'compresslevel':compresslevel, 'threads':threads, 'stats':stats, 'hashes':hashes,
+            'verbose':verbose}
+    counts = None
+    if filt:
+        counts = collapse_barcode_filtered(fps, collapse_fp, mode=mode, bgzf=bgzf, **kwargs, **filt)
+    elif mode == 'concat' and not bgzf:
+        collapse_barcode_concat(fps, collapse_fp, **kwargs)
+    else:
+        collapse_barcode_decode(fps, collapse_fp, bgzf=bgzf, **kwargs)
+    if stats is not None:
+        write_barcode_stats(stats, collapse_fp)
+    return counts, stats, hashes.digests() if hashes else {}
+
+
+def reads_decoded(mode='concat', filter_on_collapse=False, bgzf=False) -> bool:
+    """
+    Whether collapsing decodes every read anyway, so that read statistics cost no extra pass.
+    Concat mode copies gzipped chunks by the kernel without inflating them, unless it is filtering
+    or writing BGZF, and gathering statistics would mean inflating and parsing every chunk
+    """
+    return mode != 'concat' or filter_on_collapse or bgzf
+
+
+def output_counts(collapse_fp: Path, filt=None, counts=None, stats=None) -> dict:
+    """
+    {output Path: (reads, bases)} of the FASTQs collapse_barcode() wrote, from the counts and stats it returned
+    """
+    if counts:
+        out = {collapse_fp:(counts['reads_out'], counts['bases_out'])}
+        if filt and filt.get('unfilt_fp'):
+            out[filt['unfilt_fp']] = (counts['reads_in'], counts['bases_in'])
+        return out
+    if stats is not None:
+        return {collapse_fp:(stats.reads, stats.bases)}
+    return {}
+
+
+def collapse_barcodes(jobs: list, workers=1, mode='concat', append=False, results=None,
+        compresslevel=DEFAULT_COMPRESS_LEVEL, compress_threads=0, checksum=False, bgzf=False, events=None, verbose=False) -> dict:
+    """
+    Collapse many barcodes, either one after another or spread over a process pool.
+    Every barcode is written by collapse_barcode() in both cases, so the outputs are
+    identical regardless of the number of workers.
+
+    args:
+    jobs - list of (client, barcode, fps, collapse_fp, filt, stats) tuples, filt is None or a dict and
+           stats is None or a read_stats.ReadStats (see collapse_barcode)
+    workers - int, number of worker processes. 1 or less runs in this process
+    mode - str, collapse mode, one of COLLAPSE_MODES
+    append - bool, add to the end of existing collapsed files instead of replacing them
+    results - optional dict, filled with {(client, barcode): (counts, stats, digests)} for successful jobs (see collapse_barcode)
+    compresslevel - int, gzip compression level of everything that is recompressed
+    compress_threads - int, compression threads per barcode. 0 shares out the cores left over by the
+                       worker processes, so a few large barcodes still use the whole machine
+    checksum - bool, checksum the sources and outputs while collapsing, returned in results
+    bgzf - bool, write the collapsed FASTQs as BGZF with a .gzi index
+    events - optional prep_events.EventLog, given a 'collapse' event for each barcode, measured where it ran
+    verbose - bool, whether to display more information about the process
+
+    returns: dict of failures {(client, barcode): error message}, empty if all succeeded
+    """
+    failures = {}
+    if not jobs:
+        return failures
+    threads = compress_threads
+    if threads <= 0:
+        threads = max(1, default_workers() // max(1, min(workers, len(jobs))))
+    if workers <= 1 or len(jobs) <= 1:
+        for client, barcode, fps, collapse_fp, filt, stats in jobs:
+            try:
+                result, metrics = run_measured(collapse_barcode, fps, collapse_fp, mode=mode, filt=filt, append=append,
+                        compresslevel=compresslevel, threads=threads, stats=stats, checksum=checksum, bgzf=bgzf,
+                        verbose=verbose)
+            except Exception as exc:
+                failures[(client, barcode)] = f'{type(exc).__name__}: {exc}'
+            else:
+                if events:
+                    events.event('collapse', client, barcode, files=len(fps) + 1, **metrics)
+                if results is not None:
+                    results[(client, barcode)] = result
+        return failures
+
+    workers = min(workers, len(jobs))
+    if verbose:
+        print(f'Collapsing {len(jobs)} barcodes with {workers} worker processes')
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_measured, collapse_barcode, fps, collapse_fp, mode, filt, append, compresslevel,
+                threads, stats, checksum, bgzf, verbose): (client, barcode, len(fps))
+                for client, barcode, fps, collapse_fp, filt, stats in jobs}
+        for fut in as_completed(futures):
+            client, barcode, n_files = futures[fut]
+            try:
+                result, metrics = fut.result()
+            except Exception as exc:
+                failures[(client, barcode)] = f'{type(exc).__name__}: {exc}'
+            else:
+                if events:
+                    events.event('collapse', client, barcode, files=n_files + 1, **metrics)
+                if results is not None:
+                    results[(client, barcode)] = result
+                if verbose:
+                    print(f'Finished collapsing barcode {barcode} for client {client}')
+    return failures
@@ -0,0 +1,431 @@
+from argparse import ArgumentParser as AP
+from pathlib import Path
+import os
+import json
+import hashlib
+
+from block_gzip import BlockGzipWriter, gzi_path, DEFAULT_COMPRESS_LEVEL
+
+"""
+    Staging manifest for incremental, resumable prep.
+
+    For every client/barcode the manifest records the source files it was built from
+    (path, size, mtime and an optional checksum), the parameters used to stage it, and the
+    output files that were written, with the method of any that were staged unchanged from a source
+    (copy, reflink, hardlink or symlink, see plasmid_stage.py). When prep is re-run with --resume only barcodes whose
+    sources or parameters have changed, or whose outputs have gone missing, are staged again.
+    The manifest lives in the top of the plasmid directory as staging_manifest.json
+
+    With --manifest_checksum every source and output also gets a blake2b checksum, and collapsed
+    outputs their read and base counts where collapsing counted them. The checksums are taken from
+    the bytes as they stream through collapsing (see StreamHashes), rather than by reading the files
+    again afterwards. The builtin filter engine and the downsampler do the same for the filtered
+    FASTQs, appending a record for each to filter_checksums.jsonl as they finish.
+
+    python plasmid_manifest.py <plasmid_dir> verifies a plasmid directory against these records.
+    Only files whose size or mtime has changed are read again, so checking an untouched run is quick.
+    Staged FASTQs that the filter scripts have moved to unfiltered_reads/ are checked where they now are.
+"""
+
+MANIFEST_NAME = 'staging_manifest.json'
+MANIFEST_VERSION = 1
+FILTER_CHECKSUMS_NAME = 'filter_checksums.jsonl'
+SAMPLE_SCRIPT_SUFFIXES = ('_filt.sh', '_downsample.sh', '_map.sh')  # per-sample scripts prep writes in the client directory
+HASH_BUFSIZE = 16 * 1024 * 1024
+
+
+def manifest_path(plasmid_dir: Path) -> Path:
+    return Path(plasmid_dir) / MANIFEST_NAME
+
+
+def new_manifest() -> dict:
+    return {'version':MANIFEST_VERSION, 'barcodes':{}}
+
+
+def load_manifest(plasmid_dir: Path) -> dict:
+    """
+    Read the staging manifest from plasmid_dir. Returns an empty manifest if there isn't one
+    or it was written by an incompatible version
+    """
+    mp = manifest_path(plasmid_dir)
+    empty = new_manifest()
+    if not mp.exists():
+        return empty
+    try:
+        with open(mp, 'rt') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as exc:
+        print(f'Ignoring unreadable staging manifest {mp}: {exc}')
+        return empty
+    if manifest.get('version') != MANIFEST_VERSION:
+        print(f'Ignoring staging manifest {mp} from a different version of prep')
+        return empty
+    return manifest
+
+
+def save_manifest(plasmid_dir: Path, manifest: dict):
+    """
+    Write the manifest atomically, so an interrupted prep never leaves a half written file
+    """
+    mp = manifest_path(plasmid_dir)
+    tmp = mp.with_name(mp.name + '.tmp')
+    with open(tmp, 'wt') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, mp)
+
+
+def file_checksum(fp: Path) -> str:
+    """
+    blake2b hex digest of a file's contents
+    """
+    h = hashlib.blake2b()
+    with open(fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_BUFSIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class HashingReader:
+    """
+    Read-only binary file wrapper hashing every byte read, e.g. underneath a gzip.GzipFile
+    """
+    def __init__(self, fh, hasher):
+        self.fh = fh
+        self.hasher = hasher
+        self.mode = 'rb'
+
+    def read(self, size=-1):
+        data = self.fh.read(size)
+        self.hasher.update(data)
+        return data
+
+    def readable(self):
+        return True
+
+
+class HashingWriter:
+    """
+    Write-only binary file wrapper hashing every byte written, e.g. underneath a block_gzip.BlockGzipWriter
+    """
+    def __init__(self, fh, hasher):
+        self.fh = fh
+        self.hasher = hasher
+        self.mode = 'wb'
+
+    def write(self, data) -> int:
+        self.hasher.update(data)
+        return self.fh.write(data)
+
+    def flush(self):
+        self.fh.flush()
+
+    def writable(self):
+        return True
+
+    def close(self):
+        self.fh.close()
+
+
+class StreamHashes:
+    """
+    blake2b hashes of the files a collapse reads and writes, updated as the bytes go past
+    """
+    def __init__(self):
+        self.hashers = {}
+
+    def hasher(self, fp: Path):
+        self.hashers[str(fp)] = hashlib.blake2b()
+        return self.hashers[str(fp)]
+
+    def digests(self) -> dict:
+        """
+        {str(path): hex digest} of every file hashed
+        """
+        return {path:h.hexdigest() for path, h in self.hashers.items()}
+
+
+def file_record(fp: Path, checksum=False, rel_to=None, digest=None) -> dict:
+    """
+    Describe a file by path, size and mtime (and blake2b checksum if asked).
+    Paths under rel_to are stored relative to it.
+    digest - the file's blake2b checksum if it is already known, e.g. from a StreamHashes
+    """
+    st = os.stat(fp)
+    path = Path(fp)
+    if rel_to is not None:
+        path = path.relative_to(rel_to)
+    rec = {'path':str(path), 'size':st.st_size, 'mtime_ns':st.st_mtime_ns}
+    if checksum:
+        rec['blake2b'] = digest or file_checksum(fp)
+    return rec
+
+
+def open_checksummed(fn, compresslevel=DEFAULT_COMPRESS_LEVEL, threads=1, bgzf=False) -> tuple:
+    """
+    Open a FASTQ for binary writing like fastq_blocks.open_fastq(), hashing the bytes as stored
+
+    returns: (fout, hasher) - take hasher.hexdigest() once fout is closed
+    """
+    hasher = hashlib.blake2b()
+    raw = HashingWriter(open(fn, 'wb'), hasher)
+    if str(fn).lower().endswith('.gz'):
+        fout = BlockGzipWriter(fileobj=raw, compresslevel=compresslevel, threads=threads, bgzf=bgzf,
+                index_fp=gzi_path(fn) if bgzf else None)
+        fout.owns_file = True  # close the file underneath along with it
+        return fout, hasher
+    return raw, hasher
+
+
+def record_checksum(checksums_fp: Path, fp: Path, digest: str, reads: int, bases: int):
+    """
+    Append a filtered FASTQ's record to a filter checksums file (see FILTER_CHECKSUMS_NAME).
+    The line is written in one call, so filter scripts running side by side can share the file
+    """
+    rec = file_record(fp, checksum=True, digest=digest)
+    rec['reads'], rec['bases'] = reads, bases
+    with open(checksums_fp, 'at') as f:
+        f.write(json.dumps(rec) + '\n')
+
+
+def source_unchanged(old: dict, new: dict, fp: Path) -> bool:
+    """
+    A source file is unchanged if its size matches and either its mtime matches, or a checksum
+    was recorded and the contents still hash the same (e.g. the run was copied again)
+    """
+    if old['path'] != new['path'] or old['size'] != new['size']:
+        return False
+    if old['mtime_ns'] == new['mtime_ns']:
+        return True
+    if 'blake2b' in old:
+        return old['blake2b'] == new.get('blake2b') or old['blake2b'] == file_checksum(fp)
+    return False
+
+
+def moved_outputs(plasmid_dir: Path, rel_path: str, prefilter_prefix='unfilt_') -> list:
+    """
+    Paths a filter script moves a staged output (or its index) to, before writing the filtered
+    reads in its place: client/unfiltered_reads/full_<name> when downsampling reads filtered while
+    collapsing, otherwise client/unfiltered_reads/<prefilter_prefix><name>
+    """
+    unfilt_dp = Path(plasmid_dir) / Path(rel_path).parts[0] / 'unfiltered_reads'
+    name = Path(rel_path).name
+    return [unfilt_dp / ('full_' + name), unfilt_dp / (prefilter_prefix + name)]
+
+
+def output_unchanged(rec: dict, plasmid_dir: Path, prefilter_prefix='unfilt_') -> bool:
+    """
+    An output is unchanged if it still exists with the size and mtime prep left it with, or a filter
+    script has moved it to unfiltered_reads/ unchanged (mv keeps the mtime). A filter log written by
+    collapsing only has to be no shorter, as the downsample scripts append to it
+    """
+    def matches(fp):
+        try:
+            st = os.stat(fp)
+        except OSError:
+            return False
+        if fp.suffix == '.log':
+            return st.st_size >= rec['size']
+        return st.st_size == rec['size'] and st.st_mtime_ns == rec['mtime_ns']
+
+    return any(matches(fp) for fp in [Path(plasmid_dir) / rec['path']] + moved_outputs(plasmid_dir, rec['path'], prefilter_prefix))
+
+
+def barcode_up_to_date(entry: dict|None, sources: list, params: dict, plasmid_dir: Path, prefilter_prefix='unfilt_') -> bool:
+    """
+    True if the manifest entry for a barcode was built from the same sources with the same
+    parameters, and all of its outputs are still in place
+
+    args:
+    entry - manifest entry for the barcode, or None if it has never been staged
+    sources - list of source Paths that would be staged now
+    params - dict of staging parameters that would be used now
+    plasmid_dir - Path of the plasmid directory the outputs are relative to
+    prefilter_prefix - prefix the filter scripts give the staged FASTQs they move to unfiltered_reads/
+    """
+    if not entry or entry.get('params') != params:
+        return False
+    old_sources = {rec['path']:rec for rec in entry.get('sources', [])}
+    if set(old_sources) != set(str(fp) for fp in sources):
+        return False
+    for fp in sources:
+        try:
+            new = file_record(fp)
+        except OSError:
+            return False
+        if not source_unchanged(old_sources[str(fp)], new, fp):
+            return False
+    return all(output_unchanged(rec, plasmid_dir, prefilter_prefix) for rec in entry.get('outputs', []))
+
+
+def barcode_entry(sources: list, outputs: list, params: dict, plasmid_dir: Path, checksum=False, methods=None,
+        digests=None, counts=None, staged_from=None) -> dict:
+    """
+    Build the manifest entry for a freshly staged barcode
+    sources - list of source Paths, outputs - list of output Paths under plasmid_dir
+    checksum - bool, record the checksum of every source and output
+    methods - {output Path: staging method} for the outputs staged unchanged from a source
+    digests - {str(path): checksum} already taken while streaming, anything else is read to checksum it
+    counts - {output Path: (reads, bases)} where they were counted
+    staged_from - {output Path: source Path} for outputs that are unchanged copies of a source, and share its checksum
+    """
+    digests = dict(digests or {})
+    source_records = []
+    for fp in sources:
+        rec = file_record(fp, checksum=checksum, digest=digests.get(str(fp)))
+        if checksum:
+            digests[str(fp)] = rec['blake2b']
+        source_records.append(rec)
+    output_records = []
+    for fp in outputs:
+        if Path(fp).exists():
+            digest = digests.get(str(fp))
+            if staged_from and Path(fp) in staged_from:
+                digest = digests.get(str(staged_from[Path(fp)]))
+            rec = file_record(fp, checksum=checksum, rel_to=plasmid_dir, digest=digest)
+            if methods and Path(fp) in methods:
+                rec['method'] = methods[Path(fp)]
+            if counts and Path(fp) in counts:
+                rec['reads'], rec['bases'] = counts[Path(fp)]
+            output_records.append(rec)
+    return {
+        'params':params,
+        'sources':source_records,
+        'outputs':output_records,
+    }
+
+
+def remove_outputs(entry: dict, plasmid_dir: Path, prefilter_prefix='', verbose=False):
+    """
+    Delete the outputs recorded in a manifest entry. Only files prep wrote are ever removed, and
+    linked outputs (hardlink or symlink) are only unlinked, leaving the source data they share in place.
+    With prefilter_prefix, copies of the outputs that a filter or downsample script has already moved
+    to client/unfiltered_reads/ are removed too, otherwise the script would keep the old reads
+    """
+    for rec in entry.get('outputs', []):
+        fps = [Path(plasmid_dir) / rec['path']]
+        if prefilter_prefix:
+            fps.extend(moved_outputs(plasmid_dir, rec['path'], prefilter_prefix))
+        for fp in fps:
+            if fp.is_file() or fp.is_symlink():
+                if verbose:
+                    print(f'Removing out of date {fp}')
+                fp.unlink()
+
+
+def remove_sample_scripts(plasmid_dir: Path, key: str, verbose=False):
+    """
+    Delete the filter, downsample and map scripts prep wrote for the barcode of a manifest key
+    (client/barcode), once the barcode has left that client, so they can't be run on reads that are gone
+    """
+    client, barcode = key.split('/')
+    for suffix in SAMPLE_SCRIPT_SUFFIXES:
+        fp = Path(plasmid_dir) / client / (barcode + suffix)
+        if fp.is_file():
+            if verbose:
+                print(f'Removing out of date {fp}')
+            fp.unlink()
+
+
+def load_filter_checksums(plasmid_dir: Path) -> dict:
+    """
+    {path relative to plasmid_dir: record} of the latest record of each filtered FASTQ in FILTER_CHECKSUMS_NAME
+    """
+    records = {}
+    fp = Path(plasmid_dir) / FILTER_CHECKSUMS_NAME
+    if fp.exists():
+        with open(fp, 'rt') as f:
+            for line in f:
+                if line.strip():
+                    rec = json.loads(line)
+                    records[rec['path']] = rec
+    return records
+
+
+def check_file(fp: Path, rec: dict) -> str:
+    """
+    Compare a file with its record, reading it only if its size matches but its mtime doesn't
+
+    returns: 'ok', 'changed', 'missing', or 'unchecked' if it was touched and no checksum was recorded
+    """
+    try:
+        st = os.stat(fp)
+    except OSError:
+        return 'missing'
+    if st.st_size != rec['size']:
+        return 'changed'
+    if st.st_mtime_ns == rec['mtime_ns']:
+        return 'ok'
+    if 'blake2b' not in rec:
+        return 'unchecked'
+    return 'ok' if file_checksum(fp) == rec['blake2b'] else 'changed'
+
+
+def verify(plasmid_dir: Path, prefilter_prefix='unfilt_', sources=False, verbose=False) -> dict:
+    """
+    Check the outputs in a plasmid directory's staging manifest, and the filtered FASTQs in its
+    filter checksums, against what was recorded when they were written. A staged output that a
+    filter script has moved to unfiltered_reads/ is checked there. The filtered file left in its
+    place is unchecked, unless the filter recorded its checksum (the builtin engine and the
+    downsampler do, the external engine doesn't)
+
+    args:
+    plasmid_dir - Path of the plasmid directory
+    prefilter_prefix - prefix the filter scripts gave the staged FASTQs they moved to unfiltered_reads/
+    sources - bool, check the source files in the run directory too
+    verbose - bool, report every file rather than only the problems
+
+    returns: {status: number of files} for the statuses of check_file()
+    """
+    plasmid_dir = Path(plasmid_dir)
+    manifest = load_manifest(plasmid_dir)
+    filtered = load_filter_checksums(plasmid_dir)
+    checks = []  # (Path, record), no record for a file that can't be checked
+    refiltered = {str(Path(path).parent) for path in filtered}
+    for key, entry in manifest['barcodes'].items():
+        outputs = entry.get('outputs', [])
+        # staged files replaced by their filtered reads, moved (with their indexes) to unfiltered_reads/
+        moved = {}
+        for rec in outputs:
+            candidates = moved_outputs(plasmid_dir, rec['path'], prefilter_prefix)
+            found = [fp for fp in candidates if fp.exists()]
+            if found:
+                moved[rec['path']] = found[0]
+            elif rec['path'].removesuffix('.gzi').removesuffix('.fqi') in filtered:
+                moved[rec['path']] = candidates[-1]  # filtered, yet the original is gone
+        replaced = refiltered | {str(Path(path).parent) for path in moved}
+        for rec in outputs:
+            fp = plasmid_dir / rec['path']
+            if fp.suffix == '.log' and str(Path(rec['path']).parent) in replaced:
+                continue  # collapse's filter log, which the filter scripts append to
+            if rec['path'] not in moved:
+                checks.append((fp, rec))
+                continue
+            checks.append((moved[rec['path']], rec))
+            if rec['path'].removesuffix('.gzi').removesuffix('.fqi') not in filtered and fp.exists():
+                checks.append((fp, None))  # written by a filter that records no checksums
+        if sources:
+            checks.extend((Path(rec['path']), rec) for rec in entry.get('sources', []))
+    checks.extend((plasmid_dir / path, rec) for path, rec in filtered.items())
+    tally = {'ok':0, 'changed':0, 'missing':0, 'unchecked':0}
+    for fp, rec in checks:
+        status = check_file(fp, rec) if rec else 'unchecked'
+        tally[status] += 1
+        if verbose or status != 'ok':
+            print(f'{status}\t{fp}')
+    return tally
+
+
+if __name__ == '__main__':
+    parser = AP(description='Verify a plasmid directory against its staging manifest and filter checksums')
+    parser.add_argument('plasmid_dir', help='Plasmid directory made by prep')
+    parser.add_argument('--prefilter_prefix', default='unfilt_', help='Prefix the filter scripts gave the unfiltered FASTQs (default: unfilt_)')
+    parser.add_argument('--sources', action='store_true', help='Also check the source files in the run directory')
+    parser.add_argument('-v', '--verbose', action='store_true', help='List every file checked, not only the problems')
+    args = parser.parse_args()
+    if not manifest_path(args.plasmid_dir).exists():
+        print(f'No staging manifest in {args.plasmid_dir}')
+        exit(1)
+    tally = verify(args.plasmid_dir, prefilter_prefix=args.prefilter_prefix, sources=args.sources, verbose=args.verbose)
+    print(f'{sum(tally.values())} files checked: ' + ', '.join(f'{n} {status}' for status, n in tally.items()))
+    if tally['changed'] or tally['missing']:
+        exit(1)
@@ -2,29 +2,248 @@ from argparse import ArgumentParser as AP
 from pathlib import Path
 import os
 from datetime import datetime
-from shutil import copy2, rmtree
-import gzip
+from shutil import rmtree
+
+from plasmid_collapse import collapse_barcodes, output_counts, reads_decoded, default_workers, COLLAPSE_MODES
+from block_gzip import DEFAULT_COMPRESS_LEVEL, OUTPUT_FORMATS, gzi_path
+from fastq_index import fqi_path
+from read_filter import size_band
+from run_scan import scan_run, load_scan_index, save_scan_index, barcode_dirs, barcode_files, SCAN_THREADS
+from read_stats import ReadStats, stats_path, write_run_summary, choose_band, BAND_MODES
+from read_downsample import DEFAULT_SEED
+from pbs_plan import estimate_client, pbs_resources, sort_mem_per_thread, pack_clients, format_plan, DEFAULT_PACK_WALLTIME_H
+from pbs_plan import batch_resources, PBS_NCPUS, DEFAULT_MIN_WALLTIME_H, MAX_WALLTIME_S
+from plasmid_batch import build_batch, BATCH_DIR_NAME
+from prep_events import start_run, start_metrics, end_metrics, EventLog
+from prep_plan import plan_run, load_rates, free_space, format_run_plan, NO_GO_EXIT
+from plasmid_stage import stage_files, STAGING_STRATEGIES, STAGE_THREADS
+from plasmid_manifest import new_manifest, load_manifest, save_manifest, barcode_up_to_date, barcode_entry, remove_outputs, \
+        remove_sample_scripts, FILTER_CHECKSUMS_NAME
 
 """
     This script generates run scripts for filtering and assembling plasmid data on Gadi.
     It creates filtering scripts and client-specific run scripts for the ONT plasmid pipeline.
 """
 
-def generate_complete_run_script(top_dir_path, client_script_paths):
+GADI_PLASMID_DIR = '/g/data/vz35/plasmid_gadi'  # shared NXF_HOME, singularity caches and prefetch markers
+PREFETCH_RESOURCES = 'mem=4GB,ncpus=1,walltime=2:00:00'
+
+
+def generate_complete_run_script(top_dir_path, client_script_paths, prefetch_script_path=None, prefetch_marker=''):
     """
-    Make a top-level script that launches all client scripts via PBS
+    Make a top-level script that launches all client scripts (or packed jobs) via PBS
     top_dir_path = client_dir_path.parent
+    prefetch_script_path - if the pipeline hasn't been prefetched (no prefetch_marker), this job is
+        submitted first and the client jobs wait for it to succeed
     """
     run_path = Path(top_dir_path) / 'run_plasmids.sh'
     with open(run_path,'wt') as fout:
         print('#!/bin/bash', file=fout)
         print('', file=fout)
+        if prefetch_script_path:
+            print('# fetch the pipeline and its containers once, before any client job starts', file=fout)
+            print('DEPEND=""', file=fout)
+            print(f'if [[ ! -e {prefetch_marker} ]]; then', file=fout)
+            print(f'    PREFETCH_JOB=$(qsub ./{prefetch_script_path.name}) || exit 1', file=fout)
+            print('    DEPEND="-W depend=afterok:$PREFETCH_JOB"', file=fout)
+            print('fi', file=fout)
         for csp in client_script_paths:
-            print(f'qsub ./{csp.name}', file=fout)
+            print(f'qsub $DEPEND ./{csp.name}' if prefetch_script_path else f'qsub ./{csp.name}', file=fout)
     os.chmod(run_path, 0o755)
     print(f'Generated top-level script {run_path}')
 
 
+def print_pbs_header(fout, job_name, resources, email, queue='biodev'):
+    """
+    Write the #PBS directives shared by every Gadi job script
+    resources - PBS -l resource string e.g. mem=12GB,ncpus=4,walltime=4:00:00
+    queue - PBS queue, copyq for jobs that need internet access
+    """
+    print(f'#PBS -N {job_name}', file=fout)
+    print('#PBS -P vz35', file=fout)
+    print(f'#PBS -l {resources}', file=fout)
+    print(f'#PBS -q {queue}', file=fout)
+    print('#PBS -l storage=gdata/vz35', file=fout)
+    print('#PBS -m abe', file=fout)
+    print(f'#PBS -M {email}', file=fout)
+    print('#PBS -l wd', file=fout)
+
+
+def generate_pack_script(top_dir_path, pack_number, client_script_paths, resources, email):
+    """
+    Make a PBS job that runs several client scripts one after another, see pbs_plan.pack_clients()
+    The client scripts' own #PBS lines are ignored when they are run this way
+
+    Inputs:
+        top_dir_path - plasmid directory holding the client scripts
+        pack_number - int, numbers the job script run_pack_NN.qsub
+        client_script_paths - client run scripts in the order they are run
+        resources - PBS -l resource string for the whole job
+        email - email address for PBS notifications
+    """
+    pack_path = Path(top_dir_path) / f'run_pack_{pack_number:02d}.qsub'
+    with open(pack_path, 'wt') as fout:
+        print('#!/bin/bash', file=fout)
+        print('', file=fout)
+        print_pbs_header(fout, 'plsmd_asm', resources, email)
+        print('', file=fout)
+        for csp in client_script_paths:
+            print(f'bash ./{csp.name}', file=fout)
+    os.chmod(pack_path, 0o755)
+    return pack_path
+
+
+def print_pipeline_env(fout):
+    """
+    Write the modules and singularity/nextflow settings a Gadi job needs to run wf-clone-validation
+    """
+    singularity_tmp = f'{GADI_PLASMID_DIR}/singularity_tmp'
+    singularity_cache = f'{GADI_PLASMID_DIR}/singularity_cache'
+    print(f'module load singularity', file=fout)
+    print(f'module load nextflow/23.10.1', file=fout)
+    print(f'mkdir -p {singularity_tmp}', file=fout)
+    print(f'mkdir -p {singularity_cache}', file=fout)
+    print(f'export SINGULARITY_TMPDIR={singularity_tmp}', file=fout)
+    print(f'export SINGULARITY_CACHEDIR={singularity_cache}', file=fout)
+    print(f'export NXF_SINGULARITY_CACHEDIR=$SINGULARITY_CACHEDIR', file=fout)
+    print('export NXF_VER=23.10.1', file=fout)
+    print(f'export NXF_HOME={GADI_PLASMID_DIR}', file=fout)
+
+
+def prefetch_marker(pipeline_path, pipeline_version):
+    """
+    Path of the marker written once a pipeline version and all of its container images are in the shared caches
+    """
+    name = str(pipeline_path).strip('/').replace('/', '-')
+    return f'{GADI_PLASMID_DIR}/prefetch/{name}_{pipeline_version}.done'
+
+
+def generate_prefetch_script(top_dir_path, pipeline_path, pipeline_version, email):
+    """
+    Make a job that fills the shared nextflow and singularity caches for a pipeline version, then writes
+    its prefetch marker listing the images. Gadi compute nodes have no internet access, so this runs
+    on copyq (or on a login node, with bash), and the client jobs never pull anything themselves.
+
+    The images are resolved from the pipeline's own config for the singularity profile, and named the
+    way nextflow names them in NXF_SINGULARITY_CACHEDIR. Each is pulled to a temporary name and moved into
+    place, so nothing else ever sees a partly pulled image, and every image is checked to be readable.
+
+    Inputs:
+        top_dir_path - plasmid directory
+        pipeline_path - wf-clone-validation pipeline, as given to nextflow run
+        pipeline_version - e.g. v1.8.4
+        email - address for PBS notifications
+    """
+    prefetch_path = Path(top_dir_path)/'prefetch_pipeline.qsub'
+    marker = prefetch_marker(pipeline_path, pipeline_version)
+    with open(prefetch_path, 'wt') as fout:
+        print('#!/bin/bash', file=fout)
+        print('', file=fout)
+        print_pbs_header(fout, 'plsmd_fetch', PREFETCH_RESOURCES, email, queue='copyq')
+        print('', file=fout)
+        print('set -eo pipefail', file=fout)
+        print_pipeline_env(fout)
+        print(f'mkdir -p {Path(marker).parent}', file=fout)
+        print('', file=fout)
+        print(f'if [[ ! -d {pipeline_path} ]]; then', file=fout)
+        print(f'    nextflow pull {pipeline_path} -r {pipeline_version}', file=fout)
+        print('fi', file=fout)
+        print(f"IMAGES=$(nextflow config {pipeline_path} -profile singularity -flat | grep '\\.container = ' | sed -E \"s/.* = '(.*)'$/\\1/\" | sort -u)", file=fout)
+        print('if [[ -z "$IMAGES" ]]; then', file=fout)
+        print(f'    echo "No container images found in the config of {pipeline_path} {pipeline_version}" >&2', file=fout)
+        print('    exit 1', file=fout)
+        print('fi', file=fout)
+        print(f'rm -f {marker}.tmp', file=fout)
+        print('for IMAGE in $IMAGES; do', file=fout)
+        print('    IMAGE=${IMAGE#docker://}', file=fout)
+        print('    IMAGE_PATH=$NXF_SINGULARITY_CACHEDIR/$(echo "$IMAGE" | tr "/:" "--").img', file=fout)
+        print('    if [[ ! -s $IMAGE_PATH ]]; then', file=fout)
+        print('        singularity pull --force "$IMAGE_PATH.pulling" "docker://$IMAGE"', file=fout)
+        print('        mv "$IMAGE_PATH.pulling" "$IMAGE_PATH"', file=fout)
+        print('    fi', file=fout)
+        print('    singularity inspect "$IMAGE_PATH" > /dev/null', file=fout)
+        print(f'    echo "$IMAGE_PATH" >> {marker}.tmp', file=fout)
+        print('done', file=fout)
+        print(f'mv {marker}.tmp {marker}', file=fout)
+        print(f'echo "Prefetched {pipeline_path} {pipeline_version} and $(wc -l < {marker}) container images"', file=fout)
+    os.chmod(prefetch_path, 0o755)
+    return prefetch_path
+
+
+def print_prefetch_check(fout, pipeline_path, pipeline_version):
+    """
+    Write the check that stops a job, before it uses any of its reservation, if the pipeline
+    hasn't been prefetched or one of its images has gone from the cache. The pipeline then runs offline
+    """
+    marker = prefetch_marker(pipeline_path, pipeline_version)
+    print(f'# the pipeline and its containers are fetched by prefetch_pipeline.qsub, never by this job', file=fout)
+    print(f'if [[ ! -e {marker} ]]; then', file=fout)
+    print(f'    echo "{pipeline_path} {pipeline_version} has not been prefetched, run prefetch_pipeline.qsub first" >&2', file=fout)
+    print('    exit 1', file=fout)
+    print('fi', file=fout)
+    print('while read -r IMAGE_PATH; do', file=fout)
+    print('    if [[ ! -s $IMAGE_PATH ]]; then', file=fout)
+    print('        echo "Container image $IMAGE_PATH is missing from the cache, run prefetch_pipeline.qsub again" >&2', file=fout)
+    print('        exit 1', file=fout)
+    print('    fi', file=fout)
+    print(f'done < {marker}', file=fout)
+    print('export NXF_OFFLINE=true', file=fout)
+
+
+def generate_batch_run_script(top_dir_path, batch_sheet_path, filter_script_paths, map_script_paths,
+        pipeline_path, pipeline_version, batch_path, resources, email):
+    """
+    Make a PBS job that runs every client through a single wf-clone-validation run, see plasmid_batch.py
+    All clients are filtered first, then assembled together, then their outputs are copied back
+    to each client's output directory and mapped
+
+    Inputs:
+        top_dir_path - plasmid directory
+        batch_sheet_path - combined sample sheet from plasmid_batch.build_batch()
+        filter_script_paths - every client's per-sample filtering scripts
+        map_script_paths - every client's per-sample mapping scripts
+        pipeline_path - singularity container path
+        pipeline_version - e.g. v1.8.4
+        batch_path - path to plasmid_batch.py script
+        resources - PBS -l resource string for the job, see pbs_plan.batch_resources()
+        email - address for PBS notifications
+    """
+    batch_script_path = Path(top_dir_path)/'run_batch.qsub'
+    with open(batch_script_path, 'wt') as fout:
+        print('#!/bin/bash', file=fout)
+        print(f'', file=fout)
+        print_pbs_header(fout, 'plsmd_batch', resources, email)
+        print('', file=fout)
+        print('set -o pipefail', file=fout)
+        print_pipeline_env(fout)
+        print_prefetch_check(fout, pipeline_path, pipeline_version)
+        print(f'module load python3', file=fout)
+        print('', file=fout)
+        print(f'NCPUS=${{PBS_NCPUS:-{PBS_NCPUS}}}', file=fout)
+        print(f'# Comment any of the filtering script paths below to disable filtering prior to plasmid assembly', file=fout)
+        print_script_fanout(fout, 'FILTER', filter_script_paths, 'Filtering failed, not starting the assembly')
+        print('', file=fout)
+        print('# ONT wf-clone-validation pipeline, once for every client, with references where they were given', file=fout)
+        print(f'nextflow \\', file=fout)
+        print(f'run {pipeline_path} -r {pipeline_version} \\', file=fout)
+        print(f'  --fastq {BATCH_DIR_NAME}/fastq \\', file=fout)
+        print(f'  --out_dir {BATCH_DIR_NAME}/output \\', file=fout)
+        print(f'  --sample_sheet ./{BATCH_DIR_NAME}/{batch_sheet_path.name} \\', file=fout)
+        print(f'  --assembly_tool canu \\', file=fout)
+        print('  -qs $NCPUS \\', file=fout)
+        print(f'  -profile singularity', file=fout)
+        print(f'', file=fout)
+        print(f'# copy each sample\'s outputs back to its client\'s output directory', file=fout)
+        print(f'python3 {batch_path} . || exit 1', file=fout)
+        print(f'', file=fout)
+        print(f'# map each original FASTQ back to assembly, skipping BAMs that are already up to date', file=fout)
+        print(f'module load samtools/1.22', file=fout)
+        print(f'module load minimap2/2.24', file=fout)
+        print_script_fanout(fout, 'MAP', map_script_paths, 'Mapping failed')
+    os.chmod(batch_script_path, 0o755)
+    return batch_script_path
+
+
 def logstr_from_fastq_path(fp):
     """
     Return the str to a log file renames from the fastq path
@@ -38,29 +257,76 @@ def logstr_from_fastq_path(fp):
     return ''
 
 
-def generate_nanofilt_run_scripts(client_path, client_info, client_sheet, chopper_path, prefilter_prefix='unfilt_', min_quality=15):
+def generate_nanofilt_run_scripts(client_path, client_info, client_sheet, chopper_path, prefilter_prefix='unfilt_', min_quality=15,
+        filter_engine='external', readfilt_path='', compress_level=DEFAULT_COMPRESS_LEVEL, compress_threads=0,
+        band_mode='fixed', max_depth=0, downsample_path='', downsample_seed=DEFAULT_SEED, checksums=False, bgzf=False):
     """
     client_path - Path to client directory
     client_info - client_info dictionary
     client_sheet - user provided client/sample info (client,alias,barcode,size,reference)
     chopper_path - path to Chopper e.g. $PIPEDIR/bin/chopper-linux-musl
     prefilter_prefix - rename all fastq files with this prior to filtering
+    filter_engine - 'external' pipes reads through gunzip/Chopper/gzip, 'builtin' uses read_filter.py in a single pass
+    readfilt_path - path to read_filter.py script, used by the builtin filter engine
+    compress_level - gzip compression level of the filtered FASTQs
+    compress_threads - threads read_filter.py compresses with, 0 for all available cores.
+            The client script overrides this with its share of the CPUs, FILTER_THREADS
+    band_mode - 'fixed' or 'adaptive' length band, see read_stats.choose_band()
+    max_depth - downsample the filtered reads to this depth of the plasmid size, 0 to keep them all
+    downsample_path - path to read_downsample.py script
+    downsample_seed - random seed for downsampling
+    checksums - bool, the builtin engine and the downsampler record each filtered FASTQ in FILTER_CHECKSUMS_NAME
+    bgzf - bool, the collapsed FASTQs are BGZF. Their .gzi and .fqi indexes are moved along with them, the builtin
+           engine filters each one in chunks on half of FILTER_THREADS processes, compressing on the other half,
+           and it and the downsampler write the filtered FASTQs as BGZF too
     For each sample, create a script which:
     - renames the original fastq XXX to unfilt_XXX
     - filters the unfilt_XXX file to the parameters given and outputs as /client_data/XXX (matching the expected file names)
+    - downsamples the filtered reads to max_depth, in the same pipe
     The script should be in available in the client directory to avoid sample name clashes
+    Samples that were already filtered while collapsing (prefiltered) only get a script if they are to be downsampled
     """
     filter_script_paths = []
     for sample_name in client_info[client_path.name]:
+        prefiltered = client_info[client_path.name][sample_name].get('prefiltered')
+        if prefiltered and not max_depth:
+            continue
         size = client_sheet[client_path.name][sample_name].get('size','')
         if not size:
             print(f'No size provided for sample {sample_name} in client {client_path.name}. Exiting.')
             exit(1)
-        min_size = int(size) - 2000
-        max_size = int(size) + 2000
+        # the checksum is taken by whichever program writes the filtered FASTQ, as it writes it
+        checksum_opt = f'--checksums {FILTER_CHECKSUMS_NAME} ' if checksums else ''
+        bgzf_opt = '--bgzf ' if bgzf else ''
+        # the read offset index of a BGZF FASTQ lets read_filter.py split it between processes, which
+        # share the filter's CPUs with the threads compressing its output
+        split_cpus = bgzf and filter_engine == 'builtin'
+        workers_opt = '--workers $FILTER_WORKERS ' if split_cpus else ''
+        threads_opt = '$COMPRESS_THREADS' if split_cpus else f'${{FILTER_THREADS:-{compress_threads}}}'
+        downsample_cmd = f'python3 {downsample_path} --size {size} --max_depth {max_depth:g} --seed {downsample_seed}'
+        if checksums:
+            downsample_cmd += f' --checksums {FILTER_CHECKSUMS_NAME}'
+        if bgzf:
+            downsample_cmd += ' --bgzf'
+        if prefiltered:
+            filter_script_paths.append(generate_downsample_script(client_path, client_info, sample_name, downsample_cmd,
+                    compress_level=compress_level, compress_threads=compress_threads, bgzf=bgzf))
+            continue
+        min_size, max_size, band_note = choose_band(stats_path(client_path/sample_name/f'{sample_name}.fq.gz'),
+                size, band_mode)
+        # the adaptive band is recorded at the top of each filter log, ahead of the filter's own output
+        log_redirect = '2>>' if band_mode == 'adaptive' else '2>'
         filter_script_path = client_path / (str(sample_name) + '_filt.sh')
         with open(filter_script_path, 'wt') as fout:
             print('#!/bin/bash', file=fout)
+            print('set -eo pipefail', file=fout)
+            print(f'# {band_note}', file=fout)
+            if split_cpus:
+                print(f'FILTER_CPUS=${{FILTER_THREADS:-{compress_threads}}}', file=fout)
+                print('if (( FILTER_CPUS < 1 )); then FILTER_CPUS=$(nproc); fi', file=fout)
+                print('# read_filter.py filters on half of the CPUs and the rest compress the filtered reads', file=fout)
+                print('FILTER_WORKERS=$(( (FILTER_CPUS + 1) / 2 ))', file=fout)
+                print('COMPRESS_THREADS=$(( FILTER_CPUS > FILTER_WORKERS ? FILTER_CPUS - FILTER_WORKERS : 1 ))', file=fout)
             fq_files = client_info[client_path.name][sample_name]['fastq_files']
             unfilt_path = Path(client_path.name) / 'unfiltered_reads'
             print(f'mkdir -p {unfilt_path}', file=fout)
@@ -73,19 +339,150 @@ def generate_nanofilt_run_scripts(client_path, client_info, client_sheet, choppe
                 print(f'if [[ ! -e {prefilt_path} ]]', file=fout)
                 print(f'then', file=fout)
                 print(f'    mv {filt_path} {prefilt_path}', file=fout)
+                if bgzf:
+                    for index_path in (gzi_path, fqi_path):
+                        print(f'    if [[ -e {index_path(filt_path)} ]]; then mv {index_path(filt_path)} {index_path(prefilt_path)}; fi', file=fout)
                 print(f'fi', file=fout)
+                if band_mode == 'adaptive':
+                    print(f'echo "{band_note}" > {log_path}', file=fout)
+                if filter_engine == 'builtin':
+                    # decode, filter and recompress each read in a single pass
+                    if max_depth:
+                        # filtered reads are passed uncompressed to the downsampler, which compresses them
+                        print(f'python3 {readfilt_path} --minlength {min_size} --maxlength {max_size} -q {min_quality} {workers_opt}'+\
+                                f'{prefilt_path} - {log_redirect} {log_path} | {downsample_cmd} '+\
+                                f'--compress_level {compress_level} --compress_threads {threads_opt} '+\
+                                f'- {filt_path} 2>> {log_path}', file=fout)
+                    else:
+                        print(f'python3 {readfilt_path} --minlength {min_size} --maxlength {max_size} {checksum_opt}{bgzf_opt}{workers_opt}'+\
+                                f'-q {min_quality} --compress_level {compress_level} --compress_threads {threads_opt} '+\
+                                f'{prefilt_path} {filt_path} {log_redirect} {log_path}', file=fout)
+                    continue
                 ungzipped_filt_path = str(filt_path)[:-3]
                 # trim off the .gz from the filt_path
+                downsample_pipe = f' | {downsample_cmd} - - 2>> {log_path}' if max_depth else ''
                 print(f'gunzip -c {prefilt_path} | {chopper_path} --minlength {min_size} '+\
-                        f'-q {min_quality} --maxlength {max_size} | gzip > {ungzipped_filt_path}.gz 2> {log_path}', file=fout)
+                        f'-q {min_quality} --maxlength {max_size} --threads ${{FILTER_THREADS:-4}}{downsample_pipe} | gzip -{compress_level} > {ungzipped_filt_path}.gz {log_redirect} {log_path}', file=fout)
                 
         os.chmod(filter_script_path, 0o755)
         filter_script_paths.append(filter_script_path)
     return filter_script_paths
 
 
+def generate_downsample_script(client_path, client_info, sample_name, downsample_cmd,
+        compress_level=DEFAULT_COMPRESS_LEVEL, compress_threads=0, bgzf=False):
+    """
+    Script downsampling the reads of a sample that was already filtered while collapsing.
+    The full depth reads are moved to unfiltered_reads/full_XXX, and the sample is written to
+    /client_data/XXX. The depth is appended to the log that collapse wrote
+
+    client_path - Path to client directory
+    client_info - client_info dictionary
+    sample_name - the sample (barcode) to downsample
+    downsample_cmd - read_downsample.py command line, without its input, output and compression options
+    compress_level, compress_threads - compression settings of the downsampled FASTQs
+    bgzf - bool, the FASTQs are BGZF, move their .gzi and .fqi indexes along with them
+    """
+    downsample_script_path = client_path / (str(sample_name) + '_downsample.sh')
+    with open(downsample_script_path, 'wt') as fout:
+        print('#!/bin/bash', file=fout)
+        print('set -eo pipefail', file=fout)
+        unfilt_path = Path(client_path.name) / 'unfiltered_reads'
+        print(f'mkdir -p {unfilt_path}', file=fout)
+        for fp in client_info[client_path.name][sample_name]['fastq_files']:
+            full_path = unfilt_path / ('full_' + fp.name)
+            filt_path = Path(client_path.name)/str(sample_name)/fp.name
+            log_path = logstr_from_fastq_path(filt_path)
+            if not log_path:
+                log_path = '/dev/null'
+            print(f'if [[ ! -e {full_path} ]]', file=fout)
+            print(f'then', file=fout)
+            print(f'    mv {filt_path} {full_path}', file=fout)
+            if bgzf:
+                for index_path in (gzi_path, fqi_path):
+                    print(f'    if [[ -e {index_path(filt_path)} ]]; then mv {index_path(filt_path)} {index_path(full_path)}; fi', file=fout)
+            print(f'fi', file=fout)
+            print(f'{downsample_cmd} --compress_level {compress_level} --compress_threads ${{FILTER_THREADS:-{compress_threads}}} '+\
+                    f'{full_path} {filt_path} 2>> {log_path}', file=fout)
+    os.chmod(downsample_script_path, 0o755)
+    return downsample_script_path
+
+
+def generate_map_scripts(client_path, client_info, client_sheet, minimap2_path, samtools_path, sort_mem='768M'):
+    """
+    client_path - Path to client directory
+    client_info - client_info dictionary
+    client_sheet - user provided client/sample info (client,alias,barcode,size,reference)
+    minimap2_path - path to minimap2
+    samtools_path - path to samtools
+    sort_mem - memory for each samtools sort thread e.g. 768M, see pbs_plan.sort_mem_per_thread()
+    For each sample, create a script that maps its FASTQs back to its assembly on MAP_THREADS threads,
+    then sorts (in bounded memory) and indexes the BAM. A BAM newer than both the assembly and the
+    FASTQ is left as it is, and a new BAM only replaces the old one once it is complete.
+    Samples without an assembly are reported and skipped
+    """
+    map_script_paths = []
+    for sample_name in client_info[client_path.name]:
+        alias = client_sheet[client_path.name][sample_name]['alias']
+        assembly_fp = f'{client_path.name}/output/{alias}.final.fasta'  # path to assembled plasmid
+        map_script_path = client_path / (str(sample_name) + '_map.sh')
+        with open(map_script_path, 'wt') as fout:
+            print('#!/bin/bash', file=fout)
+            print('set -eo pipefail', file=fout)
+            print('THREADS=${MAP_THREADS:-1}', file=fout)
+            print(f'if [[ ! -e {assembly_fp} ]]', file=fout)
+            print(f'then', file=fout)
+            print(f'    echo "No assembly {assembly_fp} for sample {sample_name}, nothing to map" >&2', file=fout)
+            print(f'    exit 0', file=fout)
+            print(f'fi', file=fout)
+            for fp in client_info[client_path.name][sample_name]['fastq_files']:
+                fi = Path(client_path.name)/sample_name/fp.name
+                fo = rename_fastq_to_bam(fi)
+                print(f'if [[ -e {fo}.bai && {fo} -nt {assembly_fp} && {fo} -nt {fi} ]]', file=fout)
+                print(f'then', file=fout)
+                print(f'    echo "{fo} is up to date"', file=fout)
+                print(f'else', file=fout)
+                print(f'    {minimap2_path} -t $THREADS -x map-ont -a {assembly_fp} {fi} | '+\
+                        f'{samtools_path} sort -@ $THREADS -m {sort_mem} -T {fo}.sort -O bam -o {fo}.tmp -', file=fout)
+                print(f'    rm -f {fo}.bai', file=fout)
+                print(f'    mv {fo}.tmp {fo}', file=fout)
+                print(f'    {samtools_path} index -@ $THREADS {fo}', file=fout)
+                print(f'fi', file=fout)
+        os.chmod(map_script_path, 0o755)
+        map_script_paths.append(map_script_path)
+    return map_script_paths
+
+
+def print_script_fanout(fout, stage, script_paths, failure):
+    """
+    Write the part of a client (or batch) script that runs a list of per-sample scripts, as many at once as there are CPUs.
+    Each script gets an equal share of the CPUs as {stage}_THREADS. If any of them fails the
+    script stops there, e.g. so the assembly never starts on partly filtered reads
+
+    fout - open client script, which has already set NCPUS
+    stage - FILTER or MAP, names the {stage}_SCRIPTS list and the {stage}_THREADS share
+    script_paths - the per-sample scripts, each in its client directory
+    failure - message the script gives if any of the per-sample scripts fail
+    """
+    print(f'{stage}_SCRIPTS=(', file=fout)
+    for sp in script_paths:
+        print(f'    {sp.parent.name}/{sp.name}', file=fout)
+    print(')', file=fout)
+    print(f'if (( ${{#{stage}_SCRIPTS[@]}} )); then', file=fout)
+    print(f'    {stage}_JOBS=$(( ${{#{stage}_SCRIPTS[@]}} < NCPUS ? ${{#{stage}_SCRIPTS[@]}} : NCPUS ))', file=fout)
+    print(f'    export {stage}_THREADS=$(( NCPUS / {stage}_JOBS ))', file=fout)
+    print(f'    if ! printf "%s\\n" "${{{stage}_SCRIPTS[@]}}" | xargs -P "${stage}_JOBS" -I{{}} bash {{}}; then', file=fout)
+    print(f'        echo "{failure}" >&2', file=fout)
+    print('        exit 1', file=fout)
+    print('    fi', file=fout)
+    print('fi', file=fout)
+
+
 def generate_client_run_script(client_sample_sheet_ref_path, client_sample_sheet_noref_path, client_info, client_sheet,
-        client_path, pipeline_path, pipeline_version, chopper_path, prefilter_prefix, minimap2_path, samtools_path, email):
+        client_path, pipeline_path, pipeline_version, chopper_path, prefilter_prefix, minimap2_path, samtools_path, email,
+        filter_engine='external', readfilt_path='', min_quality=15,
+        compress_level=DEFAULT_COMPRESS_LEVEL, compress_threads=0, band_mode='fixed', max_depth=0,
+        downsample_path='', downsample_seed=DEFAULT_SEED, checksums=False, bgzf=False, resources='mem=12GB,ncpus=4,walltime=4:00:00'):
     """
     Inputs:
         client_sample_sheet_path - path to client sample sheet
@@ -98,6 +495,18 @@ def generate_client_run_script(client_sample_sheet_ref_path, client_sample_sheet
         minimap2_path - using module, so just name of executable
         samtools_path - using module, so just name of executable
         email - email address for PBS notifications
+        min_quality - minimum mean read quality kept by filtering
+        filter_engine - 'external' (Chopper pipe) or 'builtin' (read_filter.py)
+        readfilt_path - path to read_filter.py script
+        compress_level - gzip compression level of the filtered FASTQs
+        compress_threads - threads read_filter.py compresses with, 0 for all available cores
+        band_mode - 'fixed' or 'adaptive' length band for filtering
+        max_depth - downsample each sample to this depth of its plasmid size after filtering, 0 for no downsampling
+        downsample_path - path to read_downsample.py script
+        downsample_seed - random seed for downsampling
+        checksums - bool, record the checksum, reads and bases of each filtered FASTQ (builtin engine and downsampling only)
+        bgzf - bool, the collapsed FASTQs are BGZF, see generate_nanofilt_run_scripts()
+        resources - PBS -l resource string for the client's job, see pbs_plan.pbs_resources()
 
     module load nextflow/23.10.1
     export NXF_VER=23.10.0
@@ -116,40 +525,40 @@ def generate_client_run_script(client_sample_sheet_ref_path, client_sample_sheet
     3) minimap2 of reads back to final assembly
     4) samtools index on the mapped BAM file
 
+    Returns:
+        client_script_path, filter_script_paths, map_script_paths
+
     """
-    filter_script_paths = generate_nanofilt_run_scripts(client_path, client_info, client_sheet, chopper_path, prefilter_prefix)
+    filter_script_paths = generate_nanofilt_run_scripts(client_path, client_info, client_sheet, chopper_path, prefilter_prefix,
+            min_quality=min_quality, filter_engine=filter_engine, readfilt_path=readfilt_path,
+            compress_level=compress_level, compress_threads=compress_threads, band_mode=band_mode,
+            max_depth=max_depth, downsample_path=downsample_path, downsample_seed=downsample_seed, checksums=checksums,
+            bgzf=bgzf)
+    map_script_paths = generate_map_scripts(client_path, client_info, client_sheet, minimap2_path, samtools_path,
+            sort_mem=sort_mem_per_thread(resources))
     client_script_path = client_path.parent/f'run_{client_path.name}.qsub'
     client_name = client_path.name
     out_dn = client_name +"/output"
     #print(f'{client_info=}')
-    singularity_tmp = '/g/data/vz35/plasmid_gadi/singularity_tmp'
-    singularity_cache = '/g/data/vz35/plasmid_gadi/singularity_cache'
     nextflow_path = 'nextflow'  # using module, so just name of executable
     with open(client_script_path, 'wt') as fout:
         print('#!/bin/bash', file=fout)
         print(f'', file=fout)
-        print('#PBS -N plsmd_asm', file=fout)
-        print('#PBS -P vz35', file=fout)
-        print('#PBS -l mem=12GB,ncpus=4,walltime=4:00:00', file=fout)
-        print('#PBS -q biodev', file=fout)
-        print('#PBS -l storage=gdata/vz35', file=fout)
-        print('#PBS -m abe', file=fout)
-        print(f'#PBS -M {email}', file=fout)
-        print('#PBS -l wd', file=fout)
+        print_pbs_header(fout, 'plsmd_asm', resources, email)
         print('', file=fout)
-        print(f'module load singularity', file=fout)
-        print(f'module load nextflow/23.10.1', file=fout)
-        print(f'mkdir -p {singularity_tmp}', file=fout)
-        print(f'mkdir -p {singularity_cache}', file=fout)
-        print(f'export SINGULARITY_TMPDIR={singularity_tmp}', file=fout)
-        print(f'export SINGULARITY_CACHEDIR={singularity_cache}', file=fout)
-        print(f'export NXF_SINGULARITY_CACHEDIR=$SINGULARITY_CACHEDIR', file=fout)
-        print('export NXF_VER=23.10.1', file=fout)
-        print('export NXF_HOME=/g/data/vz35/plasmid_gadi', file=fout)
+        print('set -o pipefail', file=fout)
+        print_pipeline_env(fout)
+        print_prefetch_check(fout, pipeline_path, pipeline_version)
+        if filter_engine == 'builtin' or max_depth:
+            print(f'module load python3', file=fout)
         print('', file=fout)
+        print('NCPUS=${PBS_NCPUS:-4}', file=fout)
         print(f'# Comment any of the filtering script paths below to disable filtering prior to plasmid assembly', file=fout)
-        for fsp in filter_script_paths:
-            print(f'{client_name}/{fsp.name}', file=fout)
+        for sample_name in client_info[client_path.name]:
+            if client_info[client_path.name][sample_name].get('prefiltered'):
+                print(f'# {sample_name} reads were filtered during prep, see {client_name}/{sample_name}/{sample_name}.log', file=fout)
+        print_script_fanout(fout, 'FILTER', filter_script_paths,
+                f'Filtering failed for client {client_name}, not starting the assembly')
         print('', file=fout)
         if client_sample_sheet_ref_path:
             print('# ONT wf-clone-validation pipeline with reference', file=fout)
@@ -171,21 +580,12 @@ def generate_client_run_script(client_sample_sheet_ref_path, client_sample_sheet
             print(f'  --assembly_tool canu \\', file=fout)
             print(f'  -profile singularity', file=fout)
             print(f'', file=fout)
-        print(f'# map each original FASTQ back to assembly', file=fout)
+        print(f'# map each original FASTQ back to assembly, skipping BAMs that are already up to date', file=fout)
         print(f'module load samtools/1.22', file=fout)
         print(f'module load minimap2/2.24', file=fout)
-        for sample_name in client_info[client_path.name]:
-            for fp in client_info[client_path.name][sample_name]['fastq_files']:
-                alias = client_sheet[client_path.name][sample_name]['alias']
-                assembly_fp = f'{client_path.name}/output/{alias}.final.fasta'  # path to assembled plasmid
-                #print(f'Found fastq {fp=}')
-                fi = Path(client_path.name)/sample_name/fp.name
-                fo = rename_fastq_to_bam(fi)
-                print(f'{minimap2_path} -x map-ont -a {assembly_fp} {fi} | {samtools_path} sort -o {fo} - ', file=fout)
-                print(f'samtools index {fo}', file=fout)
-                print(f'', file=fout)
+        print_script_fanout(fout, 'MAP', map_script_paths, f'Mapping failed for client {client_name}')
     os.chmod(client_script_path, 0o755)
-    return client_script_path
+    return client_script_path, filter_script_paths, map_script_paths
 
 
 def generate_sample_sheets(client_info: dict, client_path: Path, client_sheet: dict):
@@ -327,23 +727,7 @@ def parse_samplesheet(samplesheet: str) -> dict:
     return client_info
 
 
-# now iterate through the PromethION directory tree looking for barcodes
-def get_barcode_dirs(p: Path, all_barcodes: set, chosen_dirs: list) -> list:
-    """
-    iterate through directories finding all the barcode dirs we want
-    """
-    dirs = [x for x in p.iterdir() if x.is_dir()]
-    for d in dirs:
-        if d.name == 'fastq_pass':
-            bc_dirs = [x for x in d.iterdir() if x.is_dir() if x.name in all_barcodes]
-            if bc_dirs:
-                chosen_dirs.extend(bc_dirs)
-        else:
-            get_barcode_dirs(d, all_barcodes, chosen_dirs)
-    return chosen_dirs
-
-
-def parse_input_dirs(prom_dir: str, client_sheet: dict) -> dict:
+def parse_input_dirs(prom_dir: str, client_sheet: dict, scan_index=None, threads=SCAN_THREADS) -> tuple:
     """
     Scans a PromethION directory structure:
         Mla7_45_pool/
@@ -351,7 +735,9 @@ def parse_input_dirs(prom_dir: str, client_sheet: dict) -> dict:
                 -> fastq_pass/
                     -> barcode21/ (fastqs)
     Should be able to find everything listed in client_sheet
-    returns a dict source_dirs[client] = {barcode:path_to_barcode_dir}}
+    scan_index - optional up to date scan index from an earlier prep, otherwise the tree is walked (see run_scan.py)
+    threads - number of directories listed at once while walking
+    returns (source_dirs, scan_index), source_dirs is a dict source_dirs[client] = {barcode:path_to_barcode_dir}}
     """
     pdp = Path(prom_dir)
     if not pdp.exists():
@@ -369,8 +755,9 @@ def parse_input_dirs(prom_dir: str, client_sheet: dict) -> dict:
             source_dirs[client][barcode] = ''  # src dirname
             all_barcodes.add(barcode)
 
-    barcode_dirs = get_barcode_dirs(pdp, all_barcodes, [])
-    bcds = {bcd.name:bcd for bcd in barcode_dirs}
+    if scan_index is None:
+        scan_index = scan_run(pdp, all_barcodes, threads=threads)
+    bcds = barcode_dirs(scan_index)
     bcd_names = set(bcds.keys())
     if all_barcodes.difference(bcd_names):
         print(f"Barcodes not found {all_barcodes.difference(bcd_names)}")
@@ -383,10 +770,13 @@ def parse_input_dirs(prom_dir: str, client_sheet: dict) -> dict:
         for barcode in source_dirs[client]:
             source_dirs[client][barcode] = bcds[barcode]
 
-    return source_dirs
+    return source_dirs, scan_index
 
 
-def create_new_structure(plasmid_dir: Path, client_sheet: dict, source_dirs: dict, collapse=True, nodata=False, verbose=False) -> bool:
+def create_new_structure(plasmid_dir: Path, client_sheet: dict, source_dirs: dict, collapse=True, nodata=False, workers=1, collapse_mode='concat', 
+        filter_on_collapse=False, min_quality=15, keep_unfiltered=False, prefilter_prefix='unfilt_', 
+        resume=False, checksum=False, compress_level=DEFAULT_COMPRESS_LEVEL, compress_threads=0, scan_index=None,
+        read_stats=True, staging='copy', stage_threads=STAGE_THREADS, output_format='gzip', events=None, verbose=False) -> bool:
     """
     Create new plasmid directory tree
 
@@ -396,6 +786,24 @@ def create_new_structure(plasmid_dir: Path, client_sheet: dict, source_dirs: dic
     source_dirs - dict of provided client and barcode directories
     collapse - bool, whether to collapse FASTQs into a single file
     nodata - bool, whether to skip copying data (for testing)
+    workers - int, number of processes used to collapse barcodes in parallel
+    collapse_mode - str, 'concat' copies gzip chunks without decompressing them, 'decode' recompresses everything
+    filter_on_collapse - bool, apply the size band and quality cutoff while collapsing, so no filter script is needed
+    min_quality - int, minimum mean read quality used by filter_on_collapse
+    keep_unfiltered - bool, with filter_on_collapse also write all reads to client/unfiltered_reads/
+    prefilter_prefix - prefix for the unfiltered archive file name
+    resume - bool, only restage barcodes whose sources, parameters or outputs changed since the last prep
+    checksum - bool, record a checksum of every source and output file in the staging manifest
+    compress_level - int, gzip compression level of collapsed FASTQs that have to be recompressed
+    compress_threads - int, compression threads per barcode, 0 to share out the cores left over by the workers
+    scan_index - scan index from parse_input_dirs(), used to list the source FASTQs without touching the filesystem
+    read_stats - bool, gather read statistics for each barcode while collapsing (see read_stats.py)
+    staging - str, how FASTQs with collapse=False and references are staged: copy, reflink, hardlink, symlink or auto
+              (see plasmid_stage.py)
+    stage_threads - int, files staged at once
+    output_format - str, 'gzip' or 'bgzf' collapsed FASTQs, see block_gzip.OUTPUT_FORMATS
+    events - prep_events.EventLog, given a 'stage' event for each barcode staged, a 'collapse' event for each
+             barcode collapsed and a 'manifest' event for recording them
     verbose - bool, whether to display more information about the process
 
     returns: 
@@ -409,54 +817,137 @@ def create_new_structure(plasmid_dir: Path, client_sheet: dict, source_dirs: dic
         -> clientB/
             -> barcode03/ (fastqs)
     By default the new barcode directories contain only the collapsed FASTQ file
+    What was staged, and from which sources, is recorded in the staging manifest (see plasmid_manifest.py)
     """
     #try:
         # make directories and copy files
     if True:
         if not plasmid_dir.exists():
             plasmid_dir.mkdir()
+        if events is None:
+            events = EventLog()
+        collapse_jobs = []  # (client, barcode, source fastqs, collapsed fastq, filter, read stats)
+        manifest = load_manifest(plasmid_dir) if resume else new_manifest()
+        staged = {}  # client/barcode: (sources, outputs, params, staging methods, {output: source}) waiting to be recorded in the manifest
+        unchanged = 0
         for client in client_sheet:
             p = plasmid_dir / client
             if not p.exists():
                 p.mkdir()
             for barcode in client_sheet[client]:
+                stage_start = start_metrics()
                 bp = p/barcode
                 if not bp.exists():
                     bp.mkdir()
-                fps = [source_dirs[client][barcode]/f for f in os.listdir(source_dirs[client][barcode])]
+                if scan_index:
+                    fps = barcode_files(scan_index, source_dirs[client][barcode])
+                else:
+                    fps = [source_dirs[client][barcode]/f for f in os.listdir(source_dirs[client][barcode])]
+                ref = client_sheet[client][barcode]['ref']
+                key = f'{client}/{barcode}'
+                params = {'collapse':collapse, 'collapse_mode':collapse_mode if collapse else '', 'reference':ref,
+                        'filter':None, 'read_stats':collapse and read_stats}
+                if collapse and filter_on_collapse:
+                    params['filter'] = {'size':client_sheet[client][barcode].get('size',''), 'min_quality':min_quality,
+                            'keep_unfiltered':keep_unfiltered}
+                if staging != 'copy':
+                    params['staging'] = staging  # copies are what earlier preps made, so they still match older manifests
+                if collapse and output_format != 'gzip':
+                    params['output_format'] = output_format
+                if collapse and compress_level != DEFAULT_COMPRESS_LEVEL:
+                    params['compress_level'] = compress_level  # left out at the default, to match older manifests
+                sources = fps + ([Path(ref)] if ref else [])
+                old_entry = manifest['barcodes'].get(key)
+                if resume and barcode_up_to_date(old_entry, sources, params, plasmid_dir, prefilter_prefix):
+                    if verbose:
+                        print(f'Client {client} barcode {barcode} is unchanged since the last prep, skipping')
+                    unchanged += 1
+                    continue
+                if old_entry and not nodata:
+                    remove_outputs(old_entry, plasmid_dir, prefilter_prefix=prefilter_prefix, verbose=verbose)
+                    del manifest['barcodes'][key]
+                outputs = []
+                stage_pairs = []  # (source, destination) of files staged unchanged
                 if collapse:
                     collapse_fp = plasmid_dir/client/barcode/f'{barcode}.fq.gz'
+                    filt = None
+                    if filter_on_collapse:
+                        size = client_sheet[client][barcode].get('size','')
+                        if not size:
+                            print(f'No size provided for sample {barcode} in client {client}. Exiting.')
+                            exit(1)
+                        min_size, max_size = size_band(size)
+                        filt = {'min_length':min_size, 'max_length':max_size, 'min_quality':min_quality}
+                        if keep_unfiltered:
+                            unfilt_dp = p/'unfiltered_reads'
+                            if not unfilt_dp.exists():
+                                unfilt_dp.mkdir()
+                            filt['unfilt_fp'] = unfilt_dp/f'{prefilter_prefix}{barcode}.fq.gz'
+                            outputs.append(filt['unfilt_fp'])
+                        outputs.append(bp/f'{barcode}.log')
+                    outputs.append(collapse_fp)
+                    if output_format == 'bgzf':
+                        outputs.extend([gzi_path(collapse_fp), fqi_path(collapse_fp)])
+                    stats = None
+                    if read_stats:
+                        stats = ReadStats(client_sheet[client][barcode].get('size',''))
+                        outputs.append(stats_path(collapse_fp))
                     if not nodata:
-                        with gzip.open(collapse_fp,'wt') as fout:
-                            for fp in fps:
-                                if fp.name.lower().endswith('.gz'):
-                                    if verbose:
-                                        print(f'Collapsing {fp} to {collapse_fp}')
-                                    with gzip.open(fp, 'rt') as f:
-                                        for line in f:
-                                            if line.strip():
-                                                fout.write(line)
-                                else:
-                                    if verbose:
-                                        print(f'Collapsing {fp} to {collapse_fp}')
-                                    with open(fp, 'rt') as f:
-                                        for line in f:
-                                            if line.strip():
-                                                fout.write(line)
+                        collapse_jobs.append((client, barcode, fps, collapse_fp, filt, stats))
                 else:
-                    for fp in fps:
-                        if verbose:
-                            print(f'Copying {fp} to {plasmid_dir/client/barcode}')
-                        if not nodata:
-                            copy2(fp, plasmid_dir/client/barcode/fp.name)
+                    stage_pairs.extend((fp, bp/fp.name) for fp in fps)
                                     
-                ref = client_sheet[client][barcode]['ref']
                 if ref:
                     ref_dp = bp/'reference'
                     if not ref_dp.exists():
                         ref_dp.mkdir()
-                    if not nodata:
-                        copy2(ref, ref_dp/Path(ref).name)
+                    stage_pairs.append((Path(ref), ref_dp/Path(ref).name))
+                methods = {}
+                if not nodata:
+                    methods = stage_files(stage_pairs, strategy=staging, threads=stage_threads, verbose=verbose)
+                outputs.extend(dst for src, dst in stage_pairs)
+                staged[key] = (sources, outputs, params, methods, {dst:src for src, dst in stage_pairs})
+                events.event('stage', client, barcode, files=(0 if collapse else len(fps)) + (1 if ref else 0),
+                        **end_metrics(stage_start))
+        # barcodes are independent, so collapse them across a pool of worker processes
+        results = {}
+        failures = collapse_barcodes(collapse_jobs, workers=workers, mode=collapse_mode, results=results,
+                compresslevel=compress_level, compress_threads=compress_threads, checksum=checksum,
+                bgzf=output_format == 'bgzf', events=events, verbose=verbose)
+        for client, barcode in failures:
+            print(f'Collapse failed for client {client} barcode {barcode}: {failures[(client, barcode)]}')
+        # checksums taken and reads counted while collapsing: client/barcode: (digests, {output: (reads, bases)})
+        collapse_outputs = {}
+        for client, barcode, fps, collapse_fp, filt, stats in collapse_jobs:
+            if (client, barcode) in results:
+                counts, stats, digests = results[(client, barcode)]
+                collapse_outputs[f'{client}/{barcode}'] = (digests, output_counts(collapse_fp, filt, counts, stats))
+
+        stage_start = start_metrics()
+        if resume and not nodata:
+            print(f'{unchanged} barcodes unchanged since the last prep, {len(staged)} staged')
+            # barcodes that have left the sample sheet, e.g. moved to another client
+            for key in [k for k in manifest['barcodes'] if k.split('/')[1] not in client_sheet.get(k.split('/')[0], {})]:
+                print(f'Removing {key}, which is no longer in the sample sheet')
+                remove_outputs(manifest['barcodes'][key], plasmid_dir, prefilter_prefix=prefilter_prefix, verbose=verbose)
+                remove_sample_scripts(plasmid_dir, key, verbose=verbose)
+                for d in (plasmid_dir/key/'reference', plasmid_dir/key):
+                    if d.is_dir() and not any(d.iterdir()):
+                        d.rmdir()
+                del manifest['barcodes'][key]
+        if not nodata:
+            for key, (sources, outputs, params, methods, staged_from) in staged.items():
+                if tuple(key.split('/')) not in failures:
+                    digests, counts = collapse_outputs.get(key, ({}, {}))
+                    manifest['barcodes'][key] = barcode_entry(sources, outputs, params, plasmid_dir, checksum=checksum,
+                            methods=methods, digests=digests, counts=counts, staged_from=staged_from)
+            save_manifest(plasmid_dir, manifest)
+            summary_fp = write_run_summary(plasmid_dir, client_sheet)
+            if summary_fp:
+                print(f'Read statistics for every barcode written to {summary_fp}')
+        events.event('manifest', files=len(staged), **end_metrics(stage_start))
+        if failures:
+            return False
     # except Exception as exc:
     #     print(f'Failed to create new plasmid experiment directories {exc}')
     #     exit(3)
@@ -507,25 +998,107 @@ def main():
     parser.add_argument('-p', '--plasmid_dir', default=plasmid_dn, help='Path to output folder containing all client plasmid data')
     parser.add_argument('-v', '--verbose', action='store_true', help='Display more information about the prep process')
     parser.add_argument('-o','--overwrite', action='store_true', help='Overwrite existing plasmid directory')
+    parser.add_argument('-r','--resume', action='store_true', help='Reuse an existing plasmid directory, only restaging barcodes whose data or settings changed')
+    parser.add_argument('--manifest_checksum', action='store_true', help='Also record a checksum of every source and output '+\
+            'file in the staging manifest, taken as they are staged, and of the filtered FASTQs in filter_checksums.jsonl. '+\
+            'Check them later with python plasmid_manifest.py <plasmid_dir>')
     parser.add_argument('--chopper_path', default='/g/data/vz35/plasmid_gadi/bin/chopper-linux-musl', help='Path to chopper (filtering)')
+    parser.add_argument('--filter_engine', choices=['external','builtin'], default='external', help='external: gunzip | chopper | gzip, builtin: read_filter.py in a single pass')
+    parser.add_argument('--readfilt_path', default=str(Path(__file__).resolve().parent/'read_filter.py'), help='Path to read_filter.py script (builtin filter engine)')
     parser.add_argument('--pipeline_path', default='epi2me-labs/wf-clone-validation', help='Path to ONT wf-clone-validation pipeline')
     parser.add_argument('--pipeline_version', default='v1.8.4', help='wf-clone-validation pipeline version')
     parser.add_argument('--prefilter_prefix', default='unfilt_', help='Prefix for unfilterd FASTQs')
     parser.add_argument('--no_collapse', action='store_true', help='Disable collapsing FASTQs to a single file for each barcode')
+    parser.add_argument('--staging_strategy', choices=STAGING_STRATEGIES, default='copy', help='How FASTQs with --no_collapse '+\
+            'and references are staged. auto reflinks or hardlinks where the filesystem allows and copies otherwise (default: copy)')
+    parser.add_argument('--stage_threads', type=int, default=STAGE_THREADS, help=f'Files staged at once (default: {STAGE_THREADS})')
+    parser.add_argument('--workers', type=int, default=default_workers(), help='Number of processes used to collapse barcodes in parallel (default: all available cores)')
+    parser.add_argument('--filter_on_collapse', action='store_true', help='Filter reads by size band and quality while collapsing, instead of in the client run scripts')
+    parser.add_argument('--keep_unfiltered', action='store_true', help='With --filter_on_collapse, also keep every read in each client unfiltered_reads/ directory')
+    parser.add_argument('--min_quality', type=int, default=15, help='Minimum mean read quality kept by filtering')
+    parser.add_argument('--collapse_mode', choices=COLLAPSE_MODES, default='concat', help='concat: join gzipped FASTQs without decompressing them (fast), decode: decompress and recompress every read')
+    parser.add_argument('--no_read_stats', action='store_true', help='Skip gathering read count, length and quality statistics while collapsing')
+    parser.add_argument('--read_stats', action='store_true', help='Gather read statistics in concat mode too. They are '+\
+            'otherwise only gathered where collapsing decodes the reads anyway (decode mode, --filter_on_collapse, '+\
+            '--output_format bgzf), as every gzipped chunk has to be inflated and parsed rather than copied by the kernel')
+    parser.add_argument('--band_mode', choices=BAND_MODES, default='fixed', help='fixed: filter reads to the declared size +/- 2kb, '+\
+            'adaptive: centre the length band on the full-length read peak seen in the read stats')
+    parser.add_argument('--max_depth', type=float, default=0, help='Downsample each sample after filtering to this depth of its plasmid size, e.g. 200 (default: 0, keep every read)')
+    parser.add_argument('--downsample_seed', type=int, default=DEFAULT_SEED, help=f'Random seed for downsampling (default: {DEFAULT_SEED})')
+    parser.add_argument('--downsample_path', default=str(Path(__file__).resolve().parent/'read_downsample.py'), help='Path to read_downsample.py script')
+    parser.add_argument('--compress_level', type=int, default=DEFAULT_COMPRESS_LEVEL, choices=range(1, 10), metavar='1-9', help=f'gzip compression level of FASTQs written by prep and the filter scripts (default: {DEFAULT_COMPRESS_LEVEL})')
+    parser.add_argument('--scan_threads', type=int, default=SCAN_THREADS, help='Directories listed at once while scanning the PromethION run')
+    parser.add_argument('--rescan', action='store_true', help='With --resume, walk the PromethION run again rather than reusing the saved scan index')
+    parser.add_argument('--compress_threads', type=int, default=0, help='Threads used to compress each FASTQ (default: 0, share out all available cores)')
+    parser.add_argument('--output_format', choices=OUTPUT_FORMATS, default='gzip', help='gzip: collapsed and filtered FASTQs are '+\
+            'ordinary gzip, bgzf: blocked gzip with a .gzi index, still read by any gzip reader, that htslib tools can '+\
+            'decompress in parallel and seek into. Recompresses every read, as --collapse_mode decode does')
     parser.add_argument('--minimap2', default='minimap2', help='Path to minimap2 executable (using module, so just name of executable)')
     parser.add_argument('--samtools', default='samtools', help='Path to samtools executable (using module, so just name of executable)')
     parser.add_argument('--nodata', action='store_true', help='Run the script without creating any files, for testing purposes')
     parser.add_argument('-e','--email', required=True, help='Email address for PBS notifications')
+    parser.add_argument('--min_walltime', type=float, default=DEFAULT_MIN_WALLTIME_H, help='Shortest walltime in hours any client '+\
+            f'job asks for, however small its estimate (default: {DEFAULT_MIN_WALLTIME_H:g}, the fixed walltime jobs had before they were sized)')
+    parser.add_argument('--pack_jobs', action='store_true', help='Pack clients into fewer PBS jobs that run their scripts one after another')
+    parser.add_argument('--pack_walltime', type=float, default=DEFAULT_PACK_WALLTIME_H, help=f'With --pack_jobs, longest walltime in hours of a packed job (default: {DEFAULT_PACK_WALLTIME_H})')
+    parser.add_argument('--batch_nextflow', action='store_true', help='Assemble every client in a single wf-clone-validation run and PBS job, instead of a job per client')
+    parser.add_argument('--batch_ncpus', type=int, default=16, help='With --batch_nextflow, cpus of the single PBS job (default: 16)')
+    parser.add_argument('--plan', action='store_true', help='Only report the files, sizes and times prep expects for each barcode, '+\
+            f'and whether they fit in the free space, without writing anything. Exits with {NO_GO_EXIT} if they don\'t fit')
+    parser.add_argument('--plan_rates', help='With --plan, MB/s rates from a benchmarks/run_benchmarks.py --results file, '+\
+            'instead of the built-in figures')
+    parser.add_argument('--free_gb', type=float, help='With --plan, GB free for the plasmid directory, '+\
+            'e.g. what is left of the project quota (default: free space on its filesystem)')
+    parser.add_argument('--profile', action='store_true', help=f'Profile prep with cProfile, written to prep_profile.pstats in the plasmid directory')
+    parser.add_argument('--batch_path', default=str(Path(__file__).resolve().parent/'plasmid_batch.py'), help='Path to plasmid_batch.py script')
     
     args = parser.parse_args()
+    if not 0 < args.min_walltime <= MAX_WALLTIME_S / 3600:
+        print(f'--min_walltime must be more than 0 and at most {MAX_WALLTIME_S // 3600} hours')
+        exit(1)
+    if args.pack_jobs and args.pack_walltime < args.min_walltime:
+        print(f'--pack_walltime cannot be less than --min_walltime')
+        exit(1)
+    min_walltime_s = int(args.min_walltime * 3600)
+    if args.batch_nextflow and args.pack_jobs:
+        print(f'--batch_nextflow runs every client in one job, and cannot be used with --pack_jobs')
+        exit(1)
+    if args.no_collapse and args.filter_on_collapse:
+        print(f'--filter_on_collapse cannot be used with --no_collapse')
+        exit(1)
+    if args.band_mode == 'adaptive' and args.filter_on_collapse:
+        print(f'--band_mode adaptive cannot be used with --filter_on_collapse, the read stats are only known after collapsing')
+        exit(1)
+    if args.band_mode == 'adaptive' and (args.no_collapse or args.no_read_stats):
+        print(f'--band_mode adaptive needs read stats from collapsing, and cannot be used with --no_collapse or --no_read_stats')
+        exit(1)
+    # concat mode only counts its reads when asked to, or when an adaptive band needs them
+    read_stats = not args.no_read_stats and (args.read_stats or args.band_mode == 'adaptive' or
+            reads_decoded(args.collapse_mode, args.filter_on_collapse, args.output_format == 'bgzf'))
+    if args.max_depth < 0:
+        print(f'--max_depth must be 0 (no downsampling) or more')
+        exit(1)
 
     prom_dir = Path(args.prom_dir)
     if not prom_dir.exists():
         print(f'PromethION sequencing directory {prom_dir} does not exist')
         exit(1)
+
+    if args.plan:
+        # estimate the prep from the sample sheet and a scan of the run, without writing anything
+        client_sheet = parse_samplesheet(args.samplesheet)
+        source_dirs, scan_index = parse_input_dirs(args.prom_dir, client_sheet, threads=args.scan_threads)
+        plan = plan_run(client_sheet, source_dirs, scan_index, collapse=not args.no_collapse, workers=args.workers,
+                collapse_mode=args.collapse_mode, filter_on_collapse=args.filter_on_collapse,
+                keep_unfiltered=args.keep_unfiltered, min_quality=args.min_quality, max_depth=args.max_depth,
+                rates=load_rates(args.plan_rates))
+        free_bytes = int(args.free_gb * 1e9) if args.free_gb is not None else free_space(args.plasmid_dir)
+        plan_text, go = format_run_plan(plan, free_bytes)
+        print(plan_text)
+        exit(0 if go else NO_GO_EXIT)
     
     plasmid_dir = Path(args.plasmid_dir)
-    if plasmid_dir.exists() and not args.nodata:
+    if plasmid_dir.exists() and not args.nodata and not args.resume:
         if not args.overwrite:
             print(f'Plasmid run directory {plasmid_dir} already exists. '+\
                     f'Please delete it, choose to overwrite it, or name a different output directory')
@@ -535,27 +1108,53 @@ def main():
     try:
         plasmid_dir.mkdir()
     except FileExistsError:
-        if args.nodata:
+        if args.nodata or args.resume:
             pass
         else:
             print(f'Plasmid run directory {plasmid_dir} already exists. Please delete it or name a different output directory')
             exit(1)
 
+    # timing and throughput of every stage, see prep_events.py
+    events = start_run(plasmid_dir, profile=args.profile)
+
     # client sheet is the user input about each client and sample
     client_sheet = parse_samplesheet(args.samplesheet)
     #print(f'{client_sheet=}')
+    all_barcodes = {barcode for client in client_sheet for barcode in client_sheet[client]}
+
+    # reuse the scan of the run from the last prep, where it is still up to date
+    stage_start = start_metrics()
+    scan_index = None
+    if args.resume and not args.rescan:
+        scan_index = load_scan_index(plasmid_dir, prom_dir, all_barcodes, threads=args.scan_threads)
+        if scan_index and args.verbose:
+            print(f'Reusing the scan of {prom_dir} saved in {plasmid_dir}')
 
     # create a dictionary of provided barcode directories for each client
-    source_dirs = parse_input_dirs(args.prom_dir, client_sheet)
+    source_dirs, scan_index = parse_input_dirs(args.prom_dir, client_sheet, scan_index=scan_index, threads=args.scan_threads)
+    if not args.nodata:
+        save_scan_index(plasmid_dir, scan_index)
+
+    events.event('scan', files=sum(len(bcd.get('files', [])) for dirs in scan_index['barcodes'].values()
+            for bcd in dirs.values()), **end_metrics(stage_start))
 
     #print(f'{copy_dirs=}')
     collapse_fastqs = True
     if args.no_collapse:
         collapse_fastqs = False
-    success = create_new_structure(plasmid_dir, client_sheet, source_dirs, collapse=collapse_fastqs, nodata=args.nodata, verbose=args.verbose)
+    success = create_new_structure(plasmid_dir, client_sheet, source_dirs, collapse=collapse_fastqs, nodata=args.nodata, 
+            workers=args.workers, collapse_mode=args.collapse_mode, filter_on_collapse=args.filter_on_collapse, 
+            min_quality=args.min_quality, keep_unfiltered=args.keep_unfiltered, prefilter_prefix=args.prefilter_prefix,
+            resume=args.resume, checksum=args.manifest_checksum, compress_level=args.compress_level,
+            compress_threads=args.compress_threads, scan_index=scan_index, read_stats=read_stats,
+            staging=args.staging_strategy, stage_threads=args.stage_threads, output_format=args.output_format, events=events,
+            verbose=args.verbose)
 
     if success:
         print(f'Successfully create plasmid directory {plasmid_dir}')
+    else:
+        print(f'Failed to create plasmid directory {plasmid_dir}')
+        exit(3)
 
     #local_path = Path(os.path.realpath(__file__)).parent
     # minimap2_fp = args.minimap2
@@ -565,6 +1164,9 @@ def main():
     # each sample/alias has it's own set of records, alias is the barcode name and is the directory that holds the FASTQ files
     client_info = {}
     client_script_paths = []
+    filter_script_paths = []
+    map_script_paths = []
+    client_estimates = {}
     for client in client_sheet:
         cdir = plasmid_dir/client
         client_info[cdir.name] = {}
@@ -585,6 +1187,7 @@ def main():
                 exit(1)
              
             client_info[cdir.name][sd.name]['fastq_files'] = seq_fns
+            client_info[cdir.name][sd.name]['prefiltered'] = args.filter_on_collapse
             
             ref_dir = sd.joinpath('reference')  # optional
             insert_dir = sd.joinpath('insert')  # optional
@@ -616,21 +1219,60 @@ def main():
                 client_info[cdir.name][sd.name]['insert'] = Path(cdir.name)/sd.name/'insert'/insert_fp[0].name
 
         # generate client sample sheets without, and with, references
+        stage_start = start_metrics()
         client_sample_sheet_noref_path, client_sample_sheet_ref_path = generate_sample_sheets(client_info, cdir, client_sheet)
         if client_sample_sheet_noref_path:
             print(f'Created sample sheet without reference sequences {client_sample_sheet_noref_path} for client {cdir.name}')
         if client_sample_sheet_ref_path:
             print(f'Created sample sheet with reference sequences {client_sample_sheet_ref_path} for client {cdir.name}')
 
-        client_run_script_path = generate_client_run_script(client_sample_sheet_ref_path, 
+        # size the client's job from its samples and staged reads
+        pipeline_runs = sum(1 for ssp in (client_sample_sheet_noref_path, client_sample_sheet_ref_path) if ssp)
+        client_estimates[cdir.name] = estimate_client(client_info[cdir.name], client_sheet[cdir.name],
+                pipeline_runs=pipeline_runs, max_depth=args.max_depth)
+
+        client_run_script_path, client_filter_paths, client_map_paths = generate_client_run_script(client_sample_sheet_ref_path, 
                 client_sample_sheet_noref_path, client_info, client_sheet, cdir, 
                 args.pipeline_path, args.pipeline_version, args.chopper_path, 
-                args.prefilter_prefix, args.minimap2, args.samtools, args.email)
+                args.prefilter_prefix, args.minimap2, args.samtools, args.email,
+                filter_engine=args.filter_engine, readfilt_path=args.readfilt_path, min_quality=args.min_quality,
+                compress_level=args.compress_level, compress_threads=args.compress_threads, band_mode=args.band_mode,
+                max_depth=args.max_depth, downsample_path=args.downsample_path, downsample_seed=args.downsample_seed,
+                checksums=args.manifest_checksum, bgzf=args.output_format == 'bgzf' and not args.no_collapse,
+                resources=pbs_resources([client_estimates[cdir.name]], min_walltime_s))
         print(f'Created script {client_run_script_path} for client {cdir.name}')
         client_script_paths.append(client_run_script_path)
+        filter_script_paths.extend(client_filter_paths)
+        map_script_paths.extend(client_map_paths)
+        events.event('scripts', cdir.name, files=pipeline_runs + 1 + len(client_filter_paths) + len(client_map_paths),
+                **end_metrics(stage_start))
+
+    if args.batch_nextflow:
+        batch_sheet_path = build_batch(plasmid_dir, client_info, client_sheet)
+        print(f'Created combined sample sheet {batch_sheet_path} for all clients')
+        resources = batch_resources(list(client_estimates.values()), args.batch_ncpus, min_walltime_s)
+        batch_script_path = generate_batch_run_script(args.plasmid_dir, batch_sheet_path, filter_script_paths,
+                map_script_paths, args.pipeline_path, args.pipeline_version, args.batch_path, resources, args.email)
+        print(f'Created PBS job {batch_script_path} for all clients ({resources})')
+        job_script_paths = [batch_script_path]
+    elif args.pack_jobs:
+        script_by_client = {csp.name[len('run_'):-len('.qsub')]:csp for csp in client_script_paths}
+        jobs = pack_clients(client_estimates, int(args.pack_walltime * 3600), min_walltime_s)
+        job_script_paths = [generate_pack_script(args.plasmid_dir, i + 1, [script_by_client[c] for c in clients],
+                pbs_resources([client_estimates[c] for c in clients], min_walltime_s), args.email) for i, clients in enumerate(jobs)]
+        print(f'Packed {len(client_script_paths)} clients into {len(job_script_paths)} PBS jobs')
+    else:
+        jobs = [[client] for client in client_estimates]
+        job_script_paths = client_script_paths
+    if not args.batch_nextflow:
+        print(format_plan(client_estimates, jobs, min_walltime_s))
         
+    prefetch_script_path = generate_prefetch_script(args.plasmid_dir, args.pipeline_path, args.pipeline_version, args.email)
+    print(f'Created PBS job {prefetch_script_path} to fetch the pipeline and its containers')
+
     # generate an overall run script that launches everything else
-    generate_complete_run_script(args.plasmid_dir, client_script_paths)
+    generate_complete_run_script(args.plasmid_dir, job_script_paths, prefetch_script_path,
+            prefetch_marker(args.pipeline_path, args.pipeline_version))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,104 @@
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from shutil import copystat
+import fcntl
+import os
+
+"""
+    Staging of files that prep passes on unchanged: the FASTQ chunks with --no_collapse, and every
+    reference FASTA. Nothing downstream writes to these files in place (the filter scripts move a
+    FASTQ aside and write a new one), so they don't always need their own copy of the data.
+
+    Strategies (--staging_strategy):
+        copy - a full copy, made by the kernel with os.copy_file_range() (or os.sendfile()) rather than
+               read into python, which lets NFS and Lustre copy on the server side
+        reflink - a copy on write clone sharing the source's blocks (XFS, btrfs), an independent file
+        hardlink - a second name for the source file, on the same filesystem only
+        symlink - a link to the source by its absolute path. The source must stay in place, and be
+                  visible inside the pipeline's containers
+        auto - the cheapest of reflink, hardlink and copy that works for each file. Never symlinks
+    A reflink or hardlink that isn't possible, e.g. across filesystems, falls back to a copy.
+    Files are staged on STAGE_THREADS threads, as the copies spend their time in the kernel.
+
+    The method each file was staged by is recorded with its output in the staging manifest, so that
+    links can be told apart from copies. Removing a linked output only ever removes the link: the
+    source data it shares is left alone.
+"""
+
+STAGING_STRATEGIES = ('copy', 'reflink', 'hardlink', 'symlink', 'auto')
+STAGE_THREADS = 4
+FICLONE = 0x40049409  # linux/fs.h ioctl, clone a whole file
+COPY_CHUNK = 64 * 1024 * 1024  # bytes per copy_file_range/sendfile call
+FALLBACKS = {'copy':('copy',), 'reflink':('reflink', 'copy'), 'hardlink':('hardlink', 'copy'),
+        'symlink':('symlink',), 'auto':('reflink', 'hardlink', 'copy')}
+
+
+def reflink_file(src: Path, dst: Path):
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+
+
+def copy_file(src: Path, dst: Path):
+    """
+    Copy src to dst in the kernel, then copy its metadata as shutil.copy2() does
+    """
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        remaining = os.fstat(fin.fileno()).st_size
+        copy_range = getattr(os, 'copy_file_range', None)
+        while remaining > 0:
+            if copy_range:
+                try:
+                    copied = copy_range(fin.fileno(), fout.fileno(), min(remaining, COPY_CHUNK))
+                except OSError:
+                    copy_range = None  # e.g. not supported across these filesystems
+                    continue
+            else:
+                copied = os.sendfile(fout.fileno(), fin.fileno(), None, min(remaining, COPY_CHUNK))
+            if copied == 0:
+                break  # the source shrank
+            remaining -= copied
+    copystat(src, dst)
+
+
+def stage_file(src: Path, dst: Path, strategy='copy') -> str:
+    """
+    Stage one file, replacing anything already at dst
+
+    returns: the method used, one of copy, reflink, hardlink or symlink
+    """
+    for method in FALLBACKS[strategy]:
+        if dst.exists() or dst.is_symlink():
+            dst.unlink()
+        try:
+            if method == 'symlink':
+                os.symlink(Path(src).resolve(), dst)
+            elif method == 'hardlink':
+                os.link(src, dst)
+            elif method == 'reflink':
+                reflink_file(src, dst)
+            else:
+                copy_file(src, dst)
+            return method
+        except OSError:
+            if method == FALLBACKS[strategy][-1]:
+                raise
+    raise ValueError(f'Unknown staging strategy {strategy}')
+
+
+def stage_files(pairs: list, strategy='copy', threads=STAGE_THREADS, verbose=False) -> dict:
+    """
+    Stage many files at once
+
+    args:
+    pairs - list of (source Path, destination Path)
+    strategy - one of STAGING_STRATEGIES
+    threads - int, files staged at once
+
+    returns: {destination Path: method used}
+    """
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        methods = list(pool.map(lambda pair: stage_file(pair[0], pair[1], strategy), pairs))
+    if verbose:
+        for (src, dst), method in zip(pairs, methods):
+            print(f'Staged {src} to {dst} ({method})')
+    return {dst:method for (src, dst), method in zip(pairs, methods)}
@@ -0,0 +1,244 @@
+from pathlib import Path
+import os
+import json
+import time
+
+from plasmid_collapse import collapse_barcodes
+from block_gzip import gzi_path, DEFAULT_COMPRESS_LEVEL
+from fastq_index import fqi_path
+from read_stats import ReadStats
+from read_filter import size_band
+
+"""
+    Live-run watch mode for plasmid_prep.py.
+
+    MinKNOW writes each barcode's reads as a stream of FASTQ chunks while the run is going.
+    Rather than waiting for the run to end and then collapsing everything at once, the run
+    tree is polled and every chunk that has finished being written is appended to its
+    barcode's collapsed {barcode}.fq.gz straight away (optionally filtering as it goes).
+    A chunk is treated as finished once its size and mtime are unchanged between two polls
+    and it hasn't been touched for settle_seconds, or as soon as the run's final_summary
+    file appears. Once the final summary is seen the remaining chunks are appended and
+    prep carries on to write the scripts as usual.
+
+    Progress is kept in watch_state.json in the plasmid directory: the chunks already
+    appended to every barcode, and the size of each output after the last append. An
+    interrupted watch can be restarted with --resume, and any partial append left behind
+    is trimmed off before carrying on.
+"""
+
+STATE_NAME = 'watch_state.json'
+STATE_VERSION = 1
+FASTQ_SUFFIXES = ('.fastq', '.fq', '.fastq.gz', '.fq.gz')
+
+
+def state_path(plasmid_dir: Path) -> Path:
+    return Path(plasmid_dir) / STATE_NAME
+
+
+def load_state(plasmid_dir: Path, params: dict) -> dict:
+    """
+    Read the watch state from plasmid_dir, or start a new one. Exits if the state was written
+    with different staging parameters, as the outputs so far can't be appended to
+    """
+    sp = state_path(plasmid_dir)
+    state = {'version':STATE_VERSION, 'params':params, 'barcodes':{}}
+    if not sp.exists():
+        return state
+    with open(sp, 'rt') as f:
+        old = json.load(f)
+    if old.get('version') != STATE_VERSION or old.get('params') != params:
+        print(f'Watch state {sp} was written with different settings. Use --overwrite to start again')
+        exit(1)
+    return old
+
+
+def save_state(plasmid_dir: Path, state: dict):
+    """
+    Write the watch state atomically, so an interrupted watch never leaves a half written file
+    """
+    sp = state_path(plasmid_dir)
+    tmp = sp.with_name(sp.name + '.tmp')
+    with open(tmp, 'wt') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp, sp)
+
+
+def reconcile_outputs(entry: dict, plasmid_dir: Path, verbose=False) -> bool:
+    """
+    Trim each output back to the size recorded after its last complete append, dropping
+    anything half written when a watch was interrupted.
+    Returns False if an output has gone missing or shrunk, in which case the barcode must start again
+    """
+    for rel, size in entry['outputs'].items():
+        fp = Path(plasmid_dir) / rel
+        actual = fp.stat().st_size if fp.exists() else 0
+        if actual < size:
+            return False
+        if actual > size:
+            if verbose:
+                print(f'Trimming {actual - size} bytes of an interrupted append from {fp}')
+            os.truncate(fp, size)
+    return True
+
+
+def run_finished(barcode_dirs: list) -> bool:
+    """
+    True once every run directory holding one of the barcode directories has a final summary
+    """
+    run_dirs = {bcd.parent.parent for bcd in barcode_dirs}
+    return bool(run_dirs) and all(any(rd.glob('final_summary*.txt')) for rd in run_dirs)
+
+
+def list_chunks(bcd: Path) -> list:
+    """
+    FASTQ chunks currently in a barcode directory as (path, size, mtime_ns)
+    """
+    chunks = []
+    with os.scandir(bcd) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.lower().endswith(FASTQ_SUFFIXES):
+                st = entry.stat()
+                chunks.append((Path(entry.path), st.st_size, st.st_mtime_ns))
+    return chunks
+
+
+def watch_run(plasmid_dir: Path, client_sheet: dict, find_barcode_dirs, collapse_mode='concat',
+        filter_on_collapse=False, min_quality=15, keep_unfiltered=False, prefilter_prefix='unfilt_',
+        poll_interval=60, settle_seconds=120, workers=1, compress_level=DEFAULT_COMPRESS_LEVEL, compress_threads=0,
+        read_stats=True, output_format='gzip', verbose=False) -> tuple:
+    """
+    Collapse a sequencing run while it is still being written, returning once it has finished
+
+    args:
+    plasmid_dir - Path to the plasmid directory
+    client_sheet - dict of client and barcode info provided by the user
+    find_barcode_dirs - callable returning the barcode directories currently in the run tree
+    collapse_mode - str, collapse mode, one of plasmid_collapse.COLLAPSE_MODES
+    filter_on_collapse, min_quality, keep_unfiltered, prefilter_prefix - see create_new_structure()
+    poll_interval - seconds between scans of the run tree
+    settle_seconds - seconds a chunk must go untouched before it is appended
+    workers - int, number of processes used to append to barcodes in parallel
+    compress_level, compress_threads - compression settings, see plasmid_collapse.collapse_barcodes()
+    read_stats - bool, keep read statistics for each barcode up to date as chunks are appended
+    output_format - 'gzip' or 'bgzf' collapsed FASTQs, see block_gzip.OUTPUT_FORMATS. BGZF indexes (.gzi,
+                    .fqi) are rewritten after every append, so it isn't tracked with the outputs
+    verbose - bool, whether to display more information about the process
+
+    returns: (collapsed, failures)
+    collapsed - set of (client, barcode) whose collapsed FASTQ is complete
+    failures - dict {(client, barcode): error message} of barcodes that could not be collapsed
+    """
+    params = {'collapse_mode':collapse_mode, 'filter_on_collapse':filter_on_collapse,
+            'min_quality':min_quality, 'keep_unfiltered':keep_unfiltered, 'read_stats':read_stats}
+    if output_format != 'gzip':
+        params['output_format'] = output_format  # so that watches from before BGZF can still be resumed
+    state = load_state(plasmid_dir, params)
+    barcode_clients = {}  # barcode: [clients], the same barcode may be used by more than one client
+    filts = {}
+    for client in client_sheet:
+        for barcode in client_sheet[client]:
+            barcode_clients.setdefault(barcode, []).append(client)
+            key = f'{client}/{barcode}'
+            bp = Path(plasmid_dir)/client/barcode
+            bp.mkdir(parents=True, exist_ok=True)
+            filt = None
+            if filter_on_collapse:
+                size = client_sheet[client][barcode].get('size','')
+                if not size:
+                    print(f'No size provided for sample {barcode} in client {client}. Exiting.')
+                    exit(1)
+                min_size, max_size = size_band(size)
+                filt = {'min_length':min_size, 'max_length':max_size, 'min_quality':min_quality}
+                if keep_unfiltered:
+                    unfilt_dp = Path(plasmid_dir)/client/'unfiltered_reads'
+                    unfilt_dp.mkdir(exist_ok=True)
+                    filt['unfilt_fp'] = unfilt_dp/f'{prefilter_prefix}{barcode}.fq.gz'
+            filts[key] = filt
+            entry = state['barcodes'].get(key)
+            if entry and not reconcile_outputs(entry, plasmid_dir, verbose=verbose):
+                print(f'Outputs of client {client} barcode {barcode} have changed since the last watch, starting it again')
+                entry = None
+            if not entry:
+                collapse_fp = bp/f'{barcode}.fq.gz'
+                for fp in [collapse_fp, gzi_path(collapse_fp), fqi_path(collapse_fp), bp/f'{barcode}.log'] + \
+                        ([filt['unfilt_fp']] if filt and 'unfilt_fp' in filt else []):
+                    if fp.exists():
+                        fp.unlink()
+                state['barcodes'][key] = {'chunks':[], 'failed':[], 'outputs':{}, 'counts':None, 'read_stats':None}
+    save_state(plasmid_dir, state)
+
+    failures = {}
+    last_seen = {}  # chunk path: (size, mtime_ns) at the previous poll
+    while True:
+        barcode_dirs = find_barcode_dirs()
+        # check before listing chunks, so that once the run has finished every chunk listed is complete
+        finished = run_finished(barcode_dirs)
+        bcds = {bcd.name:bcd for bcd in barcode_dirs}
+        now_ns = time.time_ns()
+        jobs = []
+        for barcode, bcd in bcds.items():
+            ready = []
+            for fp, size, mtime_ns in list_chunks(bcd):
+                sig = (size, mtime_ns)
+                settled = last_seen.get(fp) == sig and now_ns - mtime_ns >= settle_seconds * 1e9
+                last_seen[fp] = sig
+                if finished or settled:
+                    ready.append((mtime_ns, fp.name, fp))
+            ready = [fp for _, _, fp in sorted(ready)]
+            for client in barcode_clients.get(barcode, []):
+                key = f'{client}/{barcode}'
+                entry = state['barcodes'][key]
+                done = set(entry['chunks']) | set(entry['failed'])
+                fps = [fp for fp in ready if str(fp) not in done]
+                if not fps:
+                    continue
+                filt = filts[key]
+                if filt:
+                    filt = dict(filt, prior_counts=entry['counts'])
+                stats = None
+                if read_stats:
+                    if entry['read_stats']:
+                        stats = ReadStats.from_state(entry['read_stats'])
+                    else:
+                        stats = ReadStats(client_sheet[client][barcode].get('size',''))
+                jobs.append((client, barcode, fps, Path(plasmid_dir)/client/barcode/f'{barcode}.fq.gz', filt, stats))
+
+        if jobs:
+            results = {}
+            poll_failures = collapse_barcodes(jobs, workers=workers, mode=collapse_mode, append=True,
+                    results=results, compresslevel=compress_level, compress_threads=compress_threads,
+                    bgzf=output_format == 'bgzf', verbose=verbose)
+            for client, barcode, fps, collapse_fp, filt, stats in jobs:
+                entry = state['barcodes'][f'{client}/{barcode}']
+                if (client, barcode) in poll_failures:
+                    # drop the partial append, and don't try these chunks again
+                    print(f'Collapse failed for client {client} barcode {barcode}: {poll_failures[(client, barcode)]}')
+                    reconcile_outputs(entry, plasmid_dir, verbose=verbose)
+                    entry['failed'].extend(str(fp) for fp in fps)
+                    failures[(client, barcode)] = poll_failures[(client, barcode)]
+                    continue
+                entry['chunks'].extend(str(fp) for fp in fps)
+                entry['counts'], stats, _ = results[(client, barcode)]
+                if stats is not None:
+                    entry['read_stats'] = stats.to_state()
+                for fp in [collapse_fp] + ([filt['unfilt_fp']] if filt and 'unfilt_fp' in filt else []):
+                    entry['outputs'][str(fp.relative_to(plasmid_dir))] = fp.stat().st_size
+            save_state(plasmid_dir, state)
+            print(f'Appended {sum(len(job[2]) for job in jobs)} chunks to {len(jobs)} barcodes')
+
+        if finished:
+            break
+        if verbose:
+            print(f'Waiting {poll_interval} seconds for more reads')
+        time.sleep(poll_interval)
+
+    collapsed = set()
+    for client in client_sheet:
+        for barcode in client_sheet[client]:
+            entry = state['barcodes'][f'{client}/{barcode}']
+            if entry['failed'] and (client, barcode) not in failures:
+                failures[(client, barcode)] = f"{len(entry['failed'])} chunks could not be collapsed in an earlier watch"
+            if entry['chunks'] and (client, barcode) not in failures:
+                collapsed.add((client, barcode))
+    return collapsed, failures
@@ -0,0 +1,176 @@
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+import atexit
+import cProfile
+import json
+import resource
+import time
+import os
+
+"""
+    Structured timing and throughput events for prep, one JSON object per line in
+    <plasmid_dir>/prep_events.jsonl, so a slow setup job can be broken down afterwards, e.g. with
+        jq -s 'group_by(.stage) | map({stage: .[0].stage, wall_s: (map(.wall_s) | add)})' prep_events.jsonl
+
+    Each event covers one stage (scan, stage, collapse, manifest, scripts) for a client and barcode where
+    that applies, with its wall time, CPU time, bytes read and written, files touched and peak resident
+    memory. Collapsing runs in worker processes, so collapse events are measured inside the worker
+    (see run_measured()). A final 'prep' event covers the whole run, including the worker processes
+    once they have finished and been reaped: their CPU time and peak memory from the OS's counts for
+    child processes, and their bytes because Linux adds a reaped child's I/O counters to its parent's
+    /proc/self/io. Workers still running when prep exits aren't counted.
+
+    Bytes come from /proc/self/io (everything read or written, cached or not) and the peak memory is reset
+    at the start of every stage through /proc/self/clear_refs. Where those aren't available the counters
+    from getrusage() are used instead, which only see real disk blocks and the peak of the whole process,
+    adding the blocks of reaped children to the final event.
+
+    With --profile, the whole run is also profiled with cProfile and dumped to prep_profile.pstats, for
+        python -m pstats prep_profile.pstats
+"""
+
+EVENTS_NAME = 'prep_events.jsonl'
+PROFILE_NAME = 'prep_profile.pstats'
+
+
+def io_bytes(children=False) -> tuple:
+    """
+    (bytes read, bytes written) by this process so far. /proc/self/io always includes the child
+    processes it has reaped, the getrusage() fallback only with children
+    """
+    try:
+        with open('/proc/self/io', 'rt') as f:
+            counters = dict(line.split(':') for line in f if ':' in line)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        usages = [resource.getrusage(resource.RUSAGE_SELF)]
+        if children:
+            usages.append(resource.getrusage(resource.RUSAGE_CHILDREN))
+        return sum(u.ru_inblock for u in usages) * 512, sum(u.ru_oublock for u in usages) * 512
+
+
+def reset_peak_rss() -> bool:
+    """
+    Restart the peak resident memory count of this process, where Linux allows it
+    """
+    try:
+        with open('/proc/self/clear_refs', 'wt') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident memory of this process in MB, since the last reset_peak_rss()
+    """
+    try:
+        with open('/proc/self/status', 'rt') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def start_metrics() -> dict:
+    reset_peak_rss()
+    read, written = io_bytes()
+    return {'wall':time.perf_counter(), 'cpu':time.process_time(), 'read':read, 'written':written}
+
+
+def end_metrics(start: dict) -> dict:
+    """
+    Metrics of the work done in this process since start_metrics()
+    """
+    read, written = io_bytes()
+    return {'wall_s':round(time.perf_counter() - start['wall'], 3), 'cpu_s':round(time.process_time() - start['cpu'], 3),
+            'read_bytes':read - start['read'], 'write_bytes':written - start['written'], 'peak_rss_mb':round(peak_rss_mb(), 1)}
+
+
+def run_measured(fn, *args, **kwargs) -> tuple:
+    """
+    Call fn and measure it, in whichever process it runs in e.g. a worker of a process pool
+
+    returns: (fn's result, metrics from end_metrics())
+    """
+    start = start_metrics()
+    result = fn(*args, **kwargs)
+    return result, end_metrics(start)
+
+
+class EventLog:
+    """
+    Appends prep events to a JSON Lines file, or discards them if path is None
+
+    args:
+    path - Path of the events file, usually plasmid_dir/EVENTS_NAME
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.fout = open(path, 'at') if path else None
+
+    def write(self, event: dict):
+        if self.fout:
+            print(json.dumps(event), file=self.fout, flush=True)
+
+    def event(self, stage: str, client='', barcode='', **fields):
+        """
+        Record an event measured elsewhere, e.g. by run_measured()
+        """
+        self.write({'time':datetime.now().isoformat(timespec='seconds'), 'stage':stage, 'client':client,
+                'barcode':barcode, **fields})
+
+    @contextmanager
+    def stage(self, stage: str, client='', barcode='', **fields):
+        """
+        Measure the work of a with block as one event. Stages are not nested, as each resets the peak memory.
+        The block may add to the event it is given, e.g. ev['files'] += 1
+        """
+        ev = {'files':0, **fields}
+        start = start_metrics()
+        try:
+            yield ev
+        finally:
+            ev.update(end_metrics(start))
+            self.event(stage, client=client, barcode=barcode, **ev)
+
+    def close(self):
+        if self.fout:
+            self.fout.close()
+            self.fout = None
+
+
+def start_run(plasmid_dir: Path, profile=False) -> EventLog:
+    """
+    Start recording prep's events in plasmid_dir, and profiling it if asked. The final 'prep' event
+    and the profile are written when the process exits, including early exits on errors
+
+    returns: EventLog for the run's stages
+    """
+    events = EventLog(Path(plasmid_dir)/EVENTS_NAME)
+    wall = time.perf_counter()
+    read, written = io_bytes(children=True)
+    start_times = os.times()
+    profiler = None
+    if profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    def finish():
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(str(Path(plasmid_dir)/PROFILE_NAME))
+        cpu = lambda t: t.user + t.system + t.children_user + t.children_system
+        rusage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        end_read, end_written = io_bytes(children=True)
+        events.event('prep', wall_s=round(time.perf_counter() - wall, 3), cpu_s=round(cpu(os.times()) - cpu(start_times), 3),
+                read_bytes=end_read - read, write_bytes=end_written - written,
+                peak_rss_mb=round(max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, rusage_children.ru_maxrss) / 1024, 1))
+        events.close()
+
+    atexit.register(finish)
+    return events
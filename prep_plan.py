@@ -0,0 +1,221 @@
+from pathlib import Path
+from shutil import disk_usage
+import json
+import gzip
+
+from fastq_blocks import iter_record_blocks
+from read_filter import filter_block, size_band
+from pbs_plan import GZ_BYTES_PER_BASE, format_walltime
+
+"""
+    Plan mode (--plan): what prep would do with a run, worked out from the sample sheet and the run
+    scan alone. Nothing is copied and the plasmid directory isn't created.
+
+    For every client and barcode the plan gives the number of source files, their gzipped and plain
+    bytes, the estimated uncompressed bytes, the expected collapsed and filtered sizes, and the
+    estimated prep (staging) and filter times. It ends with a go/no-go check of the space prep will
+    write against the free space on the destination filesystem, so that a long copy doesn't fail
+    half way through on quota.
+
+    Estimates are sampled from the run itself rather than guessed:
+        uncompressed size - the gzip trailers (ISIZE, the last 4 bytes) of up to PLAN_SAMPLE_FILES chunks
+            per barcode, scaled up to the rest. MinKNOW writes each chunk as a single gzip member
+        filtered size - the share of bases passing the size band and quality cutoff in the first
+            PLAN_SAMPLE_BLOCKS blocks of reads of the barcode's first chunk, capped by --max_depth
+        times - MB/s of FASTQ as stored, per process. DEFAULT_RATES were measured with
+            benchmarks/run_benchmarks.py, and its --results file from the machine prep will run on
+            can be given instead (--plan_rates), as the rates depend heavily on the storage
+"""
+
+PLAN_SAMPLE_FILES = 3
+PLAN_SAMPLE_BLOCKS = 1  # of fastq_blocks.BLOCK_SIZE, a few thousand reads
+DEFAULT_EXPANSION = 2.3  # uncompressed bytes for every gzipped byte of ONT FASTQ, when no chunk is gzipped
+SPACE_MARGIN = 1.1  # free space wanted beyond the estimate
+# MB/s per process, of the benchmarks in benchmarks/run_benchmarks.py
+DEFAULT_RATES = {'collapse_concat':75.0, 'collapse_decode':10.0, 'no_collapse':200.0, 'max_length':50.0}
+PARALLEL_BENCHMARKS = ('collapse_concat', 'collapse_decode')  # run on --workers processes, the others on one
+NO_GO_EXIT = 4
+
+
+def load_rates(results_fp=None) -> dict:
+    """
+    MB/s per process for each benchmark: DEFAULT_RATES, updated with the latest results in a
+    benchmarks/run_benchmarks.py --results file where one is given
+    """
+    rates = dict(DEFAULT_RATES)
+    if not results_fp:
+        return rates
+    with open(results_fp, 'rt') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            if result.get('benchmark') not in rates or not result.get('mb_per_s'):
+                continue
+            processes = 1
+            if result['benchmark'] in PARALLEL_BENCHMARKS:
+                settings = result.get('settings', {})
+                processes = max(min(settings.get('workers', 1), settings.get('barcodes', 1)), 1)
+            rates[result['benchmark']] = result['mb_per_s'] / processes
+    return rates
+
+
+def gzip_isize(fp: Path) -> int:
+    """
+    Uncompressed size of a single member gzip file from its trailer, modulo 4GB. 0 if unreadable
+    """
+    try:
+        with open(fp, 'rb') as f:
+            f.seek(-4, 2)
+            return int.from_bytes(f.read(4), 'little')
+    except OSError:
+        return 0
+
+
+def sample_kept_fraction(fp: Path, min_length: int, max_length: int, min_quality: float) -> float|None:
+    """
+    Share of bases in the first PLAN_SAMPLE_BLOCKS blocks of reads of fp that pass the cutoffs, None if it has no reads
+    """
+    bases_in = 0
+    bases_out = 0
+    try:
+        opener = gzip.open if fp.name.lower().endswith('.gz') else open
+        with opener(fp, 'rb') as fin:
+            for i, (buf, spans) in enumerate(iter_record_blocks(fin)):
+                keep, lengths = filter_block(buf, spans, min_length, max_length, min_quality)
+                bases_in += sum(lengths)
+                bases_out += sum(read_len for read_len, k in zip(lengths, keep) if k)
+                if i + 1 >= PLAN_SAMPLE_BLOCKS:
+                    break
+    except (OSError, EOFError):
+        return None
+    return bases_out / bases_in if bases_in else None
+
+
+def plan_barcode(files: list, size, ref='', collapse=True, collapse_mode='concat', filter_on_collapse=False,
+        keep_unfiltered=False, min_quality=15, max_depth=0, rates=DEFAULT_RATES) -> dict:
+    """
+    Estimate the staging and filtering of one barcode
+
+    args:
+    files - [(Path, size in bytes)] of the barcode's source FASTQs
+    size - expected plasmid size from the sample sheet, '' if not given
+    ref - reference FASTA path from the sample sheet, '' if none
+    other args - as given to create_new_structure() and the filter scripts
+
+    returns: {'files', 'gz_bytes', 'plain_bytes', 'raw_bytes', 'collapsed_bytes', 'filtered_bytes', 'kept',
+            'write_bytes', 'prep_s', 'filter_s'}
+    """
+    gz = [(fp, nbytes) for fp, nbytes in files if fp.name.lower().endswith('.gz')]
+    gz_bytes = sum(nbytes for fp, nbytes in gz)
+    plain_bytes = sum(nbytes for fp, nbytes in files) - gz_bytes
+    expansion = DEFAULT_EXPANSION
+    sampled = gz[::max(len(gz) // PLAN_SAMPLE_FILES, 1)][:PLAN_SAMPLE_FILES]
+    sampled_bytes = sum(nbytes for fp, nbytes in sampled)
+    sampled_isize = sum(gzip_isize(fp) for fp, nbytes in sampled)
+    if sampled_bytes and sampled_isize:
+        expansion = max(sampled_isize / sampled_bytes, 1.0)
+    raw_bytes = gz_bytes * expansion + plain_bytes
+    kept = None
+    if size and files:
+        min_size, max_size = size_band(size)
+        kept = sample_kept_fraction((gz or files)[0][0], min_size, max_size, min_quality)
+    if kept is None:
+        kept = 1.0
+
+    stored_bytes = gz_bytes + plain_bytes
+    if not collapse:
+        collapsed_bytes = stored_bytes
+    else:
+        # concat keeps the gzipped chunks as they are and compresses the plain ones, decode recompresses everything
+        collapsed_bytes = gz_bytes + plain_bytes / expansion
+    filtered_bytes = collapsed_bytes * kept
+    if max_depth and size:
+        filtered_bytes = min(filtered_bytes, int(size) * max_depth * GZ_BYTES_PER_BASE)
+    if filter_on_collapse:
+        write_bytes = filtered_bytes + (collapsed_bytes if keep_unfiltered else 0)
+        collapsed_bytes = filtered_bytes
+        prep_rate = rates['collapse_decode']
+        filter_s = 0.0  # only downsampling is left to the filter scripts
+    else:
+        # the filter scripts keep the unfiltered FASTQ (renamed) alongside the filtered one
+        write_bytes = collapsed_bytes + filtered_bytes
+        prep_rate = rates[f'collapse_{collapse_mode}'] if collapse else rates['no_collapse']
+        filter_s = collapsed_bytes / 1e6 / rates['max_length']
+    if ref and Path(ref).exists():
+        write_bytes += Path(ref).stat().st_size
+    return {'files':len(files), 'gz_bytes':gz_bytes, 'plain_bytes':plain_bytes, 'raw_bytes':int(raw_bytes),
+            'collapsed_bytes':int(collapsed_bytes), 'filtered_bytes':int(filtered_bytes), 'kept':kept,
+            'write_bytes':int(write_bytes), 'prep_s':stored_bytes / 1e6 / prep_rate, 'filter_s':filter_s}
+
+
+def plan_run(client_sheet: dict, source_dirs: dict, scan_index: dict, collapse=True, workers=1, **kwargs) -> dict:
+    """
+    Estimate every barcode of a run with plan_barcode()
+
+    args:
+    client_sheet - user provided client/sample info (client,alias,barcode,size,reference)
+    source_dirs - {client: {barcode: Path of its directory}} from parse_input_dirs()
+    scan_index - scan index from parse_input_dirs(), listing the source files and their sizes
+    collapse - bool, False with --no_collapse
+    workers - int, processes collapsing barcodes in parallel
+    kwargs - passed on to plan_barcode()
+
+    returns: {'clients':{client: {barcode: estimate}}, 'write_bytes', 'prep_s', 'filter_s'}
+        prep_s is the wall time of staging, with collapsing shared between the workers,
+        filter_s is the time of every filter script run one after another
+    """
+    plan = {'clients':{}, 'write_bytes':0, 'prep_s':0.0, 'filter_s':0.0}
+    for client in client_sheet:
+        plan['clients'][client] = {}
+        for barcode, sample in client_sheet[client].items():
+            bcd = source_dirs[client][barcode]
+            files = [(Path(bcd)/name, nbytes) for name, nbytes, mtime_ns
+                    in scan_index['barcodes'][Path(bcd).name][str(bcd)]['files']]
+            plan['clients'][client][barcode] = plan_barcode(files, sample.get('size',''), ref=sample['ref'],
+                    collapse=collapse, **kwargs)
+    estimates = [est for barcodes in plan['clients'].values() for est in barcodes.values()]
+    plan['write_bytes'] = sum(est['write_bytes'] for est in estimates)
+    plan['filter_s'] = sum(est['filter_s'] for est in estimates)
+    prep_times = [est['prep_s'] for est in estimates]
+    if collapse and prep_times:
+        plan['prep_s'] = max(sum(prep_times) / max(workers, 1), max(prep_times))
+    else:
+        plan['prep_s'] = sum(prep_times)
+    return plan
+
+
+def free_space(plasmid_dir: Path) -> int:
+    """
+    Free bytes on the filesystem the plasmid directory will be made on
+    """
+    dp = Path(plasmid_dir).resolve()
+    while not dp.exists():
+        dp = dp.parent
+    return disk_usage(dp).free
+
+
+def format_run_plan(plan: dict, free_bytes: int) -> tuple:
+    """
+    Printable plan, per client and barcode, followed by the go/no-go check
+
+    returns: (text, go) where go is True if free_bytes covers the estimated writes with SPACE_MARGIN to spare
+    """
+    gb = lambda nbytes: f'{nbytes / 1e9:.2f} GB'
+    hms = lambda seconds: format_walltime(int(seconds))
+    lines = []
+    for client, barcodes in plan['clients'].items():
+        ests = list(barcodes.values())
+        lines.append(f'{client}: {len(ests)} barcodes, {sum(e["files"] for e in ests)} files, '+\
+                f'{gb(sum(e["gz_bytes"] + e["plain_bytes"] for e in ests))} stored, writes {gb(sum(e["write_bytes"] for e in ests))}')
+        for barcode, est in barcodes.items():
+            lines.append(f'    {barcode}: {est["files"]} files, {gb(est["gz_bytes"])} gzipped + {gb(est["plain_bytes"])} plain, '+\
+                    f'about {gb(est["raw_bytes"])} uncompressed -> collapsed {gb(est["collapsed_bytes"])}, '+\
+                    f'filtered {gb(est["filtered_bytes"])} ({est["kept"]:.0%} of bases kept), '+\
+                    f'prep {hms(est["prep_s"])}, filter {hms(est["filter_s"])}')
+    needed = plan['write_bytes'] * SPACE_MARGIN
+    go = free_bytes >= needed
+    lines.append(f'Estimated prep {hms(plan["prep_s"])}, filtering {hms(plan["filter_s"])} (all filter scripts one after another)')
+    lines.append(f'Prep and filtering will write about {gb(plan["write_bytes"])}, {gb(needed)} with margin, '+\
+            f'{gb(free_bytes)} is free: ' + ('GO' if go else 'NO GO, free some space or choose another --plasmid_dir'))
+    return '\n'.join(lines), go
@@ -0,0 +1,154 @@
+import sys
+import math
+import heapq
+import random
+from argparse import ArgumentParser as AP
+
+from fastq_blocks import open_fastq, iter_record_blocks, REC_START, REC_END, SEQ_START, SEQ_END, QUAL_START, QUAL_END
+from read_filter import mean_qualities
+from block_gzip import DEFAULT_COMPRESS_LEVEL
+from plasmid_manifest import open_checksummed, record_checksum
+
+"""
+    Coverage-targeted downsampling of a sample's filtered reads, run after the filter in the
+    per-sample *_filt.sh scripts. Deep barcodes are capped at max_depth times the plasmid size, so
+    the assembly doesn't spend its time and memory on thousands of times more coverage than it needs.
+
+    Sampling is a single streaming pass of weighted reservoir sampling (Efraimidis-Spirakis): each
+    read gets the key log(u)/weight, with u drawn from a generator seeded with a fixed seed and the weight
+    its length times its mean quality, so long, accurate reads are favoured. Only the reads with the
+    highest keys that are needed to reach the target bases are ever held in memory, and they are
+    written out in their original order once the input ends. The same input and seed always give
+    the same output. Samples already below the target depth are passed through unchanged.
+"""
+
+DEFAULT_SEED = 1
+MIN_WEIGHT_QUALITY = 1.0  # reads with a mean quality below this are weighted as if they had it
+
+
+def read_weight(read_len: int, quality: float) -> float:
+    """
+    Sampling weight of a read, its length times its mean quality
+    """
+    return max(read_len, 1) * max(quality, MIN_WEIGHT_QUALITY)
+
+
+class ReadSampler:
+    """
+    Weighted reservoir keeping the highest keyed reads that together reach target_bases
+
+    args:
+    target_bases - int, bases to keep
+    seed - int, random seed, the same seed and input always keep the same reads
+    """
+    def __init__(self, target_bases: int, seed=DEFAULT_SEED):
+        self.target_bases = target_bases
+        self.rng = random.Random(seed)
+        self.heap = []  # (key, read index, read length, record), lowest key first
+        self.bases = 0  # bases held in the heap
+        self.counts = {'reads_in':0, 'reads_out':0, 'bases_in':0, 'bases_out':0}
+
+    def add_block(self, buf: bytes, spans: list):
+        """
+        Offer every record of a block (from fastq_blocks.iter_record_blocks) to the reservoir
+        """
+        view = memoryview(buf)
+        scores = mean_qualities([view[span[QUAL_START]:span[QUAL_END]] for span in spans])
+        heap = self.heap
+        random = self.rng.random
+        for span, score in zip(spans, scores):
+            read_len = span[SEQ_END] - span[SEQ_START]
+            index = self.counts['reads_in']
+            self.counts['reads_in'] += 1
+            self.counts['bases_in'] += read_len
+            # one draw per read whether or not it's kept, so the keys only depend on the seed and read order
+            key = math.log(1.0 - random()) / read_weight(read_len, score)
+            if self.bases >= self.target_bases and key <= heap[0][0]:
+                continue
+            heapq.heappush(heap, (key, index, read_len, bytes(view[span[REC_START]:span[REC_END]])))
+            self.bases += read_len
+            # drop the lowest keys for as long as the rest still reach the target
+            while self.bases - heap[0][2] >= self.target_bases:
+                self.bases -= heapq.heappop(heap)[2]
+
+    def write(self, fout) -> dict:
+        """
+        Write the kept records to fout in their input order
+
+        returns: dict of counts {'reads_in','reads_out','bases_in','bases_out'}
+        """
+        kept = sorted(self.heap, key=lambda item: item[1])
+        for i in range(0, len(kept), 1000):
+            fout.write(b''.join(item[3] for item in kept[i:i + 1000]))
+        self.counts['reads_out'] = len(kept)
+        self.counts['bases_out'] = self.bases
+        return self.counts
+
+
+def downsample_reads(fin, fout, target_bases: int, seed=DEFAULT_SEED) -> dict:
+    """
+    Copy a weighted random sample of the FASTQ records from fin to fout, reaching target_bases
+
+    args:
+    fin - binary file handle to read FASTQ from
+    fout - binary file handle to write the kept records to
+    target_bases - int, bases to keep. All records are kept if fin holds fewer
+    seed - int, random seed
+
+    returns: dict of counts {'reads_in','reads_out','bases_in','bases_out'}
+    """
+    sampler = ReadSampler(target_bases, seed=seed)
+    for buf, spans in iter_record_blocks(fin):
+        sampler.add_block(buf, spans)
+    return sampler.write(fout)
+
+
+def format_depth(counts: dict, size: int) -> str:
+    """
+    One line summary of downsample_reads() counts and the depth before and after, as written to the filter logs
+    """
+    return f"Downsampled to {counts['reads_out']} of {counts['reads_in']} reads "+\
+            f"({counts['bases_out']} of {counts['bases_in']} bases), "+\
+            f"depth {counts['bases_in'] / size:.1f}x -> {counts['bases_out'] / size:.1f}x of {size}bp"
+
+
+if __name__ == "__main__":
+    parser = AP(description="Downsample FASTQ reads to a target depth of the plasmid size")
+    parser.add_argument('input', help="Input FASTQ file, may be gzipped ('-' for stdin)")
+    parser.add_argument('output', nargs='?', default='-',
+            help="Output FASTQ file, gzipped if it ends in .gz (default: stdout)")
+    parser.add_argument('--size', type=int, required=True, help="Plasmid size the depth is measured against")
+    parser.add_argument('--max_depth', type=float, required=True, help="Depth of the plasmid size to keep e.g. 200")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help=f"Random seed (default: {DEFAULT_SEED})")
+    parser.add_argument('--compress_level', type=int, default=DEFAULT_COMPRESS_LEVEL, choices=range(1, 10),
+            metavar='1-9', help=f"gzip compression level of the output (default: {DEFAULT_COMPRESS_LEVEL})")
+    parser.add_argument('--compress_threads', type=int, default=0,
+            help="Threads used to compress the output (default: all available cores)")
+    parser.add_argument('--bgzf', action='store_true', help="Write a gzipped output as BGZF, with a .gzi index (see block_gzip.py)")
+    parser.add_argument('--checksums', help="Append the output's checksum, reads and bases to this JSON Lines file "+\
+            "(see plasmid_manifest.py). Ignored when writing to stdout")
+    args = parser.parse_args()
+    if args.size <= 0 or args.max_depth <= 0:
+        print('--size and --max_depth must both be greater than zero', file=sys.stderr)
+        exit(1)
+
+    fin = open_fastq(args.input, 'rb')
+    hasher = None
+    if args.checksums and args.output != '-':
+        fout, hasher = open_checksummed(args.output, compresslevel=args.compress_level, threads=args.compress_threads,
+                bgzf=args.bgzf)
+    else:
+        fout = open_fastq(args.output, 'wb', compresslevel=args.compress_level, threads=args.compress_threads,
+                bgzf=args.bgzf)
+    try:
+        counts = downsample_reads(fin, fout, int(args.size * args.max_depth), seed=args.seed)
+    finally:
+        if fin is not sys.stdin.buffer:
+            fin.close()
+        if fout is not sys.stdout.buffer:
+            fout.close()
+        else:
+            fout.flush()
+    if hasher is not None:
+        record_checksum(args.checksums, args.output, hasher.hexdigest(), counts['reads_out'], counts['bases_out'])
+    print(format_depth(counts, args.size), file=sys.stderr)
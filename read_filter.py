@@ -0,0 +1,236 @@
+import io
+import sys
+import math
+from argparse import ArgumentParser as AP
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, the pure python path gives the same answers
+    np = None
+
+from fastq_blocks import open_fastq, iter_record_blocks, write_records, SEQ_START, SEQ_END, QUAL_START, QUAL_END
+from block_gzip import default_workers, DEFAULT_COMPRESS_LEVEL
+from fastq_index import load_index, load_blocks, block_at, chunk_bounds, RangeReader
+from plasmid_manifest import open_checksummed, record_checksum
+
+"""
+    Single pass read filter for ONT FASTQ files.
+    Replaces the gunzip -c | NanoFilt/chopper | python max_length.py | gzip chain in the
+    per-sample *_filt.sh scripts: each read is decoded once, checked against the minimum
+    length, maximum length and mean quality cutoffs, and written straight to the
+    (optionally gzipped) output. Reads are handled a block at a time by fastq_blocks.py.
+
+    Mean quality is calculated the same way as NanoFilt and chopper, by averaging the
+    per-base error probabilities and converting the mean back to a Phred score.
+
+    With --workers, a BGZF input with a read offset index (see fastq_index.py) is cut into chunks
+    of whole reads which are decompressed and filtered on a pool of processes, and the passing reads
+    are written out in their original order, exactly as a single process would write them. Inputs
+    without an index are filtered in a single process.
+"""
+
+PHRED_OFFSET = 33
+SIZE_BAND_BP = 2000  # reads are kept within +/- this many bp of the expected plasmid size
+QUALITY_TOLERANCE = 1e-9  # float summation order differs between numpy and python, don't let it decide boundary reads
+CHUNK_BYTES = 64 * 1024 * 1024  # uncompressed FASTQ per chunk with --workers, about
+CHUNKS_PER_WORKER = 4  # at least this many chunks per worker, so that uneven chunks still share out evenly
+
+# error probability for every possible quality byte, indexed by the raw ASCII value
+ERROR_PROBS = [10 ** (-max(b - PHRED_OFFSET, 0) / 10) for b in range(256)]
+if np is not None:
+    ERROR_PROB_LUT = np.array(ERROR_PROBS, dtype=np.float64)
+
+
+def mean_quality(qual: bytes) -> float:
+    """
+    NanoFilt/chopper style mean quality of a single quality string:
+    -10*log10(mean(10^(-q/10)))
+    """
+    if not qual:
+        return 0.0
+    mean_err = sum(map(ERROR_PROBS.__getitem__, qual)) / len(qual)
+    return -10 * math.log10(mean_err)
+
+
+def mean_qualities(quals: list) -> list:
+    """
+    Mean quality of every quality string (bytes or memoryview) in quals. With numpy the whole batch is
+    scored at once: the strings are joined into one byte array, mapped through the
+    error probability lookup table, and summed per read with reduceat
+    """
+    if np is None or not quals:
+        return [mean_quality(q) for q in quals]
+    lengths = np.fromiter((len(q) for q in quals), dtype=np.int64, count=len(quals))
+    scores = np.zeros(len(quals), dtype=np.float64)
+    nonempty = lengths > 0
+    if not nonempty.any():
+        return scores.tolist()
+    probs = ERROR_PROB_LUT[np.frombuffer(b''.join(quals), dtype=np.uint8)]
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))[nonempty]
+    sums = np.add.reduceat(probs, starts)
+    scores[nonempty] = -10 * np.log10(sums / lengths[nonempty])
+    return scores.tolist()
+
+
+def size_band(size) -> tuple:
+    """
+    Length band (min_length, max_length) kept for a plasmid of the given expected size
+    """
+    return int(size) - SIZE_BAND_BP, int(size) + SIZE_BAND_BP
+
+
+def filter_block(buf: bytes, spans: list, min_length=0, max_length=0, min_quality=0.0, lengths=None, scores=None) -> tuple:
+    """
+    Decide which records of a block (from fastq_blocks.iter_record_blocks) pass the cutoffs
+    lengths, scores - optional read lengths and mean qualities of every span, if already known (see read_stats.py)
+
+    returns: (keep, lengths) - a bool and a read length for every span
+    """
+    if lengths is None:
+        lengths = [span[SEQ_END] - span[SEQ_START] for span in spans]
+    keep = [read_len >= min_length and not (max_length and read_len > max_length) for read_len in lengths]
+    if min_quality > 0 and scores is not None:
+        keep = [k and score + QUALITY_TOLERANCE >= min_quality for k, score in zip(keep, scores)]
+    elif min_quality > 0:
+        # only score the reads that passed the length band
+        view = memoryview(buf)
+        passed = [i for i, k in enumerate(keep) if k]
+        scores = mean_qualities([view[spans[i][QUAL_START]:spans[i][QUAL_END]] for i in passed])
+        for i, score in zip(passed, scores):
+            if score + QUALITY_TOLERANCE < min_quality:
+                keep[i] = False
+    return keep, lengths
+
+
+def filter_reads(fin, fout, min_length=0, max_length=0, min_quality=0.0) -> dict:
+    """
+    Copy every FASTQ record from fin to fout that passes all the cutoffs
+
+    args:
+    fin - binary file handle to read FASTQ from
+    fout - binary file handle to write passing records to
+    min_length - int, minimum read length (inclusive)
+    max_length - int, maximum read length (inclusive), 0 for no limit
+    min_quality - float, minimum NanoFilt style mean read quality (inclusive), 0 to skip
+
+    returns: dict of counts {'reads_in','reads_out','bases_in','bases_out'}
+    """
+    counts = {'reads_in':0, 'reads_out':0, 'bases_in':0, 'bases_out':0}
+    for buf, spans in iter_record_blocks(fin):
+        keep, lengths = filter_block(buf, spans, min_length, max_length, min_quality)
+        counts['reads_in'] += len(spans)
+        counts['bases_in'] += sum(lengths)
+        counts['reads_out'] += write_records(fout, buf, spans, keep)
+        counts['bases_out'] += sum(read_len for read_len, k in zip(lengths, keep) if k)
+    return counts
+
+
+def filter_range(fp, block: tuple, start: int, end: int, min_length=0, max_length=0, min_quality=0.0) -> tuple:
+    """
+    filter_reads() of the reads between two uncompressed offsets of a BGZF FASTQ, run in a worker process
+
+    returns: (the passing records as bytes, counts)
+    """
+    out = io.BytesIO()
+    with RangeReader(fp, block, start, end) as fin:
+        counts = filter_reads(fin, out, min_length, max_length, min_quality)
+    return out.getvalue(), counts
+
+
+def filter_chunked(fp, fout, workers: int, min_length=0, max_length=0, min_quality=0.0) -> dict|None:
+    """
+    filter_reads() of a BGZF FASTQ split into chunks at the checkpoints of its read offset index.
+    The chunks are filtered on a pool of processes, a few per worker at a time to bound memory,
+    and written to fout in order.
+
+    args:
+    fp - path of the input FASTQ, which needs its .gzi and .fqi indexes
+    fout - binary file handle to write passing records to
+    workers - int, processes to filter with
+    min_length, max_length, min_quality - cutoffs, see filter_reads()
+
+    returns: dict of counts as filter_reads(), or None if fp has no up to date index
+    """
+    index = load_index(fp)
+    blocks = load_blocks(fp)
+    if index is None or blocks is None:
+        return None
+    chunks = chunk_bounds(index, max(workers * CHUNKS_PER_WORKER, index.offset // CHUNK_BYTES + 1))
+    counts = {'reads_in':0, 'reads_out':0, 'bases_in':0, 'bases_out':0}
+    pending = deque()
+
+    def write_next():
+        data, chunk_counts = pending.popleft().result()
+        fout.write(data)
+        for key in counts:
+            counts[key] += chunk_counts[key]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for start, end, reads in chunks:
+            pending.append(pool.submit(filter_range, fp, block_at(blocks, start), start, end,
+                    min_length, max_length, min_quality))
+            if len(pending) >= 2 * workers:
+                write_next()
+        while pending:
+            write_next()
+    return counts
+
+
+def format_counts(counts: dict) -> str:
+    """
+    One line summary of filter_reads() counts, as written to the filter logs
+    """
+    return f"Kept {counts['reads_out']} of {counts['reads_in']} reads "+\
+            f"({counts['bases_out']} of {counts['bases_in']} bases)"
+
+
+if __name__ == "__main__":
+    parser = AP(description="Single pass FASTQ read filter by length and mean quality")
+    parser.add_argument('input', help="Input FASTQ file, may be gzipped ('-' for stdin)")
+    parser.add_argument('output', nargs='?', default='-',
+            help="Output FASTQ file, gzipped if it ends in .gz (default: stdout)")
+    parser.add_argument('-l', '--minlength', type=int, default=0, help="Minimum read length")
+    parser.add_argument('--maxlength', type=int, default=0, help="Maximum read length (0 for no limit)")
+    parser.add_argument('-q', '--quality', type=float, default=0, help="Minimum mean read quality")
+    parser.add_argument('--compress_level', type=int, default=DEFAULT_COMPRESS_LEVEL, choices=range(1, 10),
+            metavar='1-9', help=f"gzip compression level of the output (default: {DEFAULT_COMPRESS_LEVEL})")
+    parser.add_argument('--compress_threads', type=int, default=0,
+            help="Threads used to compress the output (default: all available cores)")
+    parser.add_argument('--bgzf', action='store_true', help="Write a gzipped output as BGZF, with a .gzi index (see block_gzip.py)")
+    parser.add_argument('--workers', type=int, default=1, help="Processes to filter with, 0 for all available cores. "+\
+            "Needs a BGZF input with a read offset index (see fastq_index.py), otherwise one is used (default: 1)")
+    parser.add_argument('--checksums', help="Append the output's checksum, reads and bases to this JSON Lines file "+\
+            "(see plasmid_manifest.py). Ignored when writing to stdout")
+    args = parser.parse_args()
+
+    fin = open_fastq(args.input, 'rb')
+    hasher = None
+    if args.checksums and args.output != '-':
+        fout, hasher = open_checksummed(args.output, compresslevel=args.compress_level, threads=args.compress_threads,
+                bgzf=args.bgzf)
+    else:
+        fout = open_fastq(args.output, 'wb', compresslevel=args.compress_level, threads=args.compress_threads,
+                bgzf=args.bgzf)
+    workers = args.workers or default_workers()
+    try:
+        counts = None
+        if workers > 1 and args.input != '-':
+            counts = filter_chunked(args.input, fout, workers, min_length=args.minlength,
+                    max_length=args.maxlength, min_quality=args.quality)
+            if counts is None:
+                print(f'No read offset index for {args.input}, filtering it in a single process', file=sys.stderr)
+        if counts is None:
+            counts = filter_reads(fin, fout, min_length=args.minlength,
+                    max_length=args.maxlength, min_quality=args.quality)
+    finally:
+        if fin is not sys.stdin.buffer:
+            fin.close()
+        if fout is not sys.stdout.buffer:
+            fout.close()
+        else:
+            fout.flush()
+    if hasher is not None:
+        record_checksum(args.checksums, args.output, hasher.hexdigest(), counts['reads_out'], counts['bases_out'])
+    print(format_counts(counts), file=sys.stderr)
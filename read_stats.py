@@ -0,0 +1,296 @@
+from collections import Counter
+from pathlib import Path
+import json
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, the pure python path gives the same answers
+    np = None
+
+from fastq_blocks import SEQ_START, SEQ_END, QUAL_START, QUAL_END
+from read_filter import mean_qualities, size_band, SIZE_BAND_BP
+
+"""
+    Per-barcode read statistics, gathered from the blocks of records that collapse is already
+    streaming, so no extra pass over the data is needed.
+
+    Every read's length and mean quality are accumulated into exact histograms (numpy bincount
+    per block where numpy is available). From these come the read count, total bases, N50, and the
+    fraction of reads inside the size band that the filter keeps. Each barcode gets a
+    {barcode}_stats.json next to its collapsed FASTQ, and prep writes a one line per barcode
+    read_stats.tsv summary at the top of the plasmid directory.
+
+    The exact length counts also give an adaptive length band for filtering (see adaptive_band), built
+    around the full-length read peak actually observed rather than the declared plasmid size.
+"""
+
+LENGTH_BIN_BP = 500  # bin width of the length histogram written to the stats JSON
+MAX_QUALITY = 60  # mean qualities above this are counted in the top bin
+LOW_READS_WARNING = 20  # warn when a barcode has fewer reads than this inside its size band
+SUMMARY_NAME = 'read_stats.tsv'
+SUMMARY_COLUMNS = ['client', 'barcode', 'alias', 'size', 'reads', 'bases', 'mean_length', 'n50',
+        'reads_in_band', 'fraction_in_band', 'median_quality']
+BAND_MODES = ('fixed', 'adaptive')
+PEAK_SEARCH_FRACTION = 0.5  # look for the full-length peak within +/- this fraction of the declared size
+PEAK_SMOOTH_BINS = 2  # histogram bins either side summed when smoothing
+PEAK_EDGE_FRACTION = 0.1  # the peak extends until the smoothed counts fall below this fraction of its height above the background
+MIN_PEAK_READS = 10  # fewer reads than this under the smoothed peak is no peak at all
+MIN_PEAK_PROMINENCE = 3  # the peak must be this many times the median height of the search window
+MIN_BAND_FRACTION = 0.1  # the adaptive band is always at least +/- this fraction of the peak length
+
+
+class ReadStats:
+    """
+    Running read length and mean quality histograms for one barcode
+
+    args:
+    size - expected plasmid size from the sample sheet, or 0 if unknown
+    """
+    def __init__(self, size=0):
+        self.size = int(size) if size else 0
+        self.band = size_band(self.size) if self.size else None
+        self.reads = 0
+        self.bases = 0
+        self.in_band = 0
+        self.quality_counts = [0] * (MAX_QUALITY + 1)
+        self.length_counts = np.zeros(0, dtype=np.int64) if np is not None else Counter()
+
+    def add(self, lengths: list, scores: list):
+        """
+        Count a batch of reads, given their lengths and mean qualities
+        """
+        if not lengths:
+            return
+        self.reads += len(lengths)
+        if np is not None:
+            lens = np.asarray(lengths, dtype=np.int64)
+            self.bases += int(lens.sum())
+            counts = np.bincount(lens)
+            if len(counts) > len(self.length_counts):
+                counts[:len(self.length_counts)] += self.length_counts
+                self.length_counts = counts
+            else:
+                self.length_counts[:len(counts)] += counts
+            if self.band:
+                self.in_band += int(np.count_nonzero((lens >= self.band[0]) & (lens <= self.band[1])))
+            quals = np.clip(np.asarray(scores, dtype=np.float64), 0, MAX_QUALITY).astype(np.int64)
+            qcounts = np.bincount(quals, minlength=MAX_QUALITY + 1)
+            self.quality_counts = [a + int(b) for a, b in zip(self.quality_counts, qcounts)]
+            return
+        self.bases += sum(lengths)
+        self.length_counts.update(lengths)
+        if self.band:
+            self.in_band += sum(1 for read_len in lengths if self.band[0] <= read_len <= self.band[1])
+        for score in scores:
+            self.quality_counts[min(max(int(score), 0), MAX_QUALITY)] += 1
+
+    def add_block(self, buf: bytes, spans: list) -> tuple:
+        """
+        Count every record of a block from fastq_blocks.iter_record_blocks()
+        returns: (lengths, scores) so a filter can reuse them
+        """
+        view = memoryview(buf)
+        lengths = [span[SEQ_END] - span[SEQ_START] for span in spans]
+        scores = mean_qualities([view[span[QUAL_START]:span[QUAL_END]] for span in spans])
+        self.add(lengths, scores)
+        return lengths, scores
+
+    def length_items(self) -> list:
+        """
+        Sorted (length, count) pairs of every length seen
+        """
+        if np is not None:
+            lens = np.nonzero(self.length_counts)[0]
+            return list(zip(lens.tolist(), self.length_counts[lens].tolist()))
+        return sorted(self.length_counts.items())
+
+    def n50(self) -> int:
+        """
+        Length L such that reads of length L or longer hold at least half of all bases
+        """
+        half = self.bases / 2
+        total = 0
+        for read_len, count in reversed(self.length_items()):
+            total += read_len * count
+            if total >= half:
+                return read_len
+        return 0
+
+    def median_quality(self) -> int:
+        seen = 0
+        for q, count in enumerate(self.quality_counts):
+            seen += count
+            if seen * 2 >= self.reads and self.reads:
+                return q
+        return 0
+
+    def summary(self) -> dict:
+        """
+        Headline numbers, as used for the run summary
+        """
+        return {
+            'size':self.size,
+            'reads':self.reads,
+            'bases':self.bases,
+            'mean_length':round(self.bases / self.reads) if self.reads else 0,
+            'n50':self.n50(),
+            'reads_in_band':self.in_band if self.band else '',
+            'fraction_in_band':round(self.in_band / self.reads, 4) if self.band and self.reads else '',
+            'median_quality':self.median_quality(),
+        }
+
+    def to_json(self) -> dict:
+        """
+        Summary plus the length histogram in LENGTH_BIN_BP bins and the mean quality histogram in 1 Phred bins
+        """
+        stats = self.summary()
+        stats['band'] = list(self.band) if self.band else None
+        length_bins = []
+        for read_len, count in self.length_items():
+            b = read_len // LENGTH_BIN_BP
+            length_bins.extend([0] * (b + 1 - len(length_bins)))
+            length_bins[b] += count
+        last_q = max((q for q, count in enumerate(self.quality_counts) if count), default=-1)
+        stats['adaptive_band'] = adaptive_band(self.length_items(), self.size)
+        stats['length_histogram'] = {'bin_bp':LENGTH_BIN_BP, 'counts':length_bins}
+        stats['quality_histogram'] = {'bin':1, 'counts':self.quality_counts[:last_q + 1]}
+        return stats
+
+    def to_state(self) -> dict:
+        """
+        Exact, JSON friendly copy of the running totals, so counting can carry on later (see from_state)
+        """
+        return {'size':self.size, 'reads':self.reads, 'bases':self.bases, 'in_band':self.in_band,
+                'quality_counts':list(self.quality_counts),
+                'length_counts':[[read_len, count] for read_len, count in self.length_items()]}
+
+    @classmethod
+    def from_state(cls, state: dict):
+        stats = cls(state['size'])
+        stats.reads = state['reads']
+        stats.bases = state['bases']
+        stats.in_band = state['in_band']
+        stats.quality_counts = list(state['quality_counts'])
+        if np is not None:
+            lens = [read_len for read_len, count in state['length_counts']]
+            stats.length_counts = np.zeros(max(lens, default=-1) + 1, dtype=np.int64)
+            stats.length_counts[lens] = [count for read_len, count in state['length_counts']]
+        else:
+            stats.length_counts = Counter(dict(state['length_counts']))
+        return stats
+
+
+def adaptive_band(length_items: list, size) -> dict|None:
+    """
+    Find the dominant full-length read peak near the declared size and a length band around it
+
+    args:
+    length_items - sorted (length, count) pairs (see ReadStats.length_items)
+    size - declared plasmid size from the sample sheet
+
+    returns: {'peak':length, 'band':[min_length, max_length]}, or None if there is no clear peak.
+    The histogram is binned at 1% of the size and smoothed, and the highest point within
+    +/- PEAK_SEARCH_FRACTION of the size is the peak. It must stand MIN_PEAK_PROMINENCE times above
+    the background (the median of the search window), so a flat spread of broken reads gives no band.
+    The band covers the peak down to PEAK_EDGE_FRACTION of its height above the background, is at
+    least +/- MIN_BAND_FRACTION of the peak, and is never wider than the fixed +/- SIZE_BAND_BP band
+    """
+    size = int(size) if size else 0
+    if size <= 0:
+        return None
+    bin_bp = max(10, size // 100)
+    nbins = int(size * (1 + PEAK_SEARCH_FRACTION)) // bin_bp + PEAK_SMOOTH_BINS + 1
+    counts = [0] * nbins
+    for read_len, count in length_items:
+        if read_len // bin_bp >= nbins:
+            break
+        counts[read_len // bin_bp] += count
+    smooth = [sum(counts[max(0, i - PEAK_SMOOTH_BINS):i + PEAK_SMOOTH_BINS + 1]) for i in range(nbins)]
+    first = int(size * (1 - PEAK_SEARCH_FRACTION)) // bin_bp
+    last = nbins - PEAK_SMOOTH_BINS - 1
+    # highest point, nearest the declared size on a tie
+    peak_i = max(range(first, last + 1), key=lambda i: (smooth[i], -abs(i * bin_bp - size)))
+    window = sorted(smooth[first:last + 1])
+    background = window[len(window) // 2]
+    if smooth[peak_i] < MIN_PEAK_READS or smooth[peak_i] < MIN_PEAK_PROMINENCE * background:
+        return None
+    threshold = background + (smooth[peak_i] - background) * PEAK_EDGE_FRACTION
+    left = right = peak_i
+    while left > 0 and smooth[left - 1] >= threshold:
+        left -= 1
+    while right < nbins - 1 and smooth[right + 1] >= threshold:
+        right += 1
+    peak = peak_i * bin_bp + bin_bp // 2
+    min_half = int(peak * MIN_BAND_FRACTION)
+    min_length = max(min(left * bin_bp, peak - min_half), peak - SIZE_BAND_BP)
+    max_length = min(max((right + 1) * bin_bp, peak + min_half), peak + SIZE_BAND_BP)
+    return {'peak':peak, 'band':[max(0, min_length), max_length]}
+
+
+def choose_band(stats_fp: Path, size, band_mode='fixed') -> tuple:
+    """
+    Length band used to filter a sample
+
+    args:
+    stats_fp - Path of the sample's stats JSON, needed by the adaptive band mode
+    size - declared plasmid size from the sample sheet
+    band_mode - 'fixed' for size +/- SIZE_BAND_BP, 'adaptive' for the band around the observed
+                read length peak, falling back to fixed if there isn't one
+
+    returns: (min_length, max_length, note), note describes the band for the scripts and logs
+    """
+    min_size, max_size = size_band(size)
+    if band_mode == 'adaptive':
+        peak = None
+        if Path(stats_fp).exists():
+            with open(stats_fp, 'rt') as f:
+                peak = json.load(f).get('adaptive_band')
+        if peak:
+            min_length, max_length = peak['band']
+            return min_length, max_length, f"declared size {size}, adaptive length band {min_length}-{max_length} "+\
+                    f"around the read length peak at {peak['peak']}"
+        return min_size, max_size, f'declared size {size}, fixed length band {min_size}-{max_size} '+\
+                f'(no clear read length peak for an adaptive band)'
+    return min_size, max_size, f'declared size {size}, fixed length band {min_size}-{max_size}'
+
+
+def stats_path(collapse_fp: Path) -> Path:
+    """
+    Path of the stats JSON written next to a collapsed FASTQ e.g. barcode01/barcode01_stats.json
+    """
+    return collapse_fp.parent / (collapse_fp.name.split('.')[0] + '_stats.json')
+
+
+def write_barcode_stats(stats: ReadStats, collapse_fp: Path):
+    with open(stats_path(collapse_fp), 'wt') as f:
+        json.dump(stats.to_json(), f, separators=(',', ':'))
+
+
+def write_run_summary(plasmid_dir: Path, client_sheet: dict) -> Path|None:
+    """
+    Gather the stats JSON of every barcode into read_stats.tsv at the top of plasmid_dir,
+    and warn about barcodes with too few usable reads to assemble.
+    Returns the summary path, or None if no barcode has stats
+    """
+    rows = []
+    for client in client_sheet:
+        for barcode in client_sheet[client]:
+            fp = Path(plasmid_dir)/client/barcode/f'{barcode}_stats.json'
+            if not fp.exists():
+                continue
+            with open(fp, 'rt') as f:
+                stats = json.load(f)
+            stats.update({'client':client, 'barcode':barcode, 'alias':client_sheet[client][barcode]['alias']})
+            rows.append(stats)
+            usable = stats['reads_in_band'] if stats['reads_in_band'] != '' else stats['reads']
+            if usable < LOW_READS_WARNING:
+                print(f'Warning: client {client} barcode {barcode} has only {usable} reads '+\
+                        ('in its size band' if stats['reads_in_band'] != '' else 'in total'))
+    if not rows:
+        return None
+    summary_fp = Path(plasmid_dir) / SUMMARY_NAME
+    with open(summary_fp, 'wt') as fout:
+        print('\t'.join(SUMMARY_COLUMNS), file=fout)
+        for row in rows:
+            print('\t'.join(str(row[col]) for col in SUMMARY_COLUMNS), file=fout)
+    return summary_fp
@@ -0,0 +1,180 @@
+from argparse import ArgumentParser as AP
+from pathlib import Path
+from datetime import datetime
+import subprocess
+import signal
+import time
+import os
+
+from block_gzip import default_workers
+from pbs_plan import parse_resources
+
+"""
+    Local executor for the client scripts written by plasmid_prep.py, in place of the
+    sequential run_plasmids.sh.
+
+    The clients listed in run_plasmids.sh (lines that are commented out are skipped) are run
+    several at a time, as long as the CPUs and memory of the running clients fit within the
+    budgets given. Each client's needs are read from the '# resources:' line that prep writes
+    into its run_<client>.sh, and passed on to the client as NCPUS and MEM_GB, which hold its
+    filters, mapping and Nextflow executor to that share. The longest clients are started first. Each client's output is
+    streamed to its own log in run_logs/, a failed client doesn't stop the others, and the wall
+    time and exit status of every client are reported at the end.
+
+    Usage: python run_clients.py <plasmid_dir> [--cpus N] [--mem GB]
+"""
+
+RUN_SCRIPT_NAME = 'run_plasmids.sh'
+RESOURCES_PREFIX = '# resources:'
+LOG_DIR_NAME = 'run_logs'
+POLL_SECONDS = 2
+
+
+def total_mem_gb() -> int:
+    """
+    Physical memory of this machine in GB
+    """
+    try:
+        return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**30)
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def list_client_scripts(plasmid_dir: Path) -> list:
+    """
+    Client scripts run by run_plasmids.sh, in order, skipping any that have been commented out
+    """
+    scripts = []
+    with open(Path(plasmid_dir)/RUN_SCRIPT_NAME, 'rt') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('./run_') and line.endswith('.sh'):
+                scripts.append(Path(plasmid_dir)/line[2:])
+    return scripts
+
+
+def read_resources(script_path: Path) -> dict:
+    """
+    {'mem_gb', 'ncpus', 'seconds'} of a client script, from its '# resources:' line
+    """
+    with open(script_path, 'rt') as f:
+        for line in f:
+            if line.startswith(RESOURCES_PREFIX):
+                return parse_resources(line[len(RESOURCES_PREFIX):].strip())
+    return parse_resources('')
+
+
+def run_clients(plasmid_dir: Path, scripts: list, cpus: int, mem_gb: int, verbose=False) -> dict:
+    """
+    Run client scripts in parallel within the cpu and memory budgets
+
+    args:
+    plasmid_dir - Path of the plasmid directory, where the scripts are run from
+    scripts - list of client script Paths
+    cpus - int, CPUs the running clients may use between them
+    mem_gb - int, GB of memory the running clients may use between them, 0 for no limit
+    verbose - bool, report each client as it starts
+
+    returns: {script name: {'returncode', 'seconds', 'log'}}, returncode is None if the client was never run
+    """
+    log_dir = Path(plasmid_dir)/LOG_DIR_NAME
+    log_dir.mkdir(exist_ok=True)
+    needs = {sp:read_resources(sp) for sp in scripts}
+    # longest first, so the last clients to finish are short ones
+    pending = sorted(scripts, key=lambda sp: -needs[sp]['seconds'])
+    running = {}  # script: (Popen, log file, start time)
+    results = {}
+    free_cpus = cpus
+    free_mem = mem_gb
+    try:
+        while pending or running:
+            for sp in list(pending):
+                need = needs[sp]
+                # a client bigger than the whole budget still runs, on its own
+                fits = need['ncpus'] <= free_cpus and (not mem_gb or need['mem_gb'] <= free_mem)
+                if not fits and running:
+                    continue
+                log_fp = log_dir/f'{sp.stem}.log'
+                logf = open(log_fp, 'wb')
+                # like run_plasmids.sh, load the user's environment (e.g. conda) first
+                # NCPUS tells the client script how many filters to run at once, and with MEM_GB
+                # caps the CPUs and memory its Nextflow executor schedules tasks on
+                proc = subprocess.Popen(['bash', '-c', f'source ~/.bashrc; exec bash ./{sp.name}'], cwd=plasmid_dir,
+                        env=dict(os.environ, NCPUS=str(need['ncpus']), MEM_GB=str(need['mem_gb'])), stdout=logf, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=True)
+                running[sp] = (proc, logf, time.time())
+                pending.remove(sp)
+                free_cpus -= need['ncpus']
+                free_mem -= need['mem_gb']
+                if verbose:
+                    print(f'{datetime.now():%H:%M:%S} started {sp.name} ({need["ncpus"]} cpus, {need["mem_gb"]}GB), log {log_fp}')
+            time.sleep(POLL_SECONDS)
+            for sp, (proc, logf, start) in list(running.items()):
+                if proc.poll() is None:
+                    continue
+                logf.close()
+                del running[sp]
+                free_cpus += needs[sp]['ncpus']
+                free_mem += needs[sp]['mem_gb']
+                results[sp.name] = {'returncode':proc.returncode, 'seconds':time.time() - start, 'log':str(Path(logf.name))}
+                status = 'finished' if proc.returncode == 0 else f'FAILED with exit code {proc.returncode}'
+                print(f'{datetime.now():%H:%M:%S} {sp.name} {status} after {time.time() - start:.0f} seconds')
+    except KeyboardInterrupt:
+        print('Interrupted, stopping the running clients')
+        for sp, (proc, logf, start) in running.items():
+            # the whole process group, so nextflow and its tasks stop too
+            try:
+                os.killpg(proc.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for sp, (proc, logf, start) in running.items():
+            proc.wait()
+            logf.close()
+            results[sp.name] = {'returncode':proc.returncode, 'seconds':time.time() - start, 'log':str(Path(logf.name))}
+    for sp in pending:
+        results[sp.name] = {'returncode':None, 'seconds':0, 'log':''}
+    return results
+
+
+def format_results(results: dict) -> str:
+    """
+    One line per client of exit status and wall time, in the order the clients finished
+    """
+    lines = []
+    for name, res in results.items():
+        if res['returncode'] is None:
+            status = 'not run'
+        else:
+            status = 'ok' if res['returncode'] == 0 else f'failed ({res["returncode"]})'
+        h, rem = divmod(int(res['seconds']), 3600)
+        lines.append(f'{name}\t{status}\t{h}:{rem // 60:02d}:{rem % 60:02d}\t{res["log"]}')
+    return '\n'.join(lines)
+
+
+def main():
+    parser = AP(description='Run the client scripts of a prepared plasmid directory in parallel')
+    parser.add_argument('plasmid_dir', help='Plasmid directory written by plasmid_prep.py')
+    parser.add_argument('--cpus', type=int, default=default_workers(), help='CPUs shared by the running clients (default: all available cores)')
+    parser.add_argument('--mem', type=int, default=total_mem_gb(), help='GB of memory shared by the running clients (default: all physical memory, 0 for no limit)')
+    parser.add_argument('--clients', nargs='*', help='Only run these clients')
+    parser.add_argument('-v', '--verbose', action='store_true', help='More output')
+    args = parser.parse_args()
+
+    plasmid_dir = Path(args.plasmid_dir)
+    if not (plasmid_dir/RUN_SCRIPT_NAME).exists():
+        print(f'No {RUN_SCRIPT_NAME} found in {plasmid_dir}, run plasmid_prep.py first')
+        exit(1)
+    scripts = list_client_scripts(plasmid_dir)
+    if args.clients:
+        scripts = [sp for sp in scripts if sp.stem[len('run_'):] in args.clients]
+    if not scripts:
+        print(f'No client scripts to run')
+        exit(1)
+    print(f'Running {len(scripts)} clients with {args.cpus} cpus and {args.mem}GB of memory')
+    results = run_clients(plasmid_dir, scripts, args.cpus, args.mem, verbose=args.verbose)
+    print(format_results(results))
+    if any(res['returncode'] != 0 for res in results.values()):
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
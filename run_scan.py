@@ -0,0 +1,174 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+import os
+import json
+
+"""
+    Fast scan of a PromethION run tree for the barcode directories named in the sample sheet.
+
+    The walk uses os.scandir(), so directory entries come back with their type and no extra
+    stat() per entry, and it never descends into subtrees that can't hold passed FASTQs (pod5,
+    fastq_fail, other_reports, ...). Directories are listed on a pool of threads, which hides
+    most of the metadata latency of network filesystems such as Lustre on Gadi.
+
+    The result is kept as a scan index: barcode -> barcode directory -> [[file name, size, mtime_ns]],
+    along with the mtime of every fastq_pass and barcode directory. prep saves it in the plasmid
+    directory as scan_index.json. A re-run with --resume reloads it and only lists again the barcode
+    directories whose mtime has changed, instead of walking the whole run again.
+"""
+
+SCAN_INDEX_NAME = 'scan_index.json'
+SCAN_INDEX_VERSION = 1
+SCAN_THREADS = 8  # directory listings in flight, mostly waiting on the filesystem
+# MinKNOW output directories that never contain passed FASTQs
+PRUNE_DIRS = {'pod5', 'pod5_pass', 'pod5_fail', 'pod5_skip', 'fast5', 'fast5_pass', 'fast5_fail', 'fast5_skip',
+        'fastq_fail', 'bam_pass', 'bam_fail', 'other_reports'}
+
+
+def scan_index_path(plasmid_dir: Path) -> Path:
+    return Path(plasmid_dir) / SCAN_INDEX_NAME
+
+
+def walk_dir(dp: str) -> tuple:
+    """
+    List one directory of the run tree
+    returns: (subdirs, fastq_pass_dirs) - the directories to walk further, and any fastq_pass directories
+    """
+    subdirs = []
+    fastq_pass_dirs = []
+    with os.scandir(dp) as it:
+        for entry in it:
+            if not entry.is_dir() or entry.name.startswith('.') or entry.name in PRUNE_DIRS:
+                continue
+            if entry.name == 'fastq_pass':
+                fastq_pass_dirs.append(entry.path)
+            else:
+                subdirs.append(entry.path)
+    return subdirs, fastq_pass_dirs
+
+
+def list_fastq_pass(dp: str, all_barcodes: set) -> tuple:
+    """
+    returns: (mtime_ns, barcode_dirs) of a fastq_pass directory, keeping only the wanted barcodes
+    """
+    mtime_ns = os.stat(dp).st_mtime_ns
+    with os.scandir(dp) as it:
+        barcode_dirs = [entry.path for entry in it if entry.name in all_barcodes and entry.is_dir()]
+    return mtime_ns, barcode_dirs
+
+
+def list_barcode_dir(dp: str) -> dict:
+    """
+    returns: {'mtime_ns':..., 'files':[[name, size, mtime_ns], ...]} for a barcode directory, sorted by name
+    """
+    mtime_ns = os.stat(dp).st_mtime_ns
+    files = []
+    with os.scandir(dp) as it:
+        for entry in it:
+            if entry.is_file():
+                st = entry.stat()
+                files.append([entry.name, st.st_size, st.st_mtime_ns])
+    return {'mtime_ns':mtime_ns, 'files':sorted(files)}
+
+
+def scan_run(prom_dir, all_barcodes: set, threads=SCAN_THREADS, list_files=True) -> dict:
+    """
+    Walk prom_dir for the fastq_pass/<barcode> directories of all_barcodes
+
+    args:
+    prom_dir - Path of the PromethION run (or pool of runs)
+    all_barcodes - set of barcode directory names to find
+    threads - int, number of directories listed at once
+    list_files - bool, also list the files in every barcode directory
+
+    returns: scan index dict (see module docstring)
+    """
+    index = {'version':SCAN_INDEX_VERSION, 'prom_dir':str(Path(prom_dir).resolve()), 'fastq_pass':{}, 'barcodes':{}}
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        pending = {pool.submit(walk_dir, str(prom_dir)): ('walk', None)}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                kind, dp = pending.pop(fut)
+                if kind == 'walk':
+                    subdirs, fastq_pass_dirs = fut.result()
+                    for sub in subdirs:
+                        pending[pool.submit(walk_dir, sub)] = ('walk', sub)
+                    for fpd in fastq_pass_dirs:
+                        pending[pool.submit(list_fastq_pass, fpd, all_barcodes)] = ('fastq_pass', fpd)
+                elif kind == 'fastq_pass':
+                    mtime_ns, barcode_dirs = fut.result()
+                    index['fastq_pass'][dp] = mtime_ns
+                    for bcd in barcode_dirs:
+                        index['barcodes'].setdefault(Path(bcd).name, {})[bcd] = {'mtime_ns':0, 'files':[]}
+                        if list_files:
+                            pending[pool.submit(list_barcode_dir, bcd)] = ('barcode', bcd)
+                else:
+                    index['barcodes'][Path(dp).name][dp] = fut.result()
+    return index
+
+
+def refresh_scan_index(index: dict, threads=SCAN_THREADS) -> dict|None:
+    """
+    Bring a saved scan index up to date, listing again only the barcode directories that have changed.
+    Returns None if the index can't be trusted and the run must be walked again: a fastq_pass
+    directory has changed (barcodes added or removed) or a barcode directory has gone
+    """
+    try:
+        for fpd, mtime_ns in index['fastq_pass'].items():
+            if os.stat(fpd).st_mtime_ns != mtime_ns:
+                return None
+        stale = [bcd for dirs in index['barcodes'].values() for bcd, entry in dirs.items()
+                if os.stat(bcd).st_mtime_ns != entry['mtime_ns']]
+    except OSError:
+        return None
+    with ThreadPoolExecutor(max_workers=max(1, threads)) as pool:
+        for bcd, listing in zip(stale, pool.map(list_barcode_dir, stale)):
+            index['barcodes'][Path(bcd).name][bcd] = listing
+    return index
+
+
+def load_scan_index(plasmid_dir: Path, prom_dir, all_barcodes: set, threads=SCAN_THREADS) -> dict|None:
+    """
+    Reload and refresh the scan index saved in plasmid_dir. Returns None if there isn't one, it was made
+    for a different run, it is missing barcodes that are wanted now, or it is out of date (see refresh_scan_index)
+    """
+    sp = scan_index_path(plasmid_dir)
+    if not sp.exists():
+        return None
+    try:
+        with open(sp, 'rt') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if index.get('version') != SCAN_INDEX_VERSION or index.get('prom_dir') != str(Path(prom_dir).resolve()):
+        return None
+    if set(all_barcodes).difference(index['barcodes']):
+        return None
+    return refresh_scan_index(index, threads=threads)
+
+
+def save_scan_index(plasmid_dir: Path, index: dict):
+    """
+    Write the scan index atomically
+    """
+    sp = scan_index_path(plasmid_dir)
+    tmp = sp.with_name(sp.name + '.tmp')
+    with open(tmp, 'wt') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(tmp, sp)
+
+
+def barcode_dirs(index: dict) -> dict:
+    """
+    {barcode: Path of its directory} from a scan index. If a barcode turns up in more than one
+    run, the last directory in path order is used
+    """
+    return {barcode:Path(sorted(dirs)[-1]) for barcode, dirs in index['barcodes'].items() if dirs}
+
+
+def barcode_files(index: dict, bcd: Path) -> list:
+    """
+    Paths of the files in barcode directory bcd, as listed in the scan index
+    """
+    return [Path(bcd)/name for name, size, mtime_ns in index['barcodes'][Path(bcd).name][str(bcd)]['files']]